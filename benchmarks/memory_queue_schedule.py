@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Measure cost of `get()` of memory task queue with many delayed tasks.
+
+Usage: python benchmarks/memory_queue_schedule.py
+
+The cost of one `get()` call should not depend on the number of delayed
+tasks which are not due yet.
+"""
+from __future__ import print_function
+from datetime import datetime, timedelta
+import time
+
+from grab.spider import Task
+from grab.spider.queue_backend.memory_queue import QueueBackend
+
+GET_NUMBER = 10000
+
+
+def measure(delayed_number):
+    queue = QueueBackend("bench")
+    future = datetime.utcnow() + timedelta(hours=1)
+    for num in range(delayed_number):
+        queue.put(
+            Task("page", url="http://example.com/%d" % num),
+            priority=100,
+            schedule_time=future + timedelta(seconds=num),
+        )
+    for num in range(GET_NUMBER):
+        queue.put(Task("page", url="http://example.com/ready/%d" % num), 100)
+    start = time.time()
+    for _ in range(GET_NUMBER):
+        queue.get()
+    return (time.time() - start) / GET_NUMBER
+
+
+def main():
+    print("%15s %15s" % ("delayed tasks", "usec per get"))
+    for delayed_number in (0, 1000, 10000, 100000):
+        print("%15d %15.2f" % (delayed_number, measure(delayed_number) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
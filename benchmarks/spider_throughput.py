@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Measure throughput of the spider with local HTTP server.
+
+Usage: python benchmarks/spider_throughput.py [options]
+
+The HTTP server is started in separate process, it responds with HTML page
+of `--page-size` bytes after `--latency` milliseconds. The reference spider
+downloads `--tasks` pages and parses each page. The spider is run in new
+process for each combination of `--network-service`, `--grab-transport`,
+`--thread-number` and `--parser-pool-size` options (comma-separated lists),
+combinations of "multicurl" network service with other transports than
+"pycurl" are skipped.
+
+Results are printed as JSON, for each run:
+
+* rps - number of processed tasks per second, the time from the start
+  of the spider to the completion of the last task is used, time of the
+  spider shutdown is not included
+* elapsed - total time of the spider run
+* cpu_percent - CPU time of the spider process and its parser processes
+  divided by the elapsed time
+* peak_rss_mb - peak resident memory of the spider process
+* children_peak_rss_mb - peak resident memory of the largest parser process
+  (in mp mode)
+
+The HTTP server is written in python, so it could limit RPS if the latency
+is zero. Compare results of runs with same options only.
+"""
+from __future__ import print_function
+from argparse import SUPPRESS, ArgumentParser
+import itertools
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from grab.spider import Spider, Task
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1024 * 1024 if sys.platform == "darwin" else 1024
+
+
+def build_page(size):
+    head = b"<html><head><title>Benchmark</title></head><body>"
+    tail = b"</body></html>"
+    link = b'<p><a href="/page/%d">Some text of the link</a></p>\n'
+    parts = [head]
+    length = len(head) + len(tail)
+    num = 0
+    while length < size:
+        chunk = link % num
+        parts.append(chunk)
+        length += len(chunk)
+        num += 1
+    parts.append(tail)
+    return b"".join(parts)[: max(size, len(head) + len(tail))]
+
+
+class BenchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Many network streams could connect at the same time
+    request_queue_size = 1024
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    page = b""
+    latency = 0
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def server_main(page_size, latency, port_queue):
+    BenchHandler.page = build_page(page_size)
+    BenchHandler.latency = latency
+    server = BenchServer(("127.0.0.1", 0), BenchHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class BenchSpider(Spider):
+    last_task_time = None
+
+    def task_generator(self):
+        for num in range(self.meta["tasks"]):
+            yield Task("page", url="%s/page/%d" % (self.meta["base_url"], num))
+
+    def task_page(self, grab, unused_task):
+        grab.doc.select("//title").text()
+        self.stat.inc("bench:links", grab.doc.select("//a").count())
+        # Counters of parser processes are merged in mp mode
+        self.stat.inc("bench:page")
+
+    def ack_task(self, task):
+        # Called in the spider process when the task is completed,
+        # also in mp mode
+        super(BenchSpider, self).ack_task(task)
+        self.last_task_time = time.time()
+
+
+def run_spider(config):
+    """
+    Run the spider with options from `config` in current process.
+    """
+    bot = BenchSpider(
+        thread_number=config["thread_number"],
+        network_service=config["network_service"],
+        grab_transport=config["grab_transport"],
+        parser_pool_size=config["parser_pool_size"],
+        mp_mode=config["mp_mode"],
+        # Failed requests are not retried
+        network_try_limit=1,
+        meta={"tasks": config["tasks"], "base_url": config["base_url"]},
+    )
+    bot.stat.logging_period = 0
+    start = time.time()
+    bot.run()
+    elapsed = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # The "spider:task-page" counter includes network errors
+    processed = bot.stat.counters["bench:page"]
+    work_time = (bot.last_task_time or time.time()) - start
+    cpu_time = (
+        usage.ru_utime + usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+    )
+    return {
+        "processed": processed,
+        "errors": config["tasks"] - processed,
+        "elapsed": round(elapsed, 3),
+        "rps": round(processed / work_time, 1),
+        "cpu_percent": round(cpu_time / elapsed * 100, 1),
+        "peak_rss_mb": round(float(usage.ru_maxrss) / RSS_UNIT, 1),
+        "children_peak_rss_mb": round(float(child_usage.ru_maxrss) / RSS_UNIT, 1),
+    }
+
+
+def run_worker(config):
+    """
+    Run the spider in new process to measure its CPU and memory usage.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, __file__, "--worker", json.dumps(config)],
+        stdout=subprocess.PIPE,
+    )
+    out, _ = proc.communicate()
+    if proc.returncode:
+        return {"error": "worker exited with code %d" % proc.returncode}
+    return json.loads(out.decode("utf-8").strip().splitlines()[-1])
+
+
+def parse_list(value, cast=str):
+    return [cast(x.strip()) for x in value.split(",") if x.strip()]
+
+
+def build_parser():
+    parser = ArgumentParser(description="Measure throughput of the spider")
+    parser.add_argument("--network-service", default="multicurl,threaded")
+    parser.add_argument("--grab-transport", default="pycurl,urllib3")
+    parser.add_argument("--thread-number", default="10,50")
+    parser.add_argument("--parser-pool-size", default="1,4")
+    parser.add_argument(
+        "--mp-mode", action="store_true", help="run parsers in separate processes"
+    )
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="response latency, milliseconds"
+    )
+    parser.add_argument("--page-size", type=int, default=10000, help="bytes")
+    parser.add_argument("--output", help="file to save results, default is stdout")
+    parser.add_argument("--worker", help=SUPPRESS)
+    return parser
+
+
+def main():
+    opts = build_parser().parse_args()
+    if opts.worker:
+        logging.basicConfig(level=logging.CRITICAL)
+        print(json.dumps(run_spider(json.loads(opts.worker))))
+        return
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=server_main, args=(opts.page_size, opts.latency / 1000.0, port_queue)
+    )
+    server.daemon = True
+    server.start()
+    base_url = "http://127.0.0.1:%d" % port_queue.get()
+
+    results = []
+    try:
+        for network_service, grab_transport, thread_number, pool_size in (
+            itertools.product(
+                parse_list(opts.network_service),
+                parse_list(opts.grab_transport),
+                parse_list(opts.thread_number, int),
+                parse_list(opts.parser_pool_size, int),
+            )
+        ):
+            config = {
+                "network_service": network_service,
+                "grab_transport": grab_transport,
+                "thread_number": thread_number,
+                "parser_pool_size": pool_size,
+                "mp_mode": opts.mp_mode,
+                "tasks": opts.tasks,
+                "base_url": base_url,
+            }
+            if network_service.startswith("multicurl") and grab_transport != "pycurl":
+                result = {"skipped": "requires pycurl transport"}
+            else:
+                result = run_worker(config)
+            del config["base_url"]
+            config.update(result)
+            results.append(config)
+            print(
+                "%-18s %-8s threads=%-4d parsers=%-3d %s"
+                % (
+                    network_service,
+                    grab_transport,
+                    thread_number,
+                    pool_size,
+                    ", ".join("%s=%s" % x for x in sorted(result.items())),
+                ),
+                file=sys.stderr,
+            )
+    finally:
+        server.terminate()
+
+    report = json.dumps(
+        {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency_ms": opts.latency,
+            "page_size": opts.page_size,
+            "results": results,
+        },
+        indent=2,
+        sort_keys=True,
+    )
+    if opts.output:
+        with open(opts.output, "w") as out:
+            out.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
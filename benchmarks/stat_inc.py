@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Measure cost of `Stat.inc()` called concurrently from many threads.
+
+Usage: python benchmarks/stat_inc.py
+
+Each thread increments several counters like network and parser threads
+of the spider do. The cost of one call should stay at a few hundred
+nanoseconds regardless of the number of threads.
+"""
+from __future__ import print_function
+from threading import Thread
+import time
+
+from grab.stat import Stat
+
+INC_NUMBER = 200000
+KEYS = [
+    "spider:request-processed",
+    "spider:task",
+    "spider:task-page",
+    "spider:download-size",
+]
+
+
+def worker(stat):
+    inc = stat.inc
+    for num in range(INC_NUMBER):
+        inc(KEYS[num % 4])
+
+
+def measure(thread_number):
+    stat = Stat()
+    stat.start()
+    threads = [Thread(target=worker, args=[stat]) for _ in range(thread_number)]
+    start = time.time()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    elapsed = time.time() - start
+    stat.stop()
+    assert sum(stat.counters.values()) == INC_NUMBER * thread_number
+    return elapsed / (INC_NUMBER * thread_number)
+
+
+def main():
+    print("%15s %15s" % ("threads", "nsec per inc"))
+    for thread_number in (1, 4, 8, 16):
+        print("%15d %15.0f" % (thread_number, measure(thread_number) * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,7 @@ from unicodec import decode_content, detect_content_encoding, normalize_encoding
 from grab.cookie import CookieManager
 from grab.error import DataNotFound, GrabMisuseError
 from grab.unset import UNSET, UnsetType
+from grab.util.codec import decompress
 from grab.util.files import hashed_path
 from grab.util.html import decode_entities, find_refresh_url
 from grab.util.http import smart_urlencode
@@ -57,6 +58,7 @@ class Document(object):
         "code",
         "head",
         "_bytes_body",
+        "_compressed_body",
         "body_path",
         "headers",
         "url",
@@ -111,6 +113,9 @@ class Document(object):
         # Body
         self.body_path = None
         self._bytes_body = None
+        # (codec name, compressed body) which is decompressed
+        # when the body is accessed first time
+        self._compressed_body = None
         self._unicode_body = None
 
         # DOM Tree
@@ -232,7 +237,8 @@ class Document(object):
                 pass
 
         with open(path, "wb") as out:
-            out.write(self._bytes_body if self._bytes_body is not None else b"")
+            body = self._read_body()
+            out.write(body if body is not None else b"")
 
     def save_hash(self, location, basedir, ext=None):
         """
@@ -272,7 +278,7 @@ class Document(object):
             except OSError:
                 pass
             with open(path, "wb") as out:
-                out.write(self._bytes_body)
+                out.write(self._read_body())
         return rel_path
 
     @property
@@ -479,8 +485,10 @@ class Document(object):
         if self.body_path:
             with open(self.body_path, "rb") as inp:
                 body_chunk = inp.read(4096)
-        elif self._bytes_body:
-            body_chunk = self._bytes_body[:4096]
+        else:
+            body = self._read_body()
+            if body:
+                body_chunk = body[:4096]
         return body_chunk
 
     def read_body_from_file(self):
@@ -509,6 +517,10 @@ class Document(object):
         if self.body_path:
             return self.read_body_from_file()
         else:
+            if self._compressed_body is not None:
+                codec_name, data = self._compressed_body
+                self._bytes_body = decompress(codec_name, data)
+                self._compressed_body = None
             return self._bytes_body
 
     def _write_body(self, body):
@@ -520,10 +532,19 @@ class Document(object):
             self._bytes_body = None
         else:
             self._bytes_body = body
+        self._compressed_body = None
         self._unicode_body = None
 
     body = property(_read_body, _write_body)
 
+    def set_compressed_body(self, codec_name, data):
+        """
+        Set body which is decompressed only when it is accessed.
+        """
+        self._bytes_body = None
+        self._compressed_body = (codec_name, data)
+        self._unicode_body = None
+
     # DomTreeExtension methods
 
     @property
@@ -3,9 +3,12 @@
 # TODO: cache_service input task queue should be powered by task queue backend
 import logging
 import time
+from collections import deque
 from copy import deepcopy
 from datetime import datetime
+from functools import partial
 from random import randint
+from threading import Lock
 from traceback import format_exception, format_stack
 
 import six
@@ -14,17 +17,33 @@ from six.moves.queue import Empty, Queue
 from grab.base import Grab
 from grab.error import GrabInvalidUrl
 from grab.proxylist import BaseProxySource, ProxyList
-from grab.spider.cache_service import CacheReaderService, CacheWriterService
+from grab.spider.cache_memory import MemoryCache
+from grab.spider.cache_service import (
+    DEFAULT_BATCH_SIZE as DEFAULT_CACHE_BATCH_SIZE,
+    DEFAULT_EVICT_BATCH_SIZE as DEFAULT_CACHE_EVICT_BATCH_SIZE,
+    DEFAULT_EVICT_INTERVAL as DEFAULT_CACHE_EVICT_INTERVAL,
+    DEFAULT_FLUSH_INTERVAL as DEFAULT_CACHE_FLUSH_INTERVAL,
+    DEFAULT_READ_BATCH_SIZE as DEFAULT_CACHE_READ_BATCH_SIZE,
+    DEFAULT_READER_POOL_SIZE as DEFAULT_CACHE_READER_POOL_SIZE,
+    DEFAULT_SCAN_BATCH_SIZE as DEFAULT_CACHE_SCAN_BATCH_SIZE,
+    CacheReaderService,
+    CacheScannerService,
+    CacheWriterService,
+)
 from grab.spider.error import NoTaskHandler, SpiderError, SpiderMisuseError
+from grab.spider.host_scheduler import DEFAULT_LOOKAHEAD, HostScheduler
 from grab.spider.http_api_service import HttpApiService
 from grab.spider.parser_service import ParserService
 from grab.spider.task import Task
 from grab.spider.task_dispatcher_service import TaskDispatcherService
 from grab.spider.task_generator_service import TaskGeneratorService
+from grab.spider.tracer import TaskTracer
+from grab.spider.url_filter import URL_FILTER_BACKENDS
 from grab.stat import Stat
 from grab.unset import UNSET
 from grab.util.metric import format_traffic_value
 from grab.util.misc import camel_case_to_underscore
+from grab.util.warc import WarcWriter
 from grab.util.warning import warn
 
 DEFAULT_TASK_PRIORITY = 100
@@ -130,6 +149,7 @@ class Spider(object):
         http_api_port=None,
         network_service="multicurl",
         grab_transport="pycurl",
+        mp_mode=False,
         # Deprecated
         transport=None,
     ):
@@ -150,6 +170,10 @@ class Spider(object):
         * retry_rebuild_user_agent - generate new random user-agent for each
             network request which is performed again due to network error
         * args - command line arguments parsed with `setup_arg_parser` method
+        * network_service - could be "multicurl", "multicurl-socket",
+            "threaded" or "asyncio"
+        * mp_mode - run task handlers in `parser_pool_size` separate
+            processes instead of threads
         """
 
         self.fatal_error_queue = Queue()
@@ -161,6 +185,9 @@ class Spider(object):
         self.parser_requests_per_process = parser_requests_per_process
         self.stat = Stat()
         self.task_queue = None
+        self.task_queue_batch_size = 1
+        self.task_buffer = deque()
+        self.task_buffer_lock = Lock()
         if args is None:
             self.args = {}
         else:
@@ -200,10 +227,18 @@ class Spider(object):
         self.interrupted = False
         self.cache_reader_service = None
         self.cache_writer_service = None
+        self.cache_scanner_service = None
+        self.cache_backend_factory = None
+        self.warc_writer = None
+        self.task_tracer = None
+        self.host_scheduler = None
+        self.url_filter = None
         self.parser_pool_size = parser_pool_size
+        self.mp_mode = mp_mode
         self.parser_service = ParserService(
             spider=self,
             pool_size=self.parser_pool_size,
+            mp_mode=self.mp_mode,
         )
         if transport is not None:
             warn(
@@ -211,11 +246,40 @@ class Spider(object):
                 ' deprecated. Use "network_service" argument.'
             )
             network_service = transport
-        assert network_service in ("multicurl", "threaded")
+        assert network_service in (
+            "multicurl",
+            "multicurl-socket",
+            "threaded",
+            "asyncio",
+        )
         if network_service == "multicurl":
             from grab.spider.network_service.multicurl import NetworkServiceMulticurl
 
             self.network_service = NetworkServiceMulticurl(self, self.thread_number)
+        elif network_service == "multicurl-socket":
+            if grab_transport != "pycurl":
+                raise SpiderMisuseError(
+                    "The multicurl-socket network service works only with"
+                    ' "pycurl" grab transport'
+                )
+            from grab.spider.network_service.multicurl_socket import (
+                NetworkServiceMulticurlSocket,
+            )
+
+            self.network_service = NetworkServiceMulticurlSocket(
+                self, self.thread_number
+            )
+        elif network_service == "asyncio":
+            if grab_transport != "pycurl":
+                raise SpiderMisuseError(
+                    "The asyncio network service works only with"
+                    ' "pycurl" grab transport'
+                )
+            from grab.spider.network_service.asyncio_loop import (
+                NetworkServiceAsyncio,
+            )
+
+            self.network_service = NetworkServiceAsyncio(self, self.thread_number)
         elif network_service == "threaded":
             # pylint: disable=no-name-in-module, import-error
             from grab.spider.network_service.threaded import NetworkServiceThreaded
@@ -231,35 +295,183 @@ class Spider(object):
             self,
         )
 
-    def setup_cache(self, backend="mongodb", database=None, **kwargs):
+    def setup_cache(
+        self,
+        backend="mongodb",
+        database=None,
+        batch_size=DEFAULT_CACHE_BATCH_SIZE,
+        flush_interval=DEFAULT_CACHE_FLUSH_INTERVAL,
+        reader_pool_size=DEFAULT_CACHE_READER_POOL_SIZE,
+        read_batch_size=DEFAULT_CACHE_READ_BATCH_SIZE,
+        cache_timeout=None,
+        max_age=None,
+        max_size=None,
+        evict_interval=DEFAULT_CACHE_EVICT_INTERVAL,
+        evict_batch_size=DEFAULT_CACHE_EVICT_BATCH_SIZE,
+        memory_max_items=None,
+        memory_max_bytes=None,
+        **kwargs
+    ):
         """
         Setup cache.
 
         :param backend: Backend name
-            Should be one of the following: 'mongo', 'mysql' or 'postgresql'.
-        :param database: Database name.
+            Should be one of the following: 'mongo', 'mysql', 'postgresql',
+            'sqlite' or 'warc'.
+        :param database: Database name. For 'sqlite' backend it is the path
+            to the database file. For 'warc' backend it is the path to WARC
+            file or the list of paths.
+        :param batch_size: Max. number of responses which are saved into
+            the cache with one transaction.
+        :param flush_interval: Max. number of seconds which response waits
+            in the batch before it is saved into the cache.
+        :param reader_pool_size: Number of threads which read responses
+            from the cache, each thread has own connection to the database.
+        :param read_batch_size: Max. number of responses which are read
+            from the cache with one request.
+        :param cache_timeout: Max. age of cached response in seconds. Expired
+            response is revalidated with conditional request if it has ETag
+            or Last-Modified header, otherwise it is downloaded again. Use
+            `cache_timeout` option of the task to change it for the task.
+        :param max_age: Max. number of seconds the response is kept in the
+            cache, older responses are removed by the background thread.
+        :param max_size: Max. number of responses in the cache, oldest
+            responses are removed by the background thread.
+        :param evict_interval: Number of seconds between checks of
+            `max_age` and `max_size` limits.
+        :param evict_batch_size: Max. number of responses which are removed
+            from the cache with one request.
+        :param memory_max_items: Max. number of responses in the in-memory
+            cache which is used in front of the cache storage. The in-memory
+            cache is used only if this option or `memory_max_bytes` is set.
+        :param memory_max_bytes: Max. total size of responses in the
+            in-memory cache.
         :param kwargs: Additional credentials for backend.
 
         """
         if database is None:
             raise SpiderMisuseError("setup_cache method requires database " "option")
+        if reader_pool_size < 1:
+            raise SpiderMisuseError("Option reader_pool_size should be positive")
         if backend == "mongo":
             warn('Backend name "mongo" is deprecated. Use "mongodb" instead.')
             backend = "mongodb"
         mod = __import__(
             "grab.spider.cache_backend.%s" % backend, globals(), locals(), ["foo"]
         )
-        backend = mod.CacheBackend(database=database, spider=self, **kwargs)
-        self.cache_reader_service = CacheReaderService(self, backend)
-        backend = mod.CacheBackend(database=database, spider=self, **kwargs)
-        self.cache_writer_service = CacheWriterService(self, backend)
+        if getattr(mod.CacheBackend, "read_only", False) and (
+            max_age is not None or max_size is not None
+        ):
+            raise SpiderMisuseError(
+                "Options max_age and max_size are not supported by"
+                " read-only %s cache backend" % backend
+            )
+        if memory_max_items is not None or memory_max_bytes is not None:
+            memory_cache = MemoryCache(
+                max_items=memory_max_items, max_bytes=memory_max_bytes
+            )
+        else:
+            memory_cache = None
+        # Each service thread has its own backend, the reparse mode
+        # creates backend with the same options later
+        self.cache_backend_factory = partial(
+            mod.CacheBackend, database=database, spider=self, **kwargs
+        )
+        backends = [self.cache_backend_factory() for _ in range(reader_pool_size)]
+        self.cache_reader_service = CacheReaderService(
+            self,
+            backends,
+            batch_size=read_batch_size,
+            cache_timeout=cache_timeout,
+            memory_cache=memory_cache,
+        )
+        backend = self.cache_backend_factory()
+        if max_age is not None or max_size is not None:
+            evict_backend = self.cache_backend_factory()
+        else:
+            evict_backend = None
+        self.cache_writer_service = CacheWriterService(
+            self,
+            backend,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            evict_backend=evict_backend,
+            max_age=max_age,
+            max_size=max_size,
+            evict_interval=evict_interval,
+            evict_batch_size=evict_batch_size,
+            memory_cache=memory_cache,
+        )
 
-    def setup_queue(self, backend="memory", **kwargs):
+    def setup_reparse(self, task_name=None, batch_size=DEFAULT_CACHE_SCAN_BATCH_SIZE):
+        """
+        Setup reparse mode.
+
+        In reparse mode the spider does not make network requests. All
+        responses stored in the cache are read sequentially and passed to
+        handlers of tasks which have received them. Tasks generated by
+        `task_generator`, initial URLs and handlers are not processed.
+        Use this mode to run changed handlers over the whole cache.
+
+        :param task_name: Name of the task for responses which have been
+            saved in the cache without task name (by old versions of grab).
+            If it is None then such responses are skipped.
+        :param batch_size: Number of responses which are read from the cache
+            with one request.
+        """
+        if self.cache_backend_factory is None:
+            raise SpiderMisuseError(
+                "setup_reparse method requires cache configured with"
+                " `setup_cache` method"
+            )
+        self.cache_scanner_service = CacheScannerService(
+            self,
+            self.cache_backend_factory(),
+            task_name=task_name,
+            batch_size=batch_size,
+        )
+
+    def setup_warc(self, path, compress_level=6):
+        """
+        Setup writing of network responses into WARC file.
+
+        Each response is written as separate gzip member, the index
+        of records is written into `<path>.idx` file. Responses are
+        appended if the file exists. Use "warc" cache backend to load
+        responses from WARC files.
+
+        :param path: Path to the WARC file.
+        :param compress_level: Level of gzip compression.
+        """
+        self.warc_writer = WarcWriter(path, compress_level=compress_level)
+
+    def setup_trace(self, path=None, sample_rate=0.01, max_tasks=1000):
+        """
+        Setup tracing of the task lifecycle.
+
+        Time spent by tasks in each stage of processing (task queue,
+        network, task dispatcher, parser) is collected into `trace:*`
+        histograms of `spider.stat`. See `grab.spider.tracer`.
+
+        :param path: Path to the file to save trace events of sampled tasks
+            in Chrome trace event format. The file is written when the
+            spider is stopped.
+        :param sample_rate: Probability of the task to be sampled.
+        :param max_tasks: Max. number of sampled tasks.
+        """
+        self.task_tracer = TaskTracer(
+            self, path=path, sample_rate=sample_rate, max_tasks=max_tasks
+        )
+
+    def setup_queue(self, backend="memory", batch_size=None, **kwargs):
         """
         Setup queue.
 
         :param backend: Backend name
             Should be one of the following: 'memory', 'redis' or 'mongo'.
+        :param batch_size: Number of tasks which network service gets from
+            the queue with one request. By default it is 1 for memory backend
+            and `thread_number` for other backends.
         :param kwargs: Additional credentials for backend.
         """
         if backend == "mongo":
@@ -270,12 +482,92 @@ class Spider(object):
             "grab.spider.queue_backend.%s_queue" % backend, globals(), locals(), ["foo"]
         )
         self.task_queue = mod.QueueBackend(spider_name=self.get_spider_name(), **kwargs)
+        if batch_size is None:
+            batch_size = 1 if backend == "memory" else self.thread_number
+        self.task_queue_batch_size = batch_size
+
+    def setup_host_scheduler(
+        self, max_host_connections=2, host_delay=0, lookahead=DEFAULT_LOOKAHEAD
+    ):
+        """
+        Setup per-host scheduling of network requests.
+
+        :param max_host_connections: Max. number of simultaneous network
+            requests to one host. Use None to disable the limit.
+        :param host_delay: Min. number of seconds between starts of
+            network requests to one host.
+        :param lookahead: Max. number of tasks which are read from the
+            task queue to find task of a host which is ready.
+        """
+        self.host_scheduler = HostScheduler(
+            self,
+            max_host_connections=max_host_connections,
+            host_delay=host_delay,
+            lookahead=lookahead,
+        )
+
+    def setup_url_filter(self, backend="set", **kwargs):
+        """
+        Setup filter of seen URLs.
+
+        Tasks which URLs have been already added to the task queue are
+        dropped by `add_task` method. Retried and cloned tasks, tasks with
+        `refresh_cache=True` and POST tasks are not filtered.
+
+        :param backend: Filter name
+            Should be one of the following: 'set', 'bloom' or 'bloom-file'.
+        :param kwargs: Additional options of filter e.g. `capacity`
+            and `error_rate` for Bloom filters, `path` for 'bloom-file'
+        """
+        if backend not in URL_FILTER_BACKENDS:
+            raise SpiderMisuseError("Unknown URL filter backend: %s" % backend)
+        self.url_filter = URL_FILTER_BACKENDS[backend](**kwargs)
+
+    def is_task_url_filtered(self, task):
+        """
+        Check the URL of the new task with URL filter.
+
+        Returns True if the task should be dropped.
+        """
+        if (
+            task.task_try_count > 1
+            or task.network_try_count > 0
+            or task.refresh_cache
+            or (
+                task.grab_config
+                and (task.grab_config["post"] or task.grab_config["multipart_post"])
+            )
+        ):
+            return False
+        if self.url_filter.add(task.url):
+            return False
+        self.stat.inc("spider:task-url-filtered")
+        return True
 
     def add_task(self, task, queue=None, raise_error=False):
         """
         Add task to the task queue.
         """
 
+        return self.add_tasks([task], queue=queue, raise_error=raise_error) == 1
+
+    def add_tasks(self, tasks, queue=None, raise_error=False):
+        """
+        Add multiple tasks to the task queue with one request
+        to the queue backend.
+
+        Returns number of added tasks. Tasks with invalid URLs and tasks
+        dropped by URL filter are not added.
+        """
+
+        if self.cache_scanner_service is not None:
+            # Reparse mode has no frontier, only cached responses
+            # are processed
+            self.stat.inc("spider:task-reparse-skipped", len(tasks))
+            return 0
+        # URL filter is applied only to new tasks, tasks which are moved
+        # from one queue to another are added with explicit queue
+        use_url_filter = queue is None and self.url_filter is not None
         if queue is None:
             if self.cache_reader_service:
                 queue = self.cache_reader_service.input_queue
@@ -286,31 +578,41 @@ class Spider(object):
                 "You should configure task queue before "
                 "adding tasks. Use `setup_queue` method."
             )
-        if task.priority is None or not task.priority_set_explicitly:
-            task.priority = self.generate_task_priority()
-            task.priority_set_explicitly = False
-        else:
-            task.priority_set_explicitly = True
-
-        if not task.url.startswith(
-            ("http://", "https://", "ftp://", "file://", "feed://")
-        ):
-            self.stat.collect("task-with-invalid-url", task.url)
-            msg = "Invalid task URL: %s" % task.url
-            if raise_error:
-                raise SpiderError(msg)
+        items = []
+        for task in tasks:
+            if task.priority is None or not task.priority_set_explicitly:
+                task.priority = self.generate_task_priority()
+                task.priority_set_explicitly = False
             else:
-                logger.error(
-                    "%s\nTraceback:\n%s",
-                    msg,
-                    "".join(format_stack()),
-                )
-                return False
-        else:
-            # TODO: keep original task priority if it was set explicitly
-            # WTF the previous comment means?
-            queue.put(task, priority=task.priority, schedule_time=task.schedule_time)
-            return True
+                task.priority_set_explicitly = True
+
+            if not task.url.startswith(
+                ("http://", "https://", "ftp://", "file://", "feed://")
+            ):
+                self.stat.collect("task-with-invalid-url", task.url)
+                msg = "Invalid task URL: %s" % task.url
+                if raise_error:
+                    raise SpiderError(msg)
+                else:
+                    logger.error(
+                        "%s\nTraceback:\n%s",
+                        msg,
+                        "".join(format_stack()),
+                    )
+            elif use_url_filter and self.is_task_url_filtered(task):
+                pass
+            else:
+                # TODO: keep original task priority if it was set explicitly
+                # WTF the previous comment means?
+                if self.task_tracer:
+                    self.task_tracer.start_trace(task)
+                items.append((task, task.priority, task.schedule_time))
+        if len(items) == 1:
+            task, priority, schedule_time = items[0]
+            queue.put(task, priority=priority, schedule_time=schedule_time)
+        elif items:
+            queue.put_many(items)
+        return len(items)
 
     def stop(self):
         """
@@ -421,6 +723,11 @@ class Spider(object):
             out.append("  %s: %d" % col_size)
         out.append("")
 
+        out.append("Histograms:")
+        for key, hist in sorted(self.stat.histograms.items()):
+            out.append("  %s: %s" % (key, hist.render()))
+        out.append("")
+
         # Process extra metrics
         if "download-size" in self.stat.counters:
             out.append(
@@ -454,6 +761,14 @@ class Spider(object):
         this method in your Spider class.
         """
 
+    def prepare_parser(self):
+        """
+        You can do additional spider customization here
+        before it starts processing responses in the parser process.
+        This method is called only in multiprocess mode, once in
+        each parser process.
+        """
+
     def shutdown(self):
         """
         You can override this method to do some final actions
@@ -532,14 +847,41 @@ class Spider(object):
                 self.add_task(Task("initial", url=url))
 
     def get_task_from_queue(self):
-        try:
-            return self.task_queue.get()
-        except Empty:
-            size = self.task_queue.size()
-            if size:
-                return True
-            else:
-                return None
+        if self.host_scheduler:
+            return self.host_scheduler.get_task()
+        if self.task_queue_batch_size > 1:
+            with self.task_buffer_lock:
+                if not self.task_buffer:
+                    self.task_buffer.extend(
+                        self.task_queue.get_many(self.task_queue_batch_size)
+                    )
+                if self.task_buffer:
+                    return self.task_buffer.popleft()
+        else:
+            try:
+                return self.task_queue.get()
+            except Empty:
+                pass
+        size = self.task_queue.size()
+        if size:
+            return True
+        else:
+            return None
+
+    def ack_task(self, task):
+        """
+        Notify task queue that the task has been completely processed.
+        """
+        if self.task_queue is not None:
+            self.task_queue.ack(task)
+
+    def release_task_host(self, task):
+        """
+        Notify host scheduler that the network request of the task
+        is completed or it will not be performed at all.
+        """
+        if self.host_scheduler:
+            self.host_scheduler.release(task)
 
     def setup_grab_for_task(self, task):
         grab = self.create_grab_instance()
@@ -563,14 +905,16 @@ class Spider(object):
         return code < 400 or code == 404 or code in task.valid_status
 
     def process_parser_error(self, func_name, task, exc_info):
-        _, ex, _ = exc_info
+        _, ex, ex_tb = exc_info
         self.stat.inc("spider:error-%s" % ex.__class__.__name__.lower())
 
-        logger.error(
-            "Task handler [%s] error\n%s",
-            func_name,
-            "".join(format_exception(*exc_info)),
-        )
+        if ex_tb is None and getattr(ex, "tb", None):
+            # Exception from parser process, the traceback object
+            # is not available, only its text representation
+            tb_text = ex.tb
+        else:
+            tb_text = "".join(format_exception(*exc_info))
+        logger.error("Task handler [%s] error\n%s", func_name, tb_text)
 
         # Looks strange but I really have some problems with
         # serializing exception into string
@@ -619,6 +963,13 @@ class Spider(object):
             else:
                 self.stat.inc("spider:download-size", doc.download_size)
                 self.stat.inc("spider:upload-size", doc.upload_size)
+                self.stat.observe("network:total-time", doc.total_time)
+                self.stat.observe("network:total-time-%s" % task.name, doc.total_time)
+                if getattr(res["grab"].transport, "measures_connect_time", False):
+                    self.stat.observe("network:connect-time", doc.connect_time)
+                    self.stat.observe(
+                        "network:name-lookup-time", doc.name_lookup_time
+                    )
 
     def process_grab_proxy(self, task, grab):
         """Assign new proxy from proxylist to the task"""
@@ -640,14 +991,27 @@ class Spider(object):
 
     # pylint: enable=unused-argument
 
+    def process_grab_cache_validators(self, task, grab):
+        """Add headers of conditional request to revalidate cached response"""
+
+        if task.get("cache_validators") and not task.refresh_cache:
+            headers = dict(grab.config["headers"] or {})
+            headers.update(task.cache_validators)
+            grab.config["headers"] = headers
+
     def submit_task_to_transport(self, task, grab):
         if self.only_cache:
             self.stat.inc("spider:request-network-disabled-only-cache")
+            self.release_task_host(task)
+            self.ack_task(task)
         else:
             grab_config_backup = grab.dump_config()
             self.process_grab_proxy(task, grab)
+            self.process_grab_cache_validators(task, grab)
             self.stat.inc("spider:request-network")
             self.stat.inc("spider:task-%s-network" % task.name)
+            if self.task_tracer:
+                self.task_tracer.add_event(task, "network-start")
             try:
                 self.network_service.start_task_processing(
                     task, grab, grab_config_backup
@@ -657,6 +1021,8 @@ class Spider(object):
                 # TODO: show traceback
                 logger.debug("Task %s has invalid URL: %s", task.name, task.url)
                 self.stat.collect("invalid-url", task.url)
+                self.release_task_host(task)
+                self.ack_task(task)
 
     def run(self):
         self._started = time.time()
@@ -666,20 +1032,27 @@ class Spider(object):
             if self.task_queue is None:
                 self.setup_queue()
             self.process_initial_urls()
+            # Parser service goes first because in multiprocess mode
+            # it forks the parser fork server and that must be done
+            # before any other thread is started
             services = [
+                self.parser_service,
                 self.task_dispatcher,
                 self.task_generator_service,
-                self.parser_service,
                 self.network_service,
             ]
-            if self.http_api_service:
-                self.http_api_service.start()
             if self.cache_reader_service:
-                services.insert(0, self.cache_reader_service)
+                services.insert(1, self.cache_reader_service)
             if self.cache_writer_service:
-                services.insert(0, self.cache_writer_service)
+                services.insert(1, self.cache_writer_service)
+            if self.cache_scanner_service:
+                services.insert(1, self.cache_scanner_service)
             for srv in services:
                 srv.start()
+            if self.http_api_service:
+                self.http_api_service.start()
+            # Ticker thread is started after parser processes are forked
+            self.stat.start()
             while self.work_allowed:
                 try:
                     exc_info = self.fatal_error_queue.get(True, 0.5)
@@ -689,6 +1062,7 @@ class Spider(object):
                     # The trackeback of fatal error MUST BE
                     # rendered by the sender
                     raise exc_info[1]
+                self.task_queue.renew_leases()
                 if self.is_idle():
                     for srv in services:
                         srv.pause()
@@ -702,10 +1076,6 @@ class Spider(object):
         except Exception:
             raise
         finally:
-            # TODO:
-            if self.task_queue:
-                self.task_queue.clear()
-                self.task_queue.close()
             # print('Start stopping services')
             for srv in services:
                 # Resume service if it has been paused
@@ -721,6 +1091,26 @@ class Spider(object):
             for srv in services:
                 if srv.is_alive():
                     print("The %s has not stopped :(" % srv)
+            if self.http_api_service:
+                self.http_api_service.stop()
+            # Queue is closed after services are stopped because
+            # they could still use it
+            if self.task_queue:
+                # Reliable queue could be shared by multiple spider
+                # processes, its tasks and leases must survive the shutdown
+                if not getattr(self.task_queue, "reliable", False):
+                    self.task_queue.clear()
+                self.task_queue.close()
+            if self.host_scheduler:
+                self.host_scheduler.clear()
+            self.task_buffer.clear()
+            if self.url_filter:
+                self.url_filter.close()
+            if self.warc_writer:
+                self.warc_writer.close()
+            if self.task_tracer:
+                self.task_tracer.save()
+            self.stat.stop()
             self.stat.print_progress_line()
             self.shutdown()
             # if self.task_queue:
@@ -731,6 +1121,8 @@ class Spider(object):
         result = (
             not self.task_generator_service.is_alive()
             and not self.task_queue.size()
+            and not (self.host_scheduler and self.host_scheduler.size())
+            and not self.task_buffer
             and not self.task_dispatcher.input_queue.qsize()
             and not self.parser_service.input_queue.qsize()
             and not self.parser_service.is_busy()
@@ -740,8 +1132,11 @@ class Spider(object):
         if result and self.cache_reader_service:
             result = result and (
                 not self.cache_reader_service.input_queue.size()
+                and not self.cache_reader_service.is_busy()
                 and not self.cache_writer_service.input_queue.qsize()
             )
+        if result and self.cache_scanner_service:
+            result = not self.cache_scanner_service.is_alive()
         return result
 
     def log_failed_network_result(self, res):
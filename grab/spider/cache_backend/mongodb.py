@@ -2,11 +2,16 @@
 CacheItem interface:
 '_id': string,
 'url': string,
+'task_name': string, name of the task which has received the response
 'response_url': string,
-'body': string,
+'body': string, compressed body
+'codec': string, name of the codec which is used to compress the body
+'body_size': int, size of uncompressed body
+'charset': string,
 'head': string,
 'response_code': int,
 'cookies': None,#grab.doc.cookies,
+'timestamp': int, time when the item was saved
 
 TODO: WTF with cookies???
 """
@@ -16,27 +21,47 @@ import zlib
 from hashlib import sha1
 
 import pymongo
-import six
 from bson import Binary
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DocumentTooLarge
 
 from grab.cookie import CookieManager
 from grab.document import Document
+from grab.util.codec import build_codec
 from grab.util.encoding import make_str
 
 # pylint: disable=invalid-name
 logger = logging.getLogger("grab.spider.cache_backend.mongodb")
 # pylint: enable=invalid-name
+DUPLICATE_KEY_ERROR = 11000
+GC_BATCH_SIZE = 1000
 
 
 class CacheBackend(object):
-    def __init__(self, database, use_compression=False, spider=None, **kwargs):
+    def __init__(
+        self,
+        database,
+        use_compression=False,
+        codec=None,
+        deduplicate=False,
+        spider=None,
+        **kwargs
+    ):
         self.colname = "cache"
+        self.body_colname = "cache_body"
         self.dbname = database
         self.spider = spider
         self.init_kwargs = kwargs
         self.connect()
         self.connection, self.db, self.collection = self.connect()
         self.use_compression = use_compression
+        if codec is None:
+            codec = "zlib" if use_compression else "none"
+        self.codec = build_codec(codec)
+        self.deduplicate = deduplicate
+        self.collection.create_index("timestamp")
+        if self.deduplicate:
+            self.collection.create_index("body_hash", sparse=True)
 
     def connect(self):
         connection = pymongo.MongoClient(**self.init_kwargs)
@@ -47,6 +72,10 @@ class CacheBackend(object):
     def reconnect(self):
         self.connection, self.db, self.collection = self.connect()
 
+    @property
+    def body_collection(self):
+        return self.db[self.body_colname]
+
     def close(self):
         self.connection.close()
 
@@ -57,85 +86,257 @@ class CacheBackend(object):
 
         _hash = self.build_hash(url)
         query = {"_id": _hash}
-        return self.collection.find_one(query)
+        item = self.collection.find_one(query)
+        if item is not None and not self.load_item_bodies([item]):
+            return item
+        return None
+
+    def get_items(self, urls):
+        """
+        Find multiple items with one request to the database.
+
+        Returns dict which maps URL to the item, URLs which are not found
+        in the cache are not included in the dict.
+        """
+        hashes = {}
+        for url in urls:
+            hashes[self.build_hash(url)] = url
+        if not hashes:
+            return {}
+        query = {"_id": {"$in": list(hashes)}}
+        result = {hashes[x["_id"]]: x for x in self.collection.find(query)}
+        orphans = set(id(x) for x in self.load_item_bodies(list(result.values())))
+        return dict((x, y) for x, y in result.items() if id(y) not in orphans)
+
+    def iterate_items(self, batch_size=100):
+        """
+        Iterate over all items of the cache.
+
+        Items are read in batches of `batch_size` items ordered by the
+        key, so no cursor is kept open between batches.
+        """
+        query = {}
+        while True:
+            items = list(
+                self.collection.find(query)
+                .sort("_id", pymongo.ASCENDING)
+                .limit(batch_size)
+            )
+            if not items:
+                break
+            orphans = set(id(x) for x in self.load_item_bodies(items))
+            for item in items:
+                if id(item) not in orphans:
+                    yield item
+            query = {"_id": {"$gt": items[-1]["_id"]}}
+
+    def load_item_bodies(self, items):
+        """
+        Load bodies of items which have been saved in deduplication mode.
+
+        Items which bodies are not found are removed from the cache,
+        returns list of such items.
+        """
+        items = [x for x in items if x.get("body_hash")]
+        if not items:
+            return []
+        query = {"_id": {"$in": list(set(x["body_hash"] for x in items))}}
+        bodies = {x["_id"]: x for x in self.body_collection.find(query)}
+        orphans = []
+        for item in items:
+            body = bodies.get(item["body_hash"])
+            if body is None:
+                orphans.append(item)
+            else:
+                item["body"] = body["data"]
+                item["codec"] = body["codec"]
+        if orphans:
+            self.remove_orphan_items(orphans)
+        return orphans
+
+    def remove_orphan_items(self, items):
+        logger.warning("Removing %d cache items without bodies", len(items))
+        # Item could be saved again with other body in the meantime
+        self.collection.bulk_write(
+            [
+                DeleteOne({"_id": x["_id"], "body_hash": x["body_hash"]})
+                for x in items
+            ],
+            ordered=False,
+        )
 
     def build_hash(self, url):
         utf_url = make_str(url)
         return sha1(utf_url).hexdigest()
 
+    def build_body_hash(self, body):
+        return sha1(body).hexdigest()
+
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
         self.collection.delete_one({"_id": _hash})
 
+    def remove_oldest_items(self, count, timestamp=None):
+        """
+        Remove up to `count` items which have been saved earlier than
+        other items. If `timestamp` is set then only items saved not
+        later than `timestamp` are removed.
+
+        Returns number of removed items.
+        """
+        query = {} if timestamp is None else {"timestamp": {"$lte": timestamp}}
+        ids = [
+            x["_id"]
+            for x in self.collection.find(query, {"_id": 1})
+            .sort("timestamp", pymongo.ASCENDING)
+            .limit(count)
+        ]
+        if not ids:
+            return 0
+        return self.collection.delete_many({"_id": {"$in": ids}}).deleted_count
+
     def load_response(self, grab, cache_item):
-        grab.setup_document(cache_item["body"])
+        grab.setup_document(b"")
 
-        body = cache_item["body"]
-        # Till the 0.6.39 version there was no compressed flag
-        # so it was possible to detected the compressed item
-        # only by analyzing the byte stream
-        try:
-            is_compressed = cache_item["is_compressed"]
-        except KeyError:
-            is_compressed = body[0] == 120
-        if is_compressed:
-            body = zlib.decompress(body)
+        body = bytes(cache_item["body"])
+        codec_name = cache_item.get("codec")
+        if codec_name is None:
+            # Till the 0.6.39 version there was no compressed flag
+            # so it was possible to detected the compressed item
+            # only by analyzing the byte stream
+            try:
+                is_compressed = cache_item["is_compressed"]
+            except KeyError:
+                is_compressed = body[:1] == b"x"
+            if is_compressed:
+                body = zlib.decompress(body)
 
         def custom_prepare_response_func(transport, grab):
             doc = Document()
             doc.head = cache_item["head"]
-            doc.body = body
+            if codec_name is None:
+                doc.body = body
+            else:
+                doc.set_compressed_body(codec_name, body)
             doc.code = cache_item["response_code"]
-            doc.download_size = len(body)
+            doc.download_size = cache_item.get("body_size", len(body))
             doc.upload_size = 0
             doc.download_speed = 0
             doc.url = cache_item["response_url"]
-            doc.parse(charset=grab.config["document_charset"])
+            # Known charset allows to not decompress the body
+            doc.parse(
+                charset=grab.config["document_charset"] or cache_item.get("charset")
+            )
             doc.cookies = CookieManager(transport.extract_cookiejar())
             doc.from_cache = True
             return doc
 
         grab.process_request_result(custom_prepare_response_func)
 
-    def save_response(self, url, grab):
+    def build_cache_item(self, url, grab, task_name=None):
         body = grab.doc.body
-        if self.use_compression:
-            body = zlib.compress(body)
-
         _hash = self.build_hash(url)
-        item = {
+        return {
             "_id": _hash,
             "timestamp": int(time.time()),
             "url": url,
+            "task_name": task_name,
             "response_url": grab.doc.url,
-            "body": Binary(body),
+            "body": Binary(self.codec.compress(body)),
+            "codec": self.codec.name,
+            "body_size": len(body),
+            "charset": grab.doc.charset,
             "head": Binary(grab.doc.head),
             "response_code": grab.doc.code,
             "cookies": None,
-            "is_compressed": self.use_compression,
         }
-        # print('Before saving')
+
+    def save_response(self, url, grab, task_name=None):
+        self.save_responses([(url, grab, task_name)])
+
+    def save_responses(self, items):
+        """
+        Save multiple responses with one bulk request.
+
+        Args:
+            items: list of (url, grab, task_name) tuples
+        """
+        docs = []
+        # body hash -> body document
+        bodies = {}
+        for url, grab, task_name in items:
+            doc = self.build_cache_item(url, grab, task_name)
+            if self.deduplicate:
+                body_hash = self.build_body_hash(grab.doc.body)
+                bodies[body_hash] = {
+                    "_id": body_hash,
+                    "data": doc.pop("body"),
+                    "codec": doc.pop("codec"),
+                }
+                doc["body_hash"] = body_hash
+            docs.append(doc)
         try:
-            self.collection.insert_one(item)
-        except Exception as ex:  # pylint: disable=broad-except
-            # from traceback import format_exc
-            # print('FATA ERROR WHILE SAVING CACHE ITEM')
-            # print(format_exc())
-            if "document too large" in six.text_type(ex):
+            if bodies:
+                self.save_bodies(bodies)
+            self.collection.bulk_write(
+                [ReplaceOne({"_id": x["_id"]}, x, upsert=True) for x in docs],
+                ordered=False,
+            )
+        except DocumentTooLarge:
+            if len(docs) == 1:
                 logging.error(
                     "Document too large. It was not saved into"
                     " mongodb cache. Url: %s",
-                    url,
+                    docs[0]["url"],
                 )
             else:
-                raise
-        # else:
-        #    print('COUNT: %d' % self.collection.count({'_id': item['_id']}))
-        # finally:
-        #    print('After saving')
+                # Find the large document and save other documents
+                for item in items:
+                    self.save_responses([item])
+
+    def save_bodies(self, bodies):
+        query = {"_id": {"$in": list(bodies)}}
+        for body in self.body_collection.find(query, {"_id": 1}):
+            # Body is already stored, do not write it again
+            del bodies[body["_id"]]
+        if bodies:
+            try:
+                self.body_collection.insert_many(list(bodies.values()), ordered=False)
+            except BulkWriteError as ex:
+                # Same body could be inserted by other process
+                if any(
+                    x["code"] != DUPLICATE_KEY_ERROR
+                    for x in ex.details["writeErrors"]
+                ):
+                    raise
+
+    def remove_unused_bodies(self):
+        """
+        Remove bodies which are not used by any item.
+
+        Returns number of removed bodies.
+
+        MongoDB does not lock the items between the check and removal
+        of the body, so the body saved by concurrent `save_responses`
+        call could be removed. Such items are treated as missing
+        and removed by `load_item_bodies`.
+        """
+        count = 0
+        body_hashes = [x["_id"] for x in self.body_collection.find({}, {"_id": 1})]
+        for pos in range(0, len(body_hashes), GC_BATCH_SIZE):
+            chunk = body_hashes[pos : pos + GC_BATCH_SIZE]
+            used = set(
+                self.collection.distinct("body_hash", {"body_hash": {"$in": chunk}})
+            )
+            unused = [x for x in chunk if x not in used]
+            if unused:
+                result = self.body_collection.delete_many({"_id": {"$in": unused}})
+                count += result.deleted_count
+        return count
 
     def clear(self):
         self.collection.delete_many({})
+        self.body_collection.delete_many({})
 
     def size(self):
         return self.collection.count_documents({})
@@ -4,11 +4,16 @@
 CacheItem interface:
 '_id': string,
 'url': string,
+'task_name': string, name of the task which has received the response
 'response_url': string,
-'body': string,
+'body': string, compressed body
+'codec': string, name of the codec which is used to compress the body
+'body_size': int, size of uncompressed body
+'charset': string,
 'head': string,
 'response_code': int,
 'cookies': None,#grab.doc.cookies,
+'timestamp': int, time when the item was saved
 
 TODO: WTF with cookies???
 """
@@ -22,6 +27,7 @@ import MySQLdb
 
 from grab.cookie import CookieManager
 from grab.document import Document
+from grab.util.codec import build_codec
 from grab.util.encoding import make_str
 
 # pylint: disable=invalid-name
@@ -34,7 +40,9 @@ class CacheBackend(object):
         self,
         database,
         use_compression=True,
+        codec=None,
         mysql_engine="innodb",
+        deduplicate=False,
         spider=None,
         **kwargs
     ):
@@ -42,10 +50,13 @@ class CacheBackend(object):
         self.database = database
         self.connection_config = kwargs
         self.mysql_engine = mysql_engine
+        self.deduplicate = deduplicate
         self.connect()
         self.check_tables()
-        # FIXME: why `use_compression` is not used?
         self.use_compression = use_compression
+        if codec is None:
+            codec = "zlib" if use_compression else "none"
+        self.codec = build_codec(codec)
 
     def check_tables(self):
         self.execute("show tables")
@@ -56,6 +67,7 @@ class CacheBackend(object):
                 break
         if not found:
             self.create_cache_table(self.mysql_engine)
+        self.check_body_table(self.mysql_engine)
 
     def connect(self):
         self.connection = MySQLdb.connect(**self.connection_config)
@@ -87,14 +99,39 @@ class CacheBackend(object):
                 id binary(20) not null,
                 timestamp int not null,
                 data mediumblob not null,
+                body_hash binary(20) null,
                 primary key (id),
-                index timestamp_idx(timestamp)
+                index timestamp_idx(timestamp),
+                index body_hash_idx(body_hash)
             ) engine = %s
         """
             % engine
         )
         self.execute("commit")
 
+    def check_body_table(self, engine):
+        self.execute("SHOW COLUMNS FROM cache LIKE 'body_hash'")
+        if not self.cursor.fetchall():
+            # The table has been created by old version of grab
+            self.execute(
+                """
+                ALTER TABLE cache
+                ADD COLUMN body_hash binary(20) null,
+                ADD INDEX body_hash_idx(body_hash)
+            """
+            )
+        self.execute(
+            """
+            create table if not exists cache_body (
+                id binary(20) not null,
+                codec varchar(16) not null,
+                data longblob not null,
+                primary key (id)
+            ) engine = %s
+        """
+            % engine
+        )
+
     def get_item(self, url):
         """
         Returned item should have specific interface. See module docstring.
@@ -103,7 +140,7 @@ class CacheBackend(object):
         _hash = self.build_hash(url)
         self.execute("BEGIN")
         sql = """
-              SELECT data
+              SELECT timestamp, data
               FROM cache
               WHERE id = x%s
         """
@@ -111,19 +148,130 @@ class CacheBackend(object):
         row = self.cursor.fetchone()
         self.execute("COMMIT")
         if row:
-            data = row[0]
-            return self.unpack_database_value(data)
-        else:
-            return None
+            item = self.unpack_database_value(row[1])
+            item["timestamp"] = row[0]
+            if not self.load_item_bodies([item]):
+                return item
+        return None
 
     def unpack_database_value(self, val):
-        dump = zlib.decompress(val)
+        dump = bytes(val)
+        if dump[:1] == b"x":
+            # Items saved by old versions of grab are compressed entirely
+            dump = zlib.decompress(dump)
         return marshal.loads(dump)
 
+    def get_items(self, urls):
+        """
+        Find multiple items with one request to the database.
+
+        Returns dict which maps URL to the item, URLs which are not found
+        in the cache are not included in the dict.
+        """
+        hashes = {}
+        for url in urls:
+            hashes[self.build_hash(url)] = url
+        if not hashes:
+            return {}
+        self.execute("BEGIN")
+        sql = """
+              SELECT LOWER(HEX(id)), timestamp, data
+              FROM cache
+              WHERE id IN (%s)
+        """ % ", ".join(["x%s"] * len(hashes))
+        self.execute(sql, list(hashes))
+        rows = self.cursor.fetchall()
+        self.execute("COMMIT")
+        result = {}
+        for _hash, timestamp, data in rows:
+            item = self.unpack_database_value(data)
+            item["timestamp"] = timestamp
+            result[hashes[_hash]] = item
+        orphans = set(id(x) for x in self.load_item_bodies(list(result.values())))
+        return dict((x, y) for x, y in result.items() if id(y) not in orphans)
+
+    def iterate_items(self, batch_size=100):
+        """
+        Iterate over all items of the cache.
+
+        Items are read in batches of `batch_size` items ordered by the
+        key, so no transaction is kept open between batches.
+        """
+        last_hash = ""
+        while True:
+            self.execute("BEGIN")
+            self.execute(
+                """
+                SELECT LOWER(HEX(id)), timestamp, data
+                FROM cache
+                WHERE id > x%s
+                ORDER BY id
+                LIMIT %s
+            """,
+                (last_hash, batch_size),
+            )
+            rows = self.cursor.fetchall()
+            self.execute("COMMIT")
+            if not rows:
+                break
+            items = []
+            for _, timestamp, data in rows:
+                item = self.unpack_database_value(data)
+                item["timestamp"] = timestamp
+                items.append(item)
+            orphans = set(id(x) for x in self.load_item_bodies(items))
+            for item in items:
+                if id(item) not in orphans:
+                    yield item
+            last_hash = rows[-1][0]
+
+    def load_item_bodies(self, items):
+        """
+        Load bodies of items which have been saved in deduplication mode.
+
+        Items which bodies are not found are removed from the cache,
+        returns list of such items.
+        """
+        items = [x for x in items if x.get("body_hash")]
+        if not items:
+            return []
+        keys = list(set(x["body_hash"] for x in items))
+        self.execute("BEGIN")
+        sql = """
+              SELECT LOWER(HEX(id)), codec, data
+              FROM cache_body
+              WHERE id IN (%s)
+        """ % ", ".join(["x%s"] * len(keys))
+        self.execute(sql, keys)
+        bodies = {x[0]: (x[1], x[2]) for x in self.cursor.fetchall()}
+        self.execute("COMMIT")
+        orphans = []
+        for item in items:
+            if item["body_hash"] in bodies:
+                item["codec"], item["body"] = bodies[item["body_hash"]]
+            else:
+                orphans.append(item)
+        if orphans:
+            self.remove_orphan_items(orphans)
+        return orphans
+
+    def remove_orphan_items(self, items):
+        logger.warning("Removing %d cache items without bodies", len(items))
+        self.execute("BEGIN")
+        # Item could be saved again with other body in the meantime
+        self.cursor.executemany(
+            "DELETE FROM cache WHERE id = x%s AND body_hash = UNHEX(%s)",
+            [(self.build_hash(x["url"]), x["body_hash"]) for x in items],
+        )
+        self.execute("COMMIT")
+
     def build_hash(self, url):
         utf_url = make_str(url)
         return sha1(utf_url).hexdigest()
 
+    def build_body_hash(self, body):
+        return sha1(body).hexdigest()
+
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
         self.execute("begin")
@@ -135,60 +283,191 @@ class CacheBackend(object):
         )
         self.execute("commit")
 
+    def remove_oldest_items(self, count, timestamp=None):
+        """
+        Remove up to `count` items which have been saved earlier than
+        other items. If `timestamp` is set then only items saved not
+        later than `timestamp` are removed.
+
+        Returns number of removed items.
+        """
+        if timestamp is None:
+            where, args = "", (count,)
+        else:
+            where, args = "WHERE timestamp <= %s", (timestamp, count)
+        self.execute("BEGIN")
+        self.execute(
+            """
+            DELETE FROM cache %s
+            ORDER BY timestamp
+            LIMIT %%s
+        """
+            % where,
+            args,
+        )
+        count = self.cursor.rowcount
+        self.execute("COMMIT")
+        return count
+
     def load_response(self, grab, cache_item):
-        grab.setup_document(cache_item["body"])
+        grab.setup_document(b"")
 
         body = cache_item["body"]
+        codec_name = cache_item.get("codec")
 
         def custom_prepare_response_func(transport, grab):
             doc = Document()
             doc.head = cache_item["head"]
-            doc.body = body
+            if codec_name is None:
+                doc.body = body
+            else:
+                doc.set_compressed_body(codec_name, body)
             doc.code = cache_item["response_code"]
-            doc.download_size = len(body)
+            doc.download_size = cache_item.get("body_size", len(body))
             doc.upload_size = 0
             doc.download_speed = 0
             doc.url = cache_item["response_url"]
-            doc.parse(charset=grab.config["document_charset"])
+            # Known charset allows to not decompress the body
+            doc.parse(
+                charset=grab.config["document_charset"] or cache_item.get("charset")
+            )
             doc.cookies = CookieManager(transport.extract_cookiejar())
             doc.from_cache = True
             return doc
 
         grab.process_request_result(custom_prepare_response_func)
 
-    def save_response(self, url, grab):
-        body = grab.doc.body
-
-        item = {
+    def build_cache_item(self, url, grab, task_name=None):
+        return {
             "url": url,
+            "task_name": task_name,
             "response_url": grab.doc.url,
-            "body": body,
+            "body": grab.doc.body,
+            "charset": grab.doc.charset,
             "head": grab.doc.head,
             "response_code": grab.doc.code,
             "cookies": None,
         }
-        self.set_item(url, item)
+
+    def save_response(self, url, grab, task_name=None):
+        self.save_responses([(url, grab, task_name)])
+
+    def save_responses(self, items):
+        """
+        Save multiple responses in one transaction.
+
+        Args:
+            items: list of (url, grab, task_name) tuples
+        """
+        self.set_items(
+            [
+                (url, self.build_cache_item(url, grab, task_name))
+                for url, grab, task_name in items
+            ]
+        )
 
     def set_item(self, url, item):
-        _hash = self.build_hash(url)
-        data = self.pack_database_value(item)
-        self.execute("BEGIN")
+        self.set_items([(url, item)])
+
+    def set_items(self, items):
         moment = int(time.time())
+        rows = []
+        # body hash -> body
+        bodies = {}
+        for url, item in items:
+            item = dict(item)
+            body = item.pop("body")
+            body_hash = None
+            item["body_size"] = len(body)
+            if self.deduplicate:
+                body_hash = self.build_body_hash(body)
+                item["body_hash"] = body_hash
+                if body_hash not in bodies:
+                    bodies[body_hash] = body
+            else:
+                item["codec"] = self.codec.name
+                item["body"] = self.codec.compress(body)
+            rows.append(
+                (self.build_hash(url), moment, self.pack_database_value(item), body_hash)
+            )
+        self.execute("BEGIN")
+        try:
+            sql = """
+                  INSERT INTO cache (id, timestamp, data, body_hash)
+                  VALUES (x%s, %s, %s, UNHEX(%s))
+                  ON DUPLICATE KEY UPDATE
+                    timestamp = VALUES(timestamp), data = VALUES(data),
+                    body_hash = VALUES(body_hash)
+                  """
+            self.cursor.executemany(sql, rows)
+            # Bodies are checked after items are inserted, see
+            # `remove_unused_bodies`
+            if bodies:
+                self.save_bodies(bodies)
+        except Exception:
+            self.execute("ROLLBACK")
+            raise
+        self.execute("COMMIT")
+
+    def save_bodies(self, bodies):
         sql = """
-              INSERT INTO cache (id, timestamp, data)
-              VALUES(x%s, %s, %s)
-              ON DUPLICATE KEY UPDATE timestamp = %s, data = %s
-              """
-        self.execute(sql, (_hash, moment, data, moment, data))
+              SELECT LOWER(HEX(id))
+              FROM cache_body
+              WHERE id IN (%s)
+              LOCK IN SHARE MODE
+        """ % ", ".join(["x%s"] * len(bodies))
+        # Found bodies are locked until the end of the transaction,
+        # so they could not be removed as unused ones
+        self.execute(sql, list(bodies))
+        for row in self.cursor.fetchall():
+            # Body is already stored, do not write it again
+            del bodies[row[0]]
+        if bodies:
+            self.cursor.executemany(
+                """
+                INSERT IGNORE INTO cache_body (id, codec, data)
+                VALUES (x%s, %s, %s)
+                """,
+                [
+                    (x, self.codec.name, self.codec.compress(y))
+                    for x, y in bodies.items()
+                ],
+            )
+
+    def remove_unused_bodies(self):
+        """
+        Remove bodies which are not used by any item.
+
+        Returns number of removed bodies.
+        """
+        # Rows of the cache table are read with shared locks in
+        # serializable transaction, so items which refer to the bodies
+        # being removed could not be inserted until the transaction
+        # is committed
+        self.execute("SET TRANSACTION ISOLATION LEVEL SERIALIZABLE")
+        self.execute("BEGIN")
+        try:
+            self.execute(
+                """
+                DELETE cache_body FROM cache_body
+                LEFT JOIN cache ON cache.body_hash = cache_body.id
+                WHERE cache.id IS NULL
+            """
+            )
+            count = self.cursor.rowcount
+        except Exception:
+            self.execute("ROLLBACK")
+            raise
         self.execute("COMMIT")
+        return count
 
     def pack_database_value(self, val):
-        dump = marshal.dumps(val)
-        return zlib.compress(dump)
+        return marshal.dumps(val)
 
     def clear(self):
         self.execute("BEGIN")
         self.execute("TRUNCATE cache")
+        self.execute("TRUNCATE cache_body")
         self.execute("COMMIT")
 
     def has_item(self, url):
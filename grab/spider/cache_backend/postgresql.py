@@ -4,12 +4,18 @@
 CacheItem interface:
 '_id': string,
 'url': string,
+'task_name': string, name of the task which has received the response
 'response_url': string,
-'body': string,
+'body': string, compressed body
+'codec': string, name of the codec which is used to compress the body
+'body_size': int, size of uncompressed body
+'charset': string,
 'head': string,
 'response_code': int,
 'cookies': None,#grab.doc.cookies,
+'timestamp': int, time when the item was saved
 """
+from contextlib import contextmanager
 import logging
 import marshal
 import time
@@ -18,9 +24,11 @@ from hashlib import sha1
 
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED
+from psycopg2.extras import execute_values
 
 from grab.cookie import CookieManager
 from grab.document import Document
+from grab.util.codec import build_codec
 from grab.util.encoding import make_str
 
 # pylint: disable=invalid-name
@@ -29,10 +37,19 @@ logger = logging.getLogger("grab.spider.cache_backend.postgresql")
 
 
 class CacheBackend(object):
-    def __init__(self, database, use_compression=True, spider=None, **kwargs):
+    def __init__(
+        self,
+        database,
+        use_compression=True,
+        codec=None,
+        deduplicate=False,
+        spider=None,
+        **kwargs
+    ):
         self.connection_config = kwargs
         self.database = database
         self.spider = spider
+        self.deduplicate = deduplicate
         self.connect()
         self.cursor.execute(
             """
@@ -52,9 +69,12 @@ class CacheBackend(object):
                 break
         if not found:
             self.create_cache_table()
+        self.check_body_table()
 
-        # FIXME: why `use_compression` is not used?
         self.use_compression = use_compression
+        if codec is None:
+            codec = "zlib" if use_compression else "none"
+        self.codec = build_codec(codec)
 
     def close(self):
         self.cursor.close()
@@ -70,19 +90,49 @@ class CacheBackend(object):
     def reconnect(self):
         self.connect()
 
-    def create_cache_table(self):
+    @contextmanager
+    def transaction(self):
+        """
+        Run statements of the block in one transaction, the transaction
+        is rolled back if the block fails.
+        """
         self.cursor.execute("BEGIN")
-        self.cursor.execute(
+        try:
+            yield
+        except Exception:
+            self.connection.rollback()
+            raise
+        else:
+            self.cursor.execute("COMMIT")
+
+    def create_cache_table(self):
+        with self.transaction():
+            self.cursor.execute(
+                """
+                CREATE TABLE cache (
+                    id BYTEA NOT NULL CONSTRAINT primary_key PRIMARY KEY,
+                    timestamp INT NOT NULL,
+                    data BYTEA NOT NULL,
+                    body_hash BYTEA
+                );
+                CREATE INDEX timestamp_idx ON cache (timestamp);
             """
-            CREATE TABLE cache (
-                id BYTEA NOT NULL CONSTRAINT primary_key PRIMARY KEY,
-                timestamp INT NOT NULL,
-                data BYTEA NOT NULL
-            );
-            CREATE INDEX timestamp_idx ON cache (timestamp);
-        """
-        )
-        self.cursor.execute("COMMIT")
+            )
+
+    def check_body_table(self):
+        with self.transaction():
+            # The cache table could be created by old version of grab
+            self.cursor.execute(
+                """
+                ALTER TABLE cache ADD COLUMN IF NOT EXISTS body_hash BYTEA;
+                CREATE INDEX IF NOT EXISTS body_hash_idx ON cache (body_hash);
+                CREATE TABLE IF NOT EXISTS cache_body (
+                    id BYTEA NOT NULL PRIMARY KEY,
+                    codec VARCHAR(16) NOT NULL,
+                    data BYTEA NOT NULL
+                );
+            """
+            )
 
     def get_item(self, url):
         """
@@ -90,107 +140,331 @@ class CacheBackend(object):
         """
 
         _hash = self.build_hash(url)
-        self.cursor.execute("BEGIN")
-        sql = """
-              SELECT data
-              FROM cache
-              WHERE id = %s
-          """
-        self.cursor.execute(sql, (_hash,))
-        row = self.cursor.fetchone()
-        self.cursor.execute("COMMIT")
+        with self.transaction():
+            sql = """
+                  SELECT timestamp, data
+                  FROM cache
+                  WHERE id = %s
+              """
+            self.cursor.execute(sql, (_hash,))
+            row = self.cursor.fetchone()
         if row:
-            data = row[0]
-            return self.unpack_database_value(data)
-        else:
-            return None
+            item = self.unpack_database_value(row[1])
+            item["timestamp"] = row[0]
+            if not self.load_item_bodies([item]):
+                return item
+        return None
 
     def unpack_database_value(self, val):
-        dump = zlib.decompress(val)
+        dump = bytes(val)
+        if dump[:1] == b"x":
+            # Items saved by old versions of grab are compressed entirely
+            dump = zlib.decompress(dump)
         return marshal.loads(dump)
 
+    def get_items(self, urls):
+        """
+        Find multiple items with one request to the database.
+
+        Returns dict which maps URL to the item, URLs which are not found
+        in the cache are not included in the dict.
+        """
+        hashes = {}
+        for url in urls:
+            hashes[self.build_hash(url)] = url
+        if not hashes:
+            return {}
+        with self.transaction():
+            sql = """
+                  SELECT id, timestamp, data
+                  FROM cache
+                  WHERE id IN %s
+              """
+            self.cursor.execute(sql, (tuple(hashes),))
+            rows = self.cursor.fetchall()
+        result = {}
+        for _hash, timestamp, data in rows:
+            if not isinstance(_hash, str):
+                _hash = bytes(_hash).decode("ascii")
+            item = self.unpack_database_value(data)
+            item["timestamp"] = timestamp
+            result[hashes[_hash]] = item
+        orphans = set(id(x) for x in self.load_item_bodies(list(result.values())))
+        return dict((x, y) for x, y in result.items() if id(y) not in orphans)
+
+    def iterate_items(self, batch_size=100):
+        """
+        Iterate over all items of the cache.
+
+        Items are read in batches of `batch_size` items ordered by the
+        key, so no transaction is kept open between batches.
+        """
+        last_hash = ""
+        while True:
+            with self.transaction():
+                self.cursor.execute(
+                    """
+                    SELECT id, timestamp, data
+                    FROM cache
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                """,
+                    (last_hash, batch_size),
+                )
+                rows = self.cursor.fetchall()
+            if not rows:
+                break
+            items = []
+            for _, timestamp, data in rows:
+                item = self.unpack_database_value(data)
+                item["timestamp"] = timestamp
+                items.append(item)
+            orphans = set(id(x) for x in self.load_item_bodies(items))
+            for item in items:
+                if id(item) not in orphans:
+                    yield item
+            last_hash = rows[-1][0]
+            if not isinstance(last_hash, str):
+                last_hash = bytes(last_hash).decode("ascii")
+
+    def load_item_bodies(self, items):
+        """
+        Load bodies of items which have been saved in deduplication mode.
+
+        Items which bodies are not found are removed from the cache,
+        returns list of such items.
+        """
+        items = [x for x in items if x.get("body_hash")]
+        if not items:
+            return []
+        keys = tuple(set(x["body_hash"] for x in items))
+        with self.transaction():
+            sql = """
+                  SELECT id, codec, data
+                  FROM cache_body
+                  WHERE id IN %s
+              """
+            self.cursor.execute(sql, (keys,))
+            rows = self.cursor.fetchall()
+        bodies = {}
+        for body_hash, codec_name, data in rows:
+            if not isinstance(body_hash, str):
+                body_hash = bytes(body_hash).decode("ascii")
+            bodies[body_hash] = (codec_name, bytes(data))
+        orphans = []
+        for item in items:
+            if item["body_hash"] in bodies:
+                item["codec"], item["body"] = bodies[item["body_hash"]]
+            else:
+                orphans.append(item)
+        if orphans:
+            self.remove_orphan_items(orphans)
+        return orphans
+
+    def remove_orphan_items(self, items):
+        logger.warning("Removing %d cache items without bodies", len(items))
+        with self.transaction():
+            # Item could be saved again with other body in the meantime
+            self.cursor.executemany(
+                "DELETE FROM cache WHERE id = %s AND body_hash = %s",
+                [(self.build_hash(x["url"]), x["body_hash"]) for x in items],
+            )
+
     def build_hash(self, url):
         utf_url = make_str(url)
         return sha1(utf_url).hexdigest()
 
+    def build_body_hash(self, body):
+        return sha1(body).hexdigest()
+
     def remove_cache_item(self, url):
         _hash = self.build_hash(url)
-        self.cursor.execute("begin")
-        self.cursor.execute(
+        with self.transaction():
+            self.cursor.execute(
+                """
+                DELETE FROM cache WHERE id = %s
+            """,
+                (_hash,),
+            )
+
+    def remove_oldest_items(self, count, timestamp=None):
+        """
+        Remove up to `count` items which have been saved earlier than
+        other items. If `timestamp` is set then only items saved not
+        later than `timestamp` are removed.
+
+        Returns number of removed items.
+        """
+        if timestamp is None:
+            where, args = "", (count,)
+        else:
+            where, args = "WHERE timestamp <= %s", (timestamp, count)
+        with self.transaction():
+            self.cursor.execute(
+                """
+                DELETE FROM cache WHERE id IN
+                  (SELECT id FROM cache %s ORDER BY timestamp LIMIT %%s)
             """
-            DELETE FROM cache WHERE id = %s
-        """,
-            (_hash,),
-        )
-        self.cursor.execute("commit")
+                % where,
+                args,
+            )
+            count = self.cursor.rowcount
+        return count
 
     def load_response(self, grab, cache_item):
-        grab.setup_document(cache_item["body"])
+        grab.setup_document(b"")
 
         body = cache_item["body"]
+        codec_name = cache_item.get("codec")
 
         def custom_prepare_response_func(transport, grab):
             doc = Document()
             doc.head = cache_item["head"]
-            doc.body = body
+            if codec_name is None:
+                doc.body = body
+            else:
+                doc.set_compressed_body(codec_name, body)
             doc.code = cache_item["response_code"]
-            doc.download_size = len(body)
+            doc.download_size = cache_item.get("body_size", len(body))
             doc.upload_size = 0
             doc.download_speed = 0
             doc.url = cache_item["response_url"]
-            doc.parse(charset=grab.config["document_charset"])
+            # Known charset allows to not decompress the body
+            doc.parse(
+                charset=grab.config["document_charset"] or cache_item.get("charset")
+            )
             doc.cookies = CookieManager(transport.extract_cookiejar())
             doc.from_cache = True
             return doc
 
         grab.process_request_result(custom_prepare_response_func)
 
-    def save_response(self, url, grab):
-        body = grab.doc.body
-
-        item = {
+    def build_cache_item(self, url, grab, task_name=None):
+        return {
             "url": url,
+            "task_name": task_name,
             "response_url": grab.doc.url,
-            "body": body,
+            "body": grab.doc.body,
+            "charset": grab.doc.charset,
             "head": grab.doc.head,
             "response_code": grab.doc.code,
             "cookies": None,
         }
-        self.set_item(url, item)
+
+    def save_response(self, url, grab, task_name=None):
+        self.save_responses([(url, grab, task_name)])
+
+    def save_responses(self, items):
+        """
+        Save multiple responses in one transaction.
+
+        Args:
+            items: list of (url, grab, task_name) tuples
+        """
+        self.set_items(
+            [
+                (url, self.build_cache_item(url, grab, task_name))
+                for url, grab, task_name in items
+            ]
+        )
 
     def set_item(self, url, item):
-        _hash = self.build_hash(url)
-        data = self.pack_database_value(item)
-        self.cursor.execute("BEGIN")
+        self.set_items([(url, item)])
+
+    def set_items(self, items):
         moment = int(time.time())
-        sql = """
-              UPDATE cache SET timestamp = %s, data = %s WHERE id = %s;
-              INSERT INTO cache (id, timestamp, data)
-              SELECT %s, %s, %s WHERE NOT EXISTS
-                (SELECT 1 FROM cache WHERE id = %s);
-              """
-        self.cursor.execute(
-            sql,
-            (
-                moment,
-                psycopg2.Binary(data),
-                _hash,
+        # One INSERT statement could not update same row twice,
+        # so only the last item of each URL is saved
+        rows = {}
+        # body hash -> body
+        bodies = {}
+        for url, item in items:
+            item = dict(item)
+            body = item.pop("body")
+            body_hash = None
+            item["body_size"] = len(body)
+            if self.deduplicate:
+                body_hash = self.build_body_hash(body)
+                item["body_hash"] = body_hash
+                if body_hash not in bodies:
+                    bodies[body_hash] = body
+            else:
+                item["codec"] = self.codec.name
+                item["body"] = self.codec.compress(body)
+            _hash = self.build_hash(url)
+            rows[_hash] = (
                 _hash,
                 moment,
-                psycopg2.Binary(data),
-                _hash,
-            ),
+                psycopg2.Binary(self.pack_database_value(item)),
+                body_hash,
+            )
+        with self.transaction():
+            sql = """
+                  INSERT INTO cache (id, timestamp, data, body_hash)
+                  VALUES %s
+                  ON CONFLICT (id) DO UPDATE
+                    SET timestamp = EXCLUDED.timestamp, data = EXCLUDED.data,
+                        body_hash = EXCLUDED.body_hash
+                  """
+            execute_values(self.cursor, sql, list(rows.values()))
+            # Bodies are checked after items are inserted: the lock
+            # of the cache table taken by the insert makes
+            # `remove_unused_bodies` wait until the transaction is
+            # committed or makes this transaction wait until bodies
+            # are removed
+            if bodies:
+                self.save_bodies(bodies)
+
+    def save_bodies(self, bodies):
+        self.cursor.execute(
+            "SELECT id FROM cache_body WHERE id IN %s", (tuple(bodies),)
         )
-        self.cursor.execute("COMMIT")
+        for (body_hash,) in self.cursor.fetchall():
+            if not isinstance(body_hash, str):
+                body_hash = bytes(body_hash).decode("ascii")
+            # Body is already stored, do not write it again
+            bodies.pop(body_hash, None)
+        if bodies:
+            execute_values(
+                self.cursor,
+                """
+                INSERT INTO cache_body (id, codec, data)
+                VALUES %s
+                ON CONFLICT (id) DO NOTHING
+                """,
+                [
+                    (x, self.codec.name, psycopg2.Binary(self.codec.compress(y)))
+                    for x, y in bodies.items()
+                ],
+            )
+
+    def remove_unused_bodies(self):
+        """
+        Remove bodies which are not used by any item.
+
+        Returns number of removed bodies.
+        """
+        with self.transaction():
+            # Block writes of new items which could refer to
+            # the bodies being removed, see `set_items`
+            self.cursor.execute("LOCK TABLE cache IN SHARE MODE")
+            self.cursor.execute(
+                """
+                DELETE FROM cache_body WHERE NOT EXISTS
+                  (SELECT 1 FROM cache WHERE cache.body_hash = cache_body.id)
+            """
+            )
+            count = self.cursor.rowcount
+        return count
 
     def pack_database_value(self, val):
-        dump = marshal.dumps(val)
-        return zlib.compress(dump)
+        return marshal.dumps(val)
 
     def clear(self):
-        self.cursor.execute("BEGIN")
-        self.cursor.execute("TRUNCATE cache")
-        self.cursor.execute("COMMIT")
+        with self.transaction():
+            self.cursor.execute("TRUNCATE cache")
+            self.cursor.execute("TRUNCATE cache_body")
 
     def has_item(self, url):
         """
@@ -0,0 +1,464 @@
+"""
+Spider cache backend powered by sqlite
+
+The cache is stored in the single local file, no database server is
+required. The database works in WAL mode so the writer appends records
+to the log sequentially and readers are not blocked by the writer. Pages
+of the database are read via memory-mapped I/O.
+
+In deduplication mode bodies are stored in the `cache_body` table keyed
+by the hash of the body and items of the `cache` table refer to them
+with the `body_hash` key. Bodies which are not used anymore are removed
+by `remove_unused_bodies` method.
+
+Bodies are compressed with the codec, see `grab.util.codec`. The name
+of the codec is stored with the item, so items compressed with different
+codecs could be stored in one cache. Body is decompressed only when it
+is accessed.
+
+CacheItem interface:
+'url': string,
+'task_name': string, name of the task which has received the response
+'response_url': string,
+'body': string, compressed body
+'codec': string, name of the codec which is used to compress the body
+'body_size': int, size of uncompressed body
+'charset': string,
+'head': string,
+'response_code': int,
+'cookies': None,
+'timestamp': int, time when the item was saved
+"""
+import logging
+import marshal
+import sqlite3
+import time
+import zlib
+from hashlib import sha1
+from threading import Lock
+
+from grab.cookie import CookieManager
+from grab.document import Document
+from grab.util.codec import build_codec
+from grab.util.encoding import make_str
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.cache_backend.sqlite")
+# pylint: enable=invalid-name
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+# Old versions of sqlite do not allow more than 999 variables in one query
+MAX_SQL_VARIABLES = 500
+
+
+class CacheBackend(object):
+    def __init__(
+        self,
+        database,
+        use_compression=True,
+        codec=None,
+        mmap_size=DEFAULT_MMAP_SIZE,
+        deduplicate=False,
+        spider=None,
+        **kwargs
+    ):
+        """
+        Args:
+            database: path to the database file
+            use_compression: compress bodies with zlib, it is used
+                only if `codec` is None
+            codec: codec which is used to compress bodies e.g. "zlib:9"
+                or "lzma", see `grab.util.codec`
+            mmap_size: max. number of bytes of the database file which
+                are accessed via memory-mapped I/O, use 0 to disable it
+            deduplicate: store identical bodies only once
+        """
+        self.spider = spider
+        self.database = database
+        self.use_compression = use_compression
+        if codec is None:
+            codec = "zlib" if use_compression else "none"
+        self.codec = build_codec(codec)
+        self.mmap_size = mmap_size
+        self.deduplicate = deduplicate
+        self.connection_config = kwargs
+        self.lock = Lock()
+        self.connect()
+        self.create_cache_table()
+
+    def connect(self):
+        self.connection = sqlite3.connect(
+            self.database,
+            check_same_thread=False,
+            isolation_level=None,
+            **self.connection_config
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA mmap_size=%d" % int(self.mmap_size))
+
+    def reconnect(self):
+        self.connect()
+
+    def close(self):
+        self.connection.close()
+
+    def create_cache_table(self):
+        with self.lock:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    id TEXT NOT NULL PRIMARY KEY,
+                    timestamp INTEGER NOT NULL,
+                    is_compressed INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    body_hash TEXT
+                )
+            """
+            )
+            columns = [
+                x[1] for x in self.connection.execute("PRAGMA table_info(cache)")
+            ]
+            if "body_hash" not in columns:
+                # The table has been created by old version of grab
+                self.connection.execute("ALTER TABLE cache ADD COLUMN body_hash TEXT")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_body_hash_idx ON cache (body_hash)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS cache_timestamp_idx ON cache (timestamp)"
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache_body (
+                    id TEXT NOT NULL PRIMARY KEY,
+                    codec TEXT NOT NULL,
+                    data BLOB NOT NULL
+                )
+            """
+            )
+
+    def get_item(self, url):
+        """
+        Returned item should have specific interface. See module docstring.
+        """
+
+        _hash = self.build_hash(url)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT timestamp, is_compressed, data FROM cache WHERE id = ?",
+                (_hash,),
+            ).fetchone()
+        if row:
+            item = self.unpack_database_value(row[2], row[1])
+            item["timestamp"] = row[0]
+            if not self.load_item_bodies([item]):
+                return item
+        return None
+
+    def unpack_database_value(self, val, is_compressed):
+        dump = bytes(val)
+        if is_compressed:
+            # Items without codec are compressed entirely
+            dump = zlib.decompress(dump)
+        return marshal.loads(dump)
+
+    def pack_database_value(self, val):
+        return marshal.dumps(val)
+
+    def get_items(self, urls):
+        """
+        Find multiple items with one request to the database.
+
+        Returns dict which maps URL to the item, URLs which are not found
+        in the cache are not included in the dict.
+        """
+        hashes = {}
+        for url in urls:
+            hashes[self.build_hash(url)] = url
+        result = {}
+        keys = list(hashes)
+        with self.lock:
+            for pos in range(0, len(keys), MAX_SQL_VARIABLES):
+                chunk = keys[pos : pos + MAX_SQL_VARIABLES]
+                rows = self.connection.execute(
+                    "SELECT id, timestamp, is_compressed, data FROM cache"
+                    " WHERE id IN (%s)" % ", ".join("?" * len(chunk)),
+                    chunk,
+                ).fetchall()
+                for _hash, timestamp, is_compressed, data in rows:
+                    result[hashes[_hash]] = (timestamp, is_compressed, data)
+        for url, (timestamp, is_compressed, data) in result.items():
+            item = self.unpack_database_value(data, is_compressed)
+            item["timestamp"] = timestamp
+            result[url] = item
+        orphans = set(id(x) for x in self.load_item_bodies(list(result.values())))
+        return dict((x, y) for x, y in result.items() if id(y) not in orphans)
+
+    def iterate_items(self, batch_size=100):
+        """
+        Iterate over all items of the cache.
+
+        Items are read in batches of `batch_size` items ordered by the
+        key, so no transaction is kept open between batches.
+        """
+        last_hash = ""
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, timestamp, is_compressed, data FROM cache"
+                    " WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_hash, batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            items = []
+            for _, timestamp, is_compressed, data in rows:
+                item = self.unpack_database_value(data, is_compressed)
+                item["timestamp"] = timestamp
+                items.append(item)
+            orphans = set(id(x) for x in self.load_item_bodies(items))
+            for item in items:
+                if id(item) not in orphans:
+                    yield item
+            last_hash = rows[-1][0]
+
+    def load_item_bodies(self, items):
+        """
+        Load bodies of items which have been saved in deduplication mode.
+
+        Items which bodies are not found are removed from the cache,
+        returns list of such items.
+        """
+        items = [x for x in items if x.get("body_hash")]
+        keys = list(set(x["body_hash"] for x in items))
+        bodies = {}
+        with self.lock:
+            for pos in range(0, len(keys), MAX_SQL_VARIABLES):
+                chunk = keys[pos : pos + MAX_SQL_VARIABLES]
+                rows = self.connection.execute(
+                    "SELECT id, codec, data FROM cache_body"
+                    " WHERE id IN (%s)" % ", ".join("?" * len(chunk)),
+                    chunk,
+                ).fetchall()
+                for body_hash, codec_name, data in rows:
+                    bodies[body_hash] = (codec_name, bytes(data))
+        orphans = []
+        for item in items:
+            if item["body_hash"] in bodies:
+                item["codec"], item["body"] = bodies[item["body_hash"]]
+            else:
+                orphans.append(item)
+        if orphans:
+            self.remove_orphan_items(orphans)
+        return orphans
+
+    def remove_orphan_items(self, items):
+        logger.warning("Removing %d cache items without bodies", len(items))
+        with self.lock:
+            # Item could be saved again with other body in the meantime
+            self.connection.executemany(
+                "DELETE FROM cache WHERE id = ? AND body_hash = ?",
+                [(self.build_hash(x["url"]), x["body_hash"]) for x in items],
+            )
+
+    def build_hash(self, url):
+        utf_url = make_str(url)
+        return sha1(utf_url).hexdigest()
+
+    def build_body_hash(self, body):
+        return sha1(body).hexdigest()
+
+    def remove_cache_item(self, url):
+        _hash = self.build_hash(url)
+        with self.lock:
+            self.connection.execute("DELETE FROM cache WHERE id = ?", (_hash,))
+
+    def remove_oldest_items(self, count, timestamp=None):
+        """
+        Remove up to `count` items which have been saved earlier than
+        other items. If `timestamp` is set then only items saved not
+        later than `timestamp` are removed.
+
+        Returns number of removed items.
+        """
+        if timestamp is None:
+            where, args = "", (count,)
+        else:
+            where, args = "WHERE timestamp <= ?", (timestamp, count)
+        with self.lock:
+            return self.connection.execute(
+                "DELETE FROM cache WHERE id IN"
+                " (SELECT id FROM cache %s ORDER BY timestamp LIMIT ?)" % where,
+                args,
+            ).rowcount
+
+    def load_response(self, grab, cache_item):
+        grab.setup_document(b"")
+
+        body = cache_item["body"]
+        codec_name = cache_item.get("codec")
+
+        def custom_prepare_response_func(transport, grab):
+            doc = Document()
+            doc.head = cache_item["head"]
+            if codec_name is None:
+                doc.body = body
+            else:
+                doc.set_compressed_body(codec_name, body)
+            doc.code = cache_item["response_code"]
+            doc.download_size = cache_item.get("body_size", len(body))
+            doc.upload_size = 0
+            doc.download_speed = 0
+            doc.url = cache_item["response_url"]
+            # Known charset allows to not decompress the body
+            doc.parse(
+                charset=grab.config["document_charset"] or cache_item.get("charset")
+            )
+            doc.cookies = CookieManager(transport.extract_cookiejar())
+            doc.from_cache = True
+            return doc
+
+        grab.process_request_result(custom_prepare_response_func)
+
+    def build_cache_item(self, url, grab, task_name=None):
+        return {
+            "url": url,
+            "task_name": task_name,
+            "response_url": grab.doc.url,
+            "body": grab.doc.body,
+            "charset": grab.doc.charset,
+            "head": grab.doc.head,
+            "response_code": grab.doc.code,
+            "cookies": None,
+        }
+
+    def save_response(self, url, grab, task_name=None):
+        self.save_responses([(url, grab, task_name)])
+
+    def save_responses(self, items):
+        """
+        Save multiple responses in one transaction.
+
+        Args:
+            items: list of (url, grab, task_name) tuples
+        """
+        self.set_items(
+            [
+                (url, self.build_cache_item(url, grab, task_name))
+                for url, grab, task_name in items
+            ]
+        )
+
+    def set_item(self, url, item):
+        self.set_items([(url, item)])
+
+    def set_items(self, items):
+        moment = int(time.time())
+        rows = []
+        # body hash -> body
+        bodies = {}
+        for url, item in items:
+            item = dict(item)
+            body = item.pop("body")
+            body_hash = None
+            item["body_size"] = len(body)
+            if self.deduplicate:
+                body_hash = self.build_body_hash(body)
+                item["body_hash"] = body_hash
+                if body_hash not in bodies:
+                    bodies[body_hash] = body
+            else:
+                item["codec"] = self.codec.name
+                item["body"] = self.codec.compress(body)
+            rows.append(
+                (
+                    self.build_hash(url),
+                    moment,
+                    0,
+                    sqlite3.Binary(self.pack_database_value(item)),
+                    body_hash,
+                )
+            )
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if bodies:
+                    self.save_bodies(bodies)
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO cache"
+                    " (id, timestamp, is_compressed, data, body_hash)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+
+    def save_bodies(self, bodies):
+        keys = list(bodies)
+        for pos in range(0, len(keys), MAX_SQL_VARIABLES):
+            chunk = keys[pos : pos + MAX_SQL_VARIABLES]
+            for row in self.connection.execute(
+                "SELECT id FROM cache_body WHERE id IN (%s)"
+                % ", ".join("?" * len(chunk)),
+                chunk,
+            ):
+                # Body is already stored, do not write it again
+                del bodies[row[0]]
+        self.connection.executemany(
+            "INSERT INTO cache_body (id, codec, data) VALUES (?, ?, ?)",
+            [
+                (
+                    body_hash,
+                    self.codec.name,
+                    sqlite3.Binary(self.codec.compress(body)),
+                )
+                for body_hash, body in bodies.items()
+            ],
+        )
+
+    def remove_unused_bodies(self):
+        """
+        Remove bodies which are not used by any item.
+
+        Returns number of removed bodies.
+        """
+        with self.lock:
+            # Write transaction could not run concurrently with
+            # the transaction of `set_items`, so the body which is
+            # going to be used by new item is not removed
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                count = self.connection.execute(
+                    "DELETE FROM cache_body WHERE NOT EXISTS"
+                    " (SELECT 1 FROM cache WHERE cache.body_hash = cache_body.id)"
+                ).rowcount
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+        return count
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM cache")
+            self.connection.execute("DELETE FROM cache_body")
+
+    def has_item(self, url):
+        """
+        Test if required item exists in the cache.
+        """
+
+        _hash = self.build_hash(url)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM cache WHERE id = ? LIMIT 1", (_hash,)
+            ).fetchone()
+        return True if row else False
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
@@ -0,0 +1,231 @@
+"""
+Read-only spider cache backend powered by WARC files
+
+The `database` argument is the path to the WARC file or the list of paths.
+Response records of files are indexed by WARC-Target-URI, the index is
+stored in `<path>.idx` files (see `grab.util.warc`) so only records which
+are not in the index are read when the file is opened. Records are read
+from memory-mapped files. If the same URL is found in multiple records
+then the last record is used.
+
+Responses received by the spider are not saved into WARC files by this
+backend, use `Spider.setup_warc` to write them.
+
+CacheItem interface:
+'url': string,
+'task_name': string, name of the task which has received the response
+'response_url': string,
+'body': string,
+'charset': None,
+'head': string,
+'response_code': int,
+'cookies': None,
+'timestamp': int, time when the response was received
+"""
+import logging
+import mmap
+import os
+from threading import Lock
+
+import six
+
+from grab.cookie import CookieManager
+from grab.document import Document
+from grab.spider.error import SpiderMisuseError
+from grab.util.warc import (
+    WarcError,
+    load_index,
+    parse_http_response,
+    parse_record,
+    parse_warc_date,
+    read_record_data,
+)
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.cache_backend.warc")
+# pylint: enable=invalid-name
+# Indexes shared by backends of reader threads,
+# (path, size, mtime) -> index
+INDEX_CACHE = {}
+INDEX_CACHE_LOCK = Lock()
+
+
+class CacheBackend(object):
+    # Items are not removed by the cache writer, see `Spider.setup_cache`
+    read_only = True
+
+    def __init__(self, database, spider=None, **kwargs):
+        """
+        Args:
+            database: path to WARC file or list of paths
+        """
+        if isinstance(database, six.string_types):
+            database = [database]
+        self.spider = spider
+        self.paths = list(database)
+        self.files = []
+        self.data = []
+        # url -> (file number, offset, length)
+        self.index = {}
+        self.connect()
+
+    def connect(self):
+        self.close()
+        for path in self.paths:
+            fobj = open(path, "rb")
+            if os.fstat(fobj.fileno()).st_size:
+                data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty file could not be memory-mapped
+                data = b""
+            self.files.append(fobj)
+            self.data.append(data)
+        self.index = {}
+        for file_num, path in enumerate(self.paths):
+            for url, (offset, length) in self.get_file_index(file_num).items():
+                self.index[url] = (file_num, offset, length)
+
+    def get_file_index(self, file_num):
+        path = os.path.abspath(self.paths[file_num])
+        stat = os.fstat(self.files[file_num].fileno())
+        key = (path, stat.st_size, stat.st_mtime)
+        with INDEX_CACHE_LOCK:
+            if key not in INDEX_CACHE:
+                logger.debug("Loading index of %s", path)
+                # Forget index of previous version of the file
+                for old_key in [x for x in INDEX_CACHE if x[0] == path]:
+                    del INDEX_CACHE[old_key]
+                INDEX_CACHE[key] = load_index(path, self.data[file_num])
+            return INDEX_CACHE[key]
+
+    def reconnect(self):
+        self.connect()
+
+    def close(self):
+        for data in self.data:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        for fobj in self.files:
+            fobj.close()
+        self.files = []
+        self.data = []
+
+    def read_item(self, file_num, offset):
+        """
+        Returns None if the record is malformed.
+        """
+        try:
+            return self.parse_item(file_num, offset)
+        except WarcError as ex:
+            logger.error(
+                "Could not read record at offset %d of %s: %s",
+                offset,
+                self.paths[file_num],
+                ex,
+            )
+            return None
+
+    def parse_item(self, file_num, offset):
+        raw, _ = read_record_data(self.data[file_num], offset)
+        headers, payload = parse_record(raw)
+        code, head, body = parse_http_response(payload)
+        url = headers[b"warc-target-uri"].decode("utf-8")
+        task_name = headers.get(b"grab-task-name")
+        response_url = headers.get(b"grab-response-uri")
+        return {
+            "url": url,
+            "task_name": task_name.decode("utf-8") if task_name else None,
+            "response_url": response_url.decode("utf-8") if response_url else url,
+            "body": body,
+            "charset": None,
+            "head": head,
+            "response_code": code,
+            "cookies": None,
+            "timestamp": parse_warc_date(headers[b"warc-date"].decode("ascii")),
+        }
+
+    def get_item(self, url):
+        """
+        Returned item should have specific interface. See module docstring.
+        """
+        try:
+            file_num, offset, _ = self.index[url]
+        except KeyError:
+            return None
+        else:
+            return self.read_item(file_num, offset)
+
+    def get_items(self, urls):
+        """
+        Find multiple items.
+
+        Returns dict which maps URL to the item, URLs which are not found
+        in the cache are not included in the dict.
+        """
+        result = {}
+        for url in urls:
+            item = self.get_item(url)
+            if item is not None:
+                result[url] = item
+        return result
+
+    def iterate_items(self, batch_size=100):  # pylint: disable=unused-argument
+        """
+        Iterate over all items of the cache in the order of records
+        in WARC files.
+        """
+        for file_num, offset, _ in sorted(self.index.values()):
+            item = self.read_item(file_num, offset)
+            if item is not None:
+                yield item
+
+    def load_response(self, grab, cache_item):
+        grab.setup_document(b"")
+
+        def custom_prepare_response_func(transport, grab):
+            doc = Document()
+            doc.head = cache_item["head"]
+            doc.body = cache_item["body"]
+            doc.code = cache_item["response_code"]
+            doc.download_size = len(cache_item["body"])
+            doc.upload_size = 0
+            doc.download_speed = 0
+            doc.url = cache_item["response_url"]
+            doc.parse(charset=grab.config["document_charset"])
+            doc.cookies = CookieManager(transport.extract_cookiejar())
+            doc.from_cache = True
+            return doc
+
+        grab.process_request_result(custom_prepare_response_func)
+
+    def save_response(self, url, grab, task_name=None):
+        self.save_responses([(url, grab, task_name)])
+
+    def save_responses(self, items):
+        """
+        Responses are not saved, WARC backend is read-only.
+        """
+
+    def set_item(self, url, item):
+        self.set_items([(url, item)])
+
+    def set_items(self, items):
+        raise SpiderMisuseError("WARC cache backend is read-only")
+
+    def remove_cache_item(self, url):
+        raise SpiderMisuseError("WARC cache backend is read-only")
+
+    def remove_oldest_items(self, count, timestamp=None):
+        raise SpiderMisuseError("WARC cache backend is read-only")
+
+    def clear(self):
+        raise SpiderMisuseError("WARC cache backend is read-only")
+
+    def has_item(self, url):
+        """
+        Test if required item exists in the cache.
+        """
+        return url in self.index
+
+    def size(self):
+        return len(self.index)
@@ -0,0 +1,113 @@
+"""
+In-memory tier of the spider cache.
+
+`MemoryCache` keeps recently saved and recently loaded cache items
+in memory so repeated lookups of the same URL do not go to the cache
+storage. The number of items and total size of their bodies are limited,
+least recently used items are removed first.
+
+Items have the same interface as items of cache backends (see
+`grab.spider.cache_backend.sqlite`) so they could be loaded with
+`load_response` method of any backend.
+"""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+def build_memory_item(url, grab, task_name=None):
+    """
+    Build cache item from the network response.
+
+    The body is not compressed, "none" codec is set explicitly to not let
+    backends guess the compression.
+    """
+    return {
+        "url": url,
+        "task_name": task_name,
+        "response_url": grab.doc.url,
+        "body": grab.doc.body,
+        "codec": "none",
+        "body_size": len(grab.doc.body),
+        "charset": grab.doc.charset,
+        "head": grab.doc.head,
+        "response_code": grab.doc.code,
+        "cookies": None,
+        "timestamp": int(time.time()),
+    }
+
+
+def get_item_weight(item):
+    return len(item["body"]) + len(item["head"] or b"")
+
+
+class MemoryCache(object):
+    def __init__(self, max_items=None, max_bytes=None):
+        """
+        Args:
+            max_items: max. number of items, None means no limit
+            max_bytes: max. total size of bodies and headers of items,
+                None means no limit
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        # url -> (item, weight), the least recently used item goes first
+        self.items = OrderedDict()
+        self.size_bytes = 0
+        self.lock = Lock()
+
+    def get_items(self, urls):
+        """
+        Returns dict which maps URL to the item, URLs which are not found
+        are not included in the dict.
+        """
+        result = {}
+        with self.lock:
+            for url in urls:
+                try:
+                    record = self.items.pop(url)
+                except KeyError:
+                    pass
+                else:
+                    self.items[url] = record
+                    result[url] = record[0]
+        return result
+
+    def set_items(self, items):
+        """
+        Args:
+            items: list of (url, item) tuples
+        """
+        with self.lock:
+            for url, item in items:
+                old = self.items.pop(url, None)
+                if old is not None:
+                    self.size_bytes -= old[1]
+                weight = get_item_weight(item)
+                if self.max_bytes is not None and weight > self.max_bytes:
+                    continue
+                self.items[url] = (item, weight)
+                self.size_bytes += weight
+            self.evict_items()
+
+    def evict_items(self):
+        while self.items and (
+            (self.max_items is not None and len(self.items) > self.max_items)
+            or (self.max_bytes is not None and self.size_bytes > self.max_bytes)
+        ):
+            _, (_, weight) = self.items.popitem(last=False)
+            self.size_bytes -= weight
+
+    def remove_item(self, url):
+        with self.lock:
+            record = self.items.pop(url, None)
+            if record is not None:
+                self.size_bytes -= record[1]
+
+    def size(self):
+        return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items = OrderedDict()
+            self.size_bytes = 0
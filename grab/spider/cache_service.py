@@ -1,9 +1,48 @@
+from threading import Lock
 import time
 
-from six.moves.queue import Empty, Queue
+import six
+from six.moves.queue import Empty, Full, Queue
 
 from grab.spider.base_service import BaseService
+from grab.spider.cache_memory import build_memory_item
 from grab.spider.queue_backend import memory_queue
+from grab.spider.task import Task
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_READER_POOL_SIZE = 4
+DEFAULT_READ_BATCH_SIZE = 20
+DEFAULT_EVICT_INTERVAL = 60
+DEFAULT_EVICT_BATCH_SIZE = 1000
+DEFAULT_SCAN_BATCH_SIZE = 100
+
+
+def build_cache_validators(head):
+    """
+    Build headers of conditional request from headers of cached response.
+
+    Returns empty dict if cached response has neither ETag nor
+    Last-Modified headers.
+    """
+    if isinstance(head, six.binary_type):
+        head = head.decode("latin-1")
+    # Head could contain headers of multiple responses if there
+    # were redirects, the last block belongs to the final response
+    blocks = [x for x in head.replace("\r\n", "\n").split("\n\n") if x.strip()]
+    validators = {}
+    if blocks:
+        for line in blocks[-1].split("\n"):
+            name, sep, value = line.partition(":")
+            if not sep:
+                continue
+            name = name.strip().lower()
+            value = value.strip()
+            if name == "etag":
+                validators["If-None-Match"] = value
+            elif name == "last-modified":
+                validators["If-Modified-Since"] = value
+    return validators
 
 
 class CacheServiceBase(BaseService):
@@ -17,38 +56,110 @@ class CacheServiceBase(BaseService):
         # pylint: enable=no-member
         self.register_workers(self.worker)
 
-    def stop(self):
-        super(CacheServiceBase, self).stop()
-        self.backend.close()
-
 
 class CacheReaderService(CacheServiceBase):
+    """
+    Loads responses for tasks from the cache.
+
+    The service runs the pool of reader threads, each thread has its
+    own cache backend. The thread takes up to `batch_size` tasks from
+    the input queue and looks up all of them with one request
+    to the cache storage.
+
+    If `memory_cache` is set then items are looked up in it first and
+    items loaded from the cache storage are put into it.
+    """
+
+    def __init__(self, spider, backends, batch_size=DEFAULT_READ_BATCH_SIZE,
+                 cache_timeout=None, memory_cache=None):
+        """
+        Args:
+            backends: list of cache backends, one for each reader thread
+            cache_timeout: max. age of cached response in seconds, it
+                could be changed for the task with `cache_timeout` option
+                of the task, None means that cached responses never expire
+            memory_cache: `MemoryCache` instance shared with the writer
+        """
+        self.spider = spider
+        self.backends = backends
+        # The backend which is used by tests and other code
+        # which works with the cache directly
+        self.backend = backends[0]
+        self.batch_size = batch_size
+        self.cache_timeout = cache_timeout
+        self.memory_cache = memory_cache
+        self.queue_size_limit = 100
+        self.input_queue = self.create_input_queue()
+        self.input_queue_lock = Lock()
+        self.workers = []
+        # worker -> backend
+        self.worker_backends = {}
+        for backend in backends:
+            worker = self.create_worker(self.worker_callback)
+            self.workers.append(worker)
+            self.worker_backends[worker] = backend
+        self.register_workers(self.workers)
+
     def create_input_queue(self):
         return memory_queue.QueueBackend(spider_name=None)
 
     def worker_callback(self, worker):
-        while not worker.stop_event.is_set():
-            worker.process_pause_signal()
-            try:
-                # Can't use (block=True, timeout=0.1) because
-                # the backend could be mongodb, mysql, etc
-                task = self.input_queue.get()
-            except Empty:
-                time.sleep(0.1)
-            else:
-                grab = self.spider.setup_grab_for_task(task)
-                item = None
-                if self.is_read_allowed(task, grab):
-                    item = self.load_from_cache(task, grab)
-                    if item:
-                        result, task = item
-                        self.spider.task_dispatcher.input_queue.put(
-                            (result, task, None)
-                        )
-                if not item:
+        backend = self.worker_backends[worker]
+        try:
+            while not worker.stop_event.is_set():
+                worker.process_pause_signal()
+                # The worker is busy since tasks are taken from the queue
+                # until they are passed to the task dispatcher
+                worker.is_busy_event.set()
+                try:
+                    # Can't use (block=True, timeout=0.1) because
+                    # the backend could be mongodb, mysql, etc
+                    with self.input_queue_lock:
+                        tasks = self.input_queue.get_many(self.batch_size)
+                    if tasks:
+                        self.process_tasks(tasks, backend)
+                finally:
+                    worker.is_busy_event.clear()
+                if not tasks:
+                    time.sleep(0.1)
+        finally:
+            backend.close()
+
+    def process_tasks(self, tasks, backend):
+        grabs = [self.spider.setup_grab_for_task(x) for x in tasks]
+        urls = [
+            grab.config["url"]
+            for task, grab in zip(tasks, grabs)
+            if self.is_read_allowed(task, grab)
+        ]
+        cache_items = self.get_cache_items(urls, backend) if urls else {}
+        for task, grab in zip(tasks, grabs):
+            item = None
+            if self.is_read_allowed(task, grab):
+                item = self.load_from_cache(task, grab, backend, cache_items)
+                if item:
+                    result, task = item
                     self.spider.task_dispatcher.input_queue.put(
-                        (task, None, {"source": "cache_reader"})
+                        (result, task, None)
                     )
+            if not item:
+                self.spider.task_dispatcher.input_queue.put(
+                    (task, None, {"source": "cache_reader"})
+                )
+
+    def get_cache_items(self, urls, backend):
+        if self.memory_cache is None:
+            return backend.get_items(urls)
+        result = self.memory_cache.get_items(urls)
+        missing = [x for x in urls if x not in result]
+        if len(urls) > len(missing):
+            self.spider.stat.inc("cache:memory-hit", len(urls) - len(missing))
+        if missing:
+            self.spider.stat.inc("cache:memory-miss", len(missing))
+            items = backend.get_items(list(set(missing)))
+            self.memory_cache.set_items(list(items.items()))
+            result.update(items)
+        return result
 
     def is_read_allowed(self, task, grab):
         return (
@@ -57,39 +168,212 @@ class CacheReaderService(CacheServiceBase):
             and grab.detect_request_method() == "GET"
         )
 
-    def load_from_cache(self, task, grab):
-        cache_item = self.backend.get_item(grab.config["url"])
+    def is_item_expired(self, task, cache_item):
+        timeout = task.cache_timeout
+        if timeout is None:
+            timeout = self.cache_timeout
+        if timeout is None or cache_item.get("timestamp") is None:
+            return False
+        return time.time() - cache_item["timestamp"] >= timeout
+
+    def load_from_cache(self, task, grab, backend, cache_items):
+        cache_item = cache_items.get(grab.config["url"])
         if cache_item is None:
             self.spider.stat.inc("cache:req-miss")
+        elif task.get("cache_revalidated"):
+            # Server has confirmed that cached response is not changed,
+            # save it again to update its timestamp
+            task.cache_revalidated = False
+            self.load_response(task, grab, backend, cache_item)
+            if self.spider.cache_writer_service:
+                self.spider.cache_writer_service.put(task, grab)
+            return self.build_cache_result(grab), task
+        elif self.is_item_expired(task, cache_item):
+            validators = build_cache_validators(cache_item["head"])
+            if validators:
+                # The task goes to the network with conditional
+                # request headers, 304 response is a cache hit
+                task.cache_validators = validators
+                self.spider.stat.inc("cache:req-stale")
+            else:
+                self.spider.stat.inc("cache:req-expired")
         else:
-            grab.prepare_request()
-            self.backend.load_response(grab, cache_item)
-            grab.log_request("CACHED")
-            self.spider.stat.inc("cache:req-hit")
+            self.load_response(task, grab, backend, cache_item)
+            return self.build_cache_result(grab), task
+        return None
+
+    def load_response(self, task, grab, backend, cache_item):
+        grab.prepare_request()
+        backend.load_response(grab, cache_item)
+        grab.log_request("CACHED")
+        self.spider.stat.inc("cache:req-hit")
 
-            return {
-                "ok": True,
-                "grab": grab,
-                "grab_config_backup": grab.dump_config(),
-                "emsg": None,
-                "from_cache": True,
-            }, task
+    def build_cache_result(self, grab):
+        return {
+            "ok": True,
+            "grab": grab,
+            "grab_config_backup": grab.dump_config(),
+            "emsg": None,
+            "from_cache": True,
+        }
 
 
 class CacheWriterService(CacheServiceBase):
+    """
+    Saves network responses into the cache.
+
+    Responses are gathered into batches which are saved with one
+    transaction. The batch is saved when it has `batch_size` items or
+    when `flush_interval` seconds passed since the first item has been
+    added to the batch.
+
+    If `max_age` or `max_size` limit is set then the service runs the
+    eviction thread which removes oldest items from the cache every
+    `evict_interval` seconds and once more when the spider stops.
+
+    If `memory_cache` is set then responses are put into it as soon as
+    they are accepted by the service.
+    """
+
+    def __init__(self, spider, backend, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, evict_backend=None,
+                 max_age=None, max_size=None,
+                 evict_interval=DEFAULT_EVICT_INTERVAL,
+                 evict_batch_size=DEFAULT_EVICT_BATCH_SIZE,
+                 memory_cache=None):
+        """
+        Args:
+            evict_backend: cache backend of the eviction thread, it is
+                required if `max_age` or `max_size` is set
+            max_age: max. number of seconds since the item has been saved,
+                older items are removed
+            max_size: max. number of items in the cache, oldest items
+                are removed if the cache has more items
+            evict_interval: number of seconds between eviction runs
+            evict_batch_size: max. number of items which are removed
+                with one request to the cache storage
+            memory_cache: `MemoryCache` instance shared with the reader
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.evict_backend = evict_backend
+        self.max_age = max_age
+        self.max_size = max_size
+        self.evict_interval = evict_interval
+        self.evict_batch_size = evict_batch_size
+        self.memory_cache = memory_cache
+        super(CacheWriterService, self).__init__(spider, backend)
+        if max_age is not None or max_size is not None:
+            self.evict_worker = self.create_worker(self.evict_worker_callback)
+            self.register_workers(self.worker, self.evict_worker)
+
     def create_input_queue(self):
-        return Queue()
+        # Queue size is limited to not keep too many Grab objects
+        # in memory if the cache backend is slower than the network
+        return Queue(maxsize=max(self.queue_size_limit, self.batch_size * 2))
 
-    def worker_callback(self, worker):
-        while not worker.stop_event.is_set():
-            worker.process_pause_signal()
+    def put(self, task, grab):
+        while True:
             try:
-                task, grab = self.input_queue.get(True, 0.1)
-            except Empty:
-                pass
+                self.input_queue.put((task, grab), True, 0.1)
+            except Full:
+                if self.worker.stop_event.is_set():
+                    break
             else:
-                if self.is_write_allowed(task, grab):
-                    self.backend.save_response(task.url, grab)
+                break
+
+    def worker_callback(self, worker):
+        batch = []
+        batch_time = None
+        try:
+            while not worker.stop_event.is_set():
+                worker.process_pause_signal()
+                if batch:
+                    timeout = max(0, batch_time + self.flush_interval - time.time())
+                else:
+                    timeout = 0.1
+                try:
+                    task, grab = self.input_queue.get(True, min(timeout, 0.1))
+                except Empty:
+                    pass
+                else:
+                    if self.is_write_allowed(task, grab):
+                        if self.memory_cache is not None:
+                            self.memory_cache.set_items(
+                                [
+                                    (
+                                        task.url,
+                                        build_memory_item(task.url, grab, task.name),
+                                    )
+                                ]
+                            )
+                        if not batch:
+                            batch_time = time.time()
+                        batch.append((task.url, grab, task.name))
+                if batch and (
+                    len(batch) >= self.batch_size
+                    or time.time() - batch_time >= self.flush_interval
+                ):
+                    self.save_batch(batch)
+                    batch = []
+        finally:
+            if batch:
+                self.save_batch(batch)
+            self.backend.close()
+
+    def evict_worker_callback(self, worker):
+        evict_time = 0
+        try:
+            while not worker.stop_event.is_set():
+                worker.process_pause_signal()
+                if time.time() >= evict_time:
+                    self.evict_items(worker.stop_event)
+                    evict_time = time.time() + self.evict_interval
+                time.sleep(0.1)
+            # Items saved by the writer thread on shutdown
+            # are also subject of limits
+            while self.worker.is_alive():
+                time.sleep(0.1)
+            self.evict_items()
+        finally:
+            self.evict_backend.close()
+
+    def evict_items(self, stop_event=None):
+        """
+        Remove items which exceed `max_age` or `max_size` limits.
+
+        Items are removed in batches of `evict_batch_size` items until
+        limits are satisfied or `stop_event` is set.
+
+        Returns number of removed items.
+        """
+        backend = self.evict_backend
+        total = 0
+        while stop_event is None or not stop_event.is_set():
+            count = 0
+            if self.max_age is not None:
+                count += backend.remove_oldest_items(
+                    self.evict_batch_size, timestamp=int(time.time() - self.max_age)
+                )
+            if self.max_size is not None and count < self.evict_batch_size:
+                excess = backend.size() - self.max_size
+                if excess > 0:
+                    count += backend.remove_oldest_items(
+                        min(excess, self.evict_batch_size - count)
+                    )
+            if count:
+                self.spider.stat.inc("cache:evict-item", count)
+            total += count
+            if count < self.evict_batch_size:
+                break
+        if total and getattr(backend, "deduplicate", False):
+            self.spider.stat.inc("cache:evict-body", backend.remove_unused_bodies())
+        return total
+
+    def save_batch(self, batch):
+        self.backend.save_responses(batch)
+        self.spider.stat.inc("cache:write-batch")
+        self.spider.stat.inc("cache:write-item", len(batch))
 
     def is_write_allowed(self, task, grab):
         return (
@@ -97,3 +381,72 @@ class CacheWriterService(CacheServiceBase):
             and not task.get("disable_cache")
             and self.spider.is_valid_network_response_code(grab.doc.code, task)
         )
+
+
+class CacheScannerService(CacheServiceBase):
+    """
+    Reads all items of the cache and passes them to task handlers.
+
+    Items are read sequentially with `iterate_items` method of the cache
+    backend and go directly to the parser service. The handler is chosen
+    by the name of the task which has received the response, items saved
+    without task name are processed by `task_name` handler.
+    """
+
+    def __init__(self, spider, backend, task_name=None,
+                 batch_size=DEFAULT_SCAN_BATCH_SIZE):
+        """
+        Args:
+            task_name: name of the task for items saved without task name,
+                if it is None then such items are skipped
+            batch_size: number of items which are read from the cache
+                with one request
+        """
+        self.task_name = task_name
+        self.batch_size = batch_size
+        super(CacheScannerService, self).__init__(spider, backend)
+
+    def create_input_queue(self):
+        return None
+
+    def worker_callback(self, worker):
+        parser_queue = self.spider.parser_service.input_queue
+        try:
+            for item in self.backend.iterate_items(self.batch_size):
+                # Do not read whole cache into the parser queue
+                while (
+                    parser_queue.qsize() >= self.queue_size_limit
+                    and not worker.stop_event.is_set()
+                ):
+                    worker.process_pause_signal()
+                    time.sleep(0.01)
+                worker.process_pause_signal()
+                if worker.stop_event.is_set():
+                    break
+                self.process_item(item)
+        finally:
+            self.backend.close()
+
+    def process_item(self, item):
+        task_name = item.get("task_name") or self.task_name
+        if task_name is None:
+            self.spider.stat.inc("cache:scan-no-task")
+            return
+        task = Task(task_name, url=item["url"])
+        grab = self.spider.setup_grab_for_task(task)
+        grab.prepare_request()
+        self.backend.load_response(grab, item)
+        grab.log_request("CACHED")
+        self.spider.stat.inc("cache:scan-item")
+        self.spider.parser_service.input_queue.put(
+            (
+                {
+                    "ok": True,
+                    "grab": grab,
+                    "grab_config_backup": grab.dump_config(),
+                    "emsg": None,
+                    "from_cache": True,
+                },
+                task,
+            )
+        )
@@ -0,0 +1,129 @@
+"""
+Host-aware scheduling of tasks taken from the task queue.
+
+Queue backends are global priority queues and know nothing about hosts.
+The `HostScheduler` reads tasks from the task queue into the buffer
+grouped by host and hands out tasks only for hosts which have free
+connection slots and which were not requested too recently. If the host
+of the head-of-queue task is saturated then the scheduler returns ready
+task of other host instead of blocking.
+"""
+from collections import defaultdict, deque
+import itertools
+from threading import Lock
+import time
+
+from six.moves.urllib.parse import urlsplit
+
+DEFAULT_LOOKAHEAD = 1000
+
+
+def get_task_host(task):
+    try:
+        return urlsplit(task.url).hostname or ""
+    except ValueError:
+        return ""
+
+
+class HostScheduler(object):
+    def __init__(self, spider, max_host_connections=None, host_delay=0,
+                 lookahead=DEFAULT_LOOKAHEAD):
+        """
+        Args:
+            spider: spider instance which task queue is used
+            max_host_connections: max. number of simultaneous network
+                requests to one host, use None to disable the limit
+            host_delay: min. number of seconds between starts of network
+                requests to one host
+            lookahead: max. number of tasks which are read from the
+                queue into the buffer
+        """
+        self.spider = spider
+        self.max_host_connections = max_host_connections
+        self.host_delay = host_delay
+        self.lookahead = lookahead
+        # host -> deque of (sequence number, task)
+        self.buffer = {}
+        self.buffer_size = 0
+        self.active = defaultdict(int)
+        self.next_request_time = {}
+        # id(task) -> host, for tasks which are processed now
+        self.task_hosts = {}
+        self.counter = itertools.count()
+        self.lock = Lock()
+
+    def fill_buffer(self):
+        if self.buffer_size >= self.lookahead:
+            return
+        tasks = self.spider.task_queue.get_many(self.lookahead - self.buffer_size)
+        for task in tasks:
+            host = get_task_host(task)
+            self.buffer.setdefault(host, deque()).append(
+                (next(self.counter), task)
+            )
+        self.buffer_size += len(tasks)
+
+    def is_host_ready(self, host, now):
+        if (self.max_host_connections is not None
+                and self.active.get(host, 0) >= self.max_host_connections):
+            return False
+        return self.next_request_time.get(host, 0) <= now
+
+    def get_task(self):
+        """
+        Return task which could be processed now.
+
+        Return value has the same meaning as the value returned
+        by `Spider.get_task_from_queue`: `Task` object, True if
+        there are tasks but none of them could be processed now
+        and None if there are no tasks at all.
+        """
+        with self.lock:
+            self.fill_buffer()
+            now = time.time()
+            ready_host = None
+            ready_seq = None
+            for host, tasks in self.buffer.items():
+                # The task with lowest sequence number is the task
+                # which was fetched from the queue earlier i.e. it has
+                # higher priority
+                if ((ready_seq is None or tasks[0][0] < ready_seq)
+                        and self.is_host_ready(host, now)):
+                    ready_host = host
+                    ready_seq = tasks[0][0]
+            if ready_host is None:
+                if self.buffer_size or self.spider.task_queue.size():
+                    return True
+                return None
+            tasks = self.buffer[ready_host]
+            _, task = tasks.popleft()
+            if not tasks:
+                del self.buffer[ready_host]
+            self.buffer_size -= 1
+            self.active[ready_host] += 1
+            if self.host_delay:
+                self.next_request_time[ready_host] = now + self.host_delay
+            self.task_hosts[id(task)] = ready_host
+            return task
+
+    def release(self, task):
+        """
+        Free the connection slot of the task's host.
+
+        It is safe to call this method for tasks which were not
+        returned by `get_task` or which were already released.
+        """
+        with self.lock:
+            host = self.task_hosts.pop(id(task), None)
+            if host is not None:
+                self.active[host] -= 1
+                if not self.active[host]:
+                    del self.active[host]
+
+    def size(self):
+        return self.buffer_size
+
+    def clear(self):
+        with self.lock:
+            self.buffer = {}
+            self.buffer_size = 0
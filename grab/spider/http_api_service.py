@@ -1,9 +1,19 @@
+"""
+HTTP API of the spider.
+
+Methods:
+
+* / - HTML page which displays the state of the spider
+* /api/info - JSON with counters and sizes of queues
+* /api/stop - stop the spider
+* /metrics - metrics in OpenMetrics text format, see `render_metrics`
+"""
 import json
 import logging
 import os
 
 from six.moves.SimpleHTTPServer import SimpleHTTPRequestHandler
-from six.moves.socketserver import TCPServer
+from six.moves.socketserver import TCPServer, ThreadingMixIn
 
 from grab.spider.base_service import BaseService
 from grab.util.encoding import make_str
@@ -12,9 +22,108 @@ from grab.util.encoding import make_str
 logger = logging.getLogger("grab.spider.http_api_service")
 # pylint: enable=invalid-name
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+METRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# Upper bounds of histogram buckets exported to /metrics, in seconds
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_metric_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+def get_queue_sizes(spider):
+    """
+    Returns list of (name, size) tuples of queues of spider services.
+    """
+    result = [
+        ("task_queue", spider.task_queue.size() if spider.task_queue else 0),
+        ("task_buffer", len(spider.task_buffer)),
+        ("task_dispatcher", spider.task_dispatcher.input_queue.qsize()),
+        ("parser_service", spider.parser_service.input_queue.qsize()),
+    ]
+    if spider.parser_service.mp_mode:
+        result.append(("parser_process", len(spider.parser_service.jobs)))
+    if spider.host_scheduler:
+        result.append(("host_scheduler", spider.host_scheduler.size()))
+    if spider.cache_reader_service:
+        result.append(
+            ("cache_reader", spider.cache_reader_service.input_queue.size())
+        )
+    if spider.cache_writer_service:
+        result.append(
+            ("cache_writer", spider.cache_writer_service.input_queue.qsize())
+        )
+    return result
+
+
+def render_metrics(spider):
+    """
+    Render metrics of the spider in OpenMetrics text format.
+
+    Metrics:
+
+    * grab_stat_total{key} - counters of `spider.stat`
+    * grab_histogram{key} - histograms of `spider.stat`, the numbers of
+      values in buckets are approximate
+    * grab_queue_size{queue} - number of items in queues of services
+    * grab_network_active - number of active network requests
+    * grab_network_threads - max. number of active network requests
+    * grab_parser_busy - 1 if any parser is processing a response
+    * grab_parser_pool_size - number of parser threads or processes
+    """
+    lines = []
+
+    def add_family(name, kind, help_text):
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+    def add_sample(name, value, **labels):
+        if labels:
+            name += "{%s}" % ",".join(
+                '%s="%s"' % (key, format_label_value(val))
+                for key, val in sorted(labels.items())
+            )
+        lines.append("%s %s" % (name, format_metric_value(value)))
+
+    add_family("grab_stat", "counter", "Counters of spider events.")
+    for key, value in sorted(spider.stat.counters.items()):
+        add_sample("grab_stat_total", value, key=key)
+    add_family("grab_histogram", "histogram", "Distributions of values.")
+    for key, hist in sorted(spider.stat.histograms.items()):
+        counts = hist.get_bucket_counts(METRICS_BUCKETS)
+        for bound, count in zip(METRICS_BUCKETS, counts):
+            add_sample("grab_histogram_bucket", count, key=key, le=repr(float(bound)))
+        add_sample("grab_histogram_bucket", hist.count, key=key, le="+Inf")
+        add_sample("grab_histogram_count", hist.count, key=key)
+        add_sample("grab_histogram_sum", float(hist.total), key=key)
+    add_family("grab_queue_size", "gauge", "Number of items in the queue.")
+    for name, size in get_queue_sizes(spider):
+        add_sample("grab_queue_size", size, queue=name)
+    add_family("grab_network_active", "gauge", "Number of active network requests.")
+    add_sample(
+        "grab_network_active", spider.network_service.get_active_threads_number()
+    )
+    add_family("grab_network_threads", "gauge", "Max. number of network requests.")
+    add_sample("grab_network_threads", spider.thread_number)
+    add_family("grab_parser_busy", "gauge", "Parser is processing a response.")
+    add_sample("grab_parser_busy", int(spider.parser_service.is_busy()))
+    add_family("grab_parser_pool_size", "gauge", "Number of parsers.")
+    add_sample("grab_parser_pool_size", spider.parser_pool_size)
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
 
 
 class ApiHandler(SimpleHTTPRequestHandler):
+    @property
+    def spider(self):
+        return self.server.spider
+
     def do_GET(self):  # pylint: disable=invalid-name
         if self.path == "/":
             self.home()
@@ -22,6 +131,8 @@ class ApiHandler(SimpleHTTPRequestHandler):
             self.api_info()
         elif self.path == "/api/stop":
             self.api_stop()
+        elif self.path == "/metrics":
+            self.metrics()
         else:
             self.not_found()
 
@@ -44,6 +155,9 @@ class ApiHandler(SimpleHTTPRequestHandler):
             "collections": dict(
                 (x, len(y)) for (x, y) in self.spider.stat.collections.items()
             ),
+            "histograms": dict(
+                (x, y.get_summary()) for (x, y) in self.spider.stat.histograms.items()
+            ),
             "thread_number": self.spider.thread_number,
             "parser_pool_size": self.spider.parser_pool_size,
             "task_queue": self.spider.task_queue.size(),
@@ -70,6 +184,10 @@ class ApiHandler(SimpleHTTPRequestHandler):
         content = make_str(json.dumps(info))
         self.response(content=content)
 
+    def metrics(self):
+        content = make_str(render_metrics(self.spider))
+        self.response(content=content, content_type=METRICS_CONTENT_TYPE)
+
     def api_stop(self):
         self.response()
         self.spider.stop()
@@ -80,8 +198,20 @@ class ApiHandler(SimpleHTTPRequestHandler):
         self.response(content=content)
 
 
-class ReuseTCPServer(TCPServer):
+class ReuseTCPServer(ThreadingMixIn, TCPServer):
+    """
+    Each request is handled in separate thread so slow client
+    does not block other requests.
+    """
+
     allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, spider):
+        # Spider is bound to the server, so multiple spiders
+        # could serve HTTP API in one process
+        self.spider = spider
+        TCPServer.__init__(self, server_address, handler_class)
 
 
 class HttpApiService(BaseService):
@@ -97,14 +227,22 @@ class HttpApiService(BaseService):
     def resume(self):
         return
 
+    def start(self):
+        # Server is created before the worker is started, so
+        # the error of binding to the port is raised by `Spider.run`
+        # and `stop` always has the server to shut down
+        self.server = ReuseTCPServer(
+            ("", self.spider.http_api_port), ApiHandler, self.spider
+        )
+        super(HttpApiService, self).start()
+
     def stop(self):
-        # It freezes
-        # if self.server:
-        #    self.server.shutdown()
-        pass
+        if self.server:
+            # Waits until `serve_forever` call of the worker is finished
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
 
     def worker_callback(self, unused_worker):
-        ApiHandler.spider = self.spider
-        self.server = ReuseTCPServer(("", self.spider.http_api_port), ApiHandler)
-        logging.debug("Serving HTTP API on localhost:%d", self.spider.http_api_port)
+        logger.debug("Serving HTTP API on localhost:%d", self.spider.http_api_port)
         self.server.serve_forever()
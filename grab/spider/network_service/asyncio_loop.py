@@ -0,0 +1,165 @@
+"""
+Network service which drives multicurl handles from an asyncio event loop.
+
+Instead of polling curl sockets with fdset/select the service registers
+curl sockets in the event loop (via `M_SOCKETFUNCTION` callback) and lets
+curl schedule its timeouts (via `M_TIMERFUNCTION` callback). Curl does
+work only for sockets which are ready, so the number of concurrent
+connections is not limited by thread count or by `select` FD_SETSIZE.
+"""
+import logging
+import sys
+
+import pycurl
+import six
+
+from grab.spider.error import SpiderMisuseError
+from grab.spider.network_service.multicurl import NetworkServiceMulticurlEvents
+
+try:
+    import asyncio
+except ImportError:  # pragma: no cover
+    asyncio = None
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.network_service.asyncio_loop")
+# pylint: enable=invalid-name
+QUEUE_POLL_INTERVAL = 0.1
+
+
+class NetworkServiceAsyncio(NetworkServiceMulticurlEvents):
+    def setup_workers(self):
+        if asyncio is None:
+            raise SpiderMisuseError(
+                "The asyncio network service requires Python 3.4+"
+            )
+        # pylint: disable=attribute-defined-outside-init
+        self.loop = None
+        self.timer_handle = None
+        self.spawn_handle = None
+        self.exc_info = None
+        self.loop_worker = self.create_worker(self.loop_callback)
+        self.register_workers(self.loop_worker)
+
+    def loop_callback(self, worker):
+        self.loop = asyncio.new_event_loop()
+        self.setup_curl_callbacks()
+        try:
+            self.schedule_spawn(worker, 0)
+            self.loop.run_forever()
+        finally:
+            self.cancel_timer()
+            self.loop.close()
+            self.loop = None
+        if self.exc_info:
+            six.reraise(*self.exc_info)
+
+    def call_guarded(self, func, *args):
+        """
+        Run callback and stop the event loop if it fails.
+
+        Exceptions raised inside event loop callbacks are just logged
+        by asyncio. The network service must fail loudly instead,
+        so the exception is saved and re-raised from `loop_callback`.
+        """
+        try:
+            func(*args)
+        except Exception:  # pylint: disable=broad-except
+            self.exc_info = sys.exc_info()
+            self.loop.stop()
+
+    # **************
+    # Task Spawning
+    # **************
+
+    def schedule_spawn(self, worker, delay):
+        if self.spawn_handle:
+            self.spawn_handle.cancel()
+        if delay:
+            self.spawn_handle = self.loop.call_later(
+                delay, self.call_guarded, self.spawn_tasks, worker
+            )
+        else:
+            self.spawn_handle = self.loop.call_soon(
+                self.call_guarded, self.spawn_tasks, worker
+            )
+
+    def spawn_tasks(self, worker):
+        self.spawn_handle = None
+        if worker.stop_event.is_set():
+            self.loop.stop()
+            return
+        worker.process_pause_signal()
+        while self.get_free_threads_number():
+            task = self.spider.get_task_from_queue()
+            if task is None or task is True:
+                self.schedule_spawn(worker, QUEUE_POLL_INTERVAL)
+                return
+            worker.is_busy_event.set()
+            try:
+                self.spawn_task(task)
+            finally:
+                worker.is_busy_event.clear()
+        # All handles are busy. The spawning will be resumed
+        # by `process_results` as soon as some handle is released
+        self.schedule_spawn(worker, QUEUE_POLL_INTERVAL)
+
+    # ***************
+    # Curl Callbacks
+    # ***************
+
+    def watch_socket(self, sock_fd, readable, writable):
+        if readable:
+            self.loop.add_reader(
+                sock_fd,
+                self.call_guarded,
+                self.process_socket_action,
+                sock_fd,
+                pycurl.CSELECT_IN,
+            )
+        else:
+            self.loop.remove_reader(sock_fd)
+        if writable:
+            self.loop.add_writer(
+                sock_fd,
+                self.call_guarded,
+                self.process_socket_action,
+                sock_fd,
+                pycurl.CSELECT_OUT,
+            )
+        else:
+            self.loop.remove_writer(sock_fd)
+
+    def set_timer(self, timeout):
+        self.cancel_timer()
+        if timeout is not None and self.loop:
+            # Curl does not allow to call `socket_action` from
+            # the timer callback, so it is always deferred
+            self.timer_handle = self.loop.call_later(
+                timeout,
+                self.call_guarded,
+                self.process_socket_action,
+                pycurl.SOCKET_TIMEOUT,
+                0,
+            )
+
+    def cancel_timer(self):
+        if self.timer_handle:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+
+    def process_socket_action(self, sock_fd, event):
+        if sock_fd == pycurl.SOCKET_TIMEOUT:
+            self.timer_handle = None
+        self.socket_action(sock_fd, event)
+        self.process_results()
+
+    def process_results(self):
+        released = False
+        for result, task in self.iterate_results():
+            self.spider.task_dispatcher.input_queue.put(
+                (result, task, None),
+            )
+            released = True
+        if released and self.spawn_handle:
+            self.schedule_spawn(self.loop_worker, 0)
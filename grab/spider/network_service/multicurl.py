@@ -133,6 +133,9 @@ class NetworkServiceMulticurl(BaseService):
             self.freelist.append(curl)
             # self.multi.handles.append(curl)
 
+        self.setup_workers()
+
+    def setup_workers(self):
         self.spawner = self.create_worker(self.spawner_callback)
         self.async_loop = self.create_worker(self.async_loop_callback)
         self.register_workers(self.spawner, self.async_loop)
@@ -153,18 +156,7 @@ class NetworkServiceMulticurl(BaseService):
                 else:
                     worker.is_busy_event.set()
                     try:
-                        task.network_try_count += 1 # pylint: disable=no-member
-                        is_valid, reason = self.spider.check_task_limits(task)
-                        if is_valid:
-                            grab = self.spider.setup_grab_for_task(task)
-                            self.spider.submit_task_to_transport(task, grab)
-                        else:
-                            self.spider.log_rejected_task(task, reason)
-                            # pylint: disable=no-member
-                            handler = task.get_fallback_handler(self.spider)
-                            # pylint: enable=no-member
-                            if handler:
-                                handler(task)
+                        self.spawn_task(task)
                     finally:
                         worker.is_busy_event.clear()
 
@@ -173,6 +165,24 @@ class NetworkServiceMulticurl(BaseService):
                     (result, task, None),
                 )
 
+    def spawn_task(self, task):
+        if self.spider.task_tracer:
+            self.spider.task_tracer.add_event(task, 'get')
+        task.network_try_count += 1 # pylint: disable=no-member
+        is_valid, reason = self.spider.check_task_limits(task)
+        if is_valid:
+            grab = self.spider.setup_grab_for_task(task)
+            self.spider.submit_task_to_transport(task, grab)
+        else:
+            self.spider.log_rejected_task(task, reason)
+            self.spider.release_task_host(task)
+            self.spider.ack_task(task)
+            # pylint: disable=no-member
+            handler = task.get_fallback_handler(self.spider)
+            # pylint: enable=no-member
+            if handler:
+                handler(task)
+
     def ready_for_task(self):
         return len(self.freelist)
 
@@ -322,6 +332,8 @@ class NetworkServiceMulticurl(BaseService):
                     error_abbr = None
                 else:
                     error_abbr = ERRNUM_TAG.get(ecode, 'unknown-%d' % ecode)
+                if self.spider.task_tracer:
+                    self.spider.task_tracer.add_event(task, 'network-end')
                 yield {
                     'ok': is_ok,
                     'ecode': ecode,
@@ -344,3 +356,59 @@ class NetworkServiceMulticurl(BaseService):
 
             if not queued_messages:
                 break
+
+
+class NetworkServiceMulticurlEvents(NetworkServiceMulticurl):
+    """
+    Base class of network services which drive multicurl with
+    `socket_action` API from some event loop.
+
+    Curl reports which sockets it wants to watch via `M_SOCKETFUNCTION`
+    callback and schedules its timeouts via `M_TIMERFUNCTION` callback.
+    Subclasses implement `watch_socket` and `set_timer` with their
+    event loop and call `socket_action` when the socket is ready
+    or the timer has expired.
+    """
+
+    def setup_curl_callbacks(self):
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.handle_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.handle_timer)
+
+    def watch_socket(self, sock_fd, readable, writable):
+        """
+        Start or stop watching the socket, stop watching
+        if both `readable` and `writable` are False.
+        """
+        raise NotImplementedError
+
+    def set_timer(self, timeout):
+        """
+        Schedule `socket_action(pycurl.SOCKET_TIMEOUT, 0)` call after
+        `timeout` seconds, cancel the timer if `timeout` is None.
+        """
+        raise NotImplementedError
+
+    def socket_action(self, sock_fd, action):
+        while True:
+            with self.sigint_handler.handle_sigint():
+                status, _ = self.multi.socket_action(sock_fd, action)
+            if status != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+    # ***************
+    # Curl Callbacks
+    # ***************
+
+    def handle_socket(self, event, sock_fd, unused_multi, unused_data):
+        if event == pycurl.POLL_REMOVE:
+            self.watch_socket(sock_fd, False, False)
+        else:
+            self.watch_socket(
+                sock_fd, bool(event & pycurl.POLL_IN), bool(event & pycurl.POLL_OUT)
+            )
+
+    def handle_timer(self, timeout_ms):
+        if timeout_ms < 0:
+            self.set_timer(None)
+        else:
+            self.set_timer(timeout_ms / 1000.0)
@@ -0,0 +1,140 @@
+"""
+Network service which drives multicurl handles with `socket_action` API.
+
+The `NetworkServiceMulticurl` service calls `multi.fdset()`, `select` and
+`multi.perform()` which process all curl handles on each iteration.
+This service registers curl sockets in the selector (epoll on Linux) via
+`M_SOCKETFUNCTION` callback and lets curl schedule its timeouts via
+`M_TIMERFUNCTION` callback. Curl is notified only about sockets which
+are ready. Task spawning, network operations and processing of results
+are done in one thread, so no sleeps are required between them.
+"""
+import logging
+import time
+
+import pycurl
+
+from grab.spider.error import SpiderMisuseError
+from grab.spider.network_service.multicurl import NetworkServiceMulticurlEvents
+
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    selectors = None
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.network_service.multicurl_socket")
+# pylint: enable=invalid-name
+# How often to check the task queue if there are free curl handles
+QUEUE_POLL_INTERVAL = 0.1
+# Max. time to wait for socket events, stop signal is checked after that
+MAX_SELECT_TIMEOUT = 1.0
+
+
+class NetworkServiceMulticurlSocket(NetworkServiceMulticurlEvents):
+    def setup_workers(self):
+        if selectors is None:
+            raise SpiderMisuseError(
+                "The multicurl-socket network service requires"
+                " selectors module (Python 3.4+)"
+            )
+        # pylint: disable=attribute-defined-outside-init
+        self.selector = None
+        self.timer_deadline = None
+        self.loop_worker = self.create_worker(self.loop_callback)
+        self.register_workers(self.loop_worker)
+
+    def loop_callback(self, worker):
+        self.selector = selectors.DefaultSelector()
+        self.setup_curl_callbacks()
+        try:
+            while not worker.stop_event.is_set():
+                worker.process_pause_signal()
+                self.spawn_tasks(worker)
+                self.process_events(self.get_select_timeout())
+                self.process_results()
+        finally:
+            self.selector.close()
+            self.selector = None
+
+    def spawn_tasks(self, worker):
+        while self.get_free_threads_number():
+            task = self.spider.get_task_from_queue()
+            if task is None or task is True:
+                break
+            worker.is_busy_event.set()
+            try:
+                self.spawn_task(task)
+            finally:
+                worker.is_busy_event.clear()
+
+    def get_select_timeout(self):
+        # If there are free curl handles then the task queue is empty,
+        # otherwise `spawn_tasks` would use them. Free handles could
+        # appear only after processing of socket events so there is
+        # no need to check the queue often if all handles are busy
+        if self.get_free_threads_number():
+            timeout = QUEUE_POLL_INTERVAL
+        else:
+            timeout = MAX_SELECT_TIMEOUT
+        if self.timer_deadline is not None:
+            timeout = min(timeout, max(0, self.timer_deadline - time.time()))
+        return timeout
+
+    def process_events(self, timeout):
+        if self.selector.get_map():
+            events = self.selector.select(timeout)
+        else:
+            # Some selectors (e.g. select on Windows) fail if
+            # there is no registered file objects
+            events = []
+            if timeout:
+                time.sleep(timeout)
+        for key, mask in events:
+            action = 0
+            if mask & selectors.EVENT_READ:
+                action |= pycurl.CSELECT_IN
+            if mask & selectors.EVENT_WRITE:
+                action |= pycurl.CSELECT_OUT
+            self.socket_action(key.fd, action)
+        if (self.timer_deadline is not None
+                and self.timer_deadline <= time.time()):
+            self.timer_deadline = None
+            self.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+
+    def process_results(self):
+        for result, task in self.iterate_results():
+            self.spider.task_dispatcher.input_queue.put(
+                (result, task, None),
+            )
+
+    # ***************
+    # Curl Callbacks
+    # ***************
+
+    def watch_socket(self, sock_fd, readable, writable):
+        mask = 0
+        if readable:
+            mask |= selectors.EVENT_READ
+        if writable:
+            mask |= selectors.EVENT_WRITE
+        if not mask:
+            if sock_fd in self.selector.get_map():
+                self.selector.unregister(sock_fd)
+            return
+        if sock_fd in self.selector.get_map():
+            try:
+                self.selector.modify(sock_fd, mask)
+            except (OSError, IOError, ValueError):
+                # Socket was closed and the descriptor was reused
+                # before curl reported POLL_REMOVE for it
+                self.selector.unregister(sock_fd)
+                self.selector.register(sock_fd, mask)
+        else:
+            self.selector.register(sock_fd, mask)
+
+    def set_timer(self, timeout):
+        if timeout is None:
+            self.timer_deadline = None
+        else:
+            self.timer_deadline = time.time() + timeout
@@ -40,6 +40,9 @@ class NetworkServiceThreaded(BaseService):
                     time.sleep(0.1)
                 else:
                     worker.is_busy_event.set()
+                    tracer = self.spider.task_tracer
+                    if tracer:
+                        tracer.add_event(task, 'get')
                     try:
                         task.network_try_count += 1 # pylint: disable=no-member
                         is_valid, reason = self.spider.check_task_limits(task)
@@ -52,9 +55,14 @@ class NetworkServiceThreaded(BaseService):
                                     'spider:'
                                     'request-network-disabled-only-cache'
                                 )
+                                self.spider.release_task_host(task)
+                                self.spider.ack_task(task)
                             else:
                                 grab_config_backup = grab.dump_config()
                                 self.spider.process_grab_proxy(task, grab)
+                                self.spider.process_grab_cache_validators(
+                                    task, grab
+                                )
                                 self.spider.stat.inc('spider:request-network')
                                 self.spider.stat.inc(
                                     'spider:task-%s-network' % task.name
@@ -74,6 +82,8 @@ class NetworkServiceThreaded(BaseService):
                                         'task': task,
                                         'exc': None
                                     }
+                                    if tracer:
+                                        tracer.add_event(task, 'network-start')
                                     try:
                                         grab.request()
                                     except (
@@ -110,6 +120,8 @@ class NetworkServiceThreaded(BaseService):
                                                 )
                                             ),
                                         })
+                                    if tracer:
+                                        tracer.add_event(task, 'network-end')
                                     (self.spider.task_dispatcher
                                      .input_queue.put((result, task, None)))
                                 finally:
@@ -117,6 +129,8 @@ class NetworkServiceThreaded(BaseService):
                                     #self.freelist.append(1)
                         else:
                             self.spider.log_rejected_task(task, reason)
+                            self.spider.release_task_host(task)
+                            self.spider.ack_task(task)
                             # pylint: disable=no-member
                             handler = task.get_fallback_handler(self.spider)
                             # pylint: enable=no-member
@@ -1,26 +1,334 @@
+import itertools
+import logging
+import multiprocessing
+from multiprocessing.connection import Client, Listener
+import os
+import select
+import signal
 import time
+from threading import Lock
 from traceback import format_exc
 import sys
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 from six.moves.queue import Queue
 from six.moves import queue
 
+from grab.document import Document
 from grab.spider.base_service import BaseService
-from grab.spider.error import NoTaskHandler
+from grab.spider.error import NoTaskHandler, SpiderError, SpiderMisuseError
+from grab.stat import Stat
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.parser_service")
+# pylint: enable=invalid-name
+# Document attributes which are not passed to parser process
+# Cached DOM objects could not be pickled and they will be
+# built again in the parser process
+DOCUMENT_SKIP_SLOTS = (
+    "grab",
+    "_grab_config",
+    "_unicode_body",
+    "_lxml_tree",
+    "_strict_lxml_tree",
+    "_pyquery",
+    "_lxml_form",
+    "_file_fields",
+)
+GRAB_STATE_SLOTS = (
+    "request_head",
+    "request_body",
+    "request_method",
+    "request_counter",
+    "cookies",
+    "meta",
+)
+
+
+def get_mp_context():
+    """
+    Return multiprocessing context which creates processes with fork.
+
+    Parser processes get copy of spider instance so the task handlers
+    and all spider attributes are available in them. That works only
+    with "fork" start method.
+    """
+    if hasattr(multiprocessing, "get_context"):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise SpiderMisuseError(
+                "Multiprocess parser mode requires the fork start method"
+            )
+        return multiprocessing.get_context("fork")
+    if sys.platform == "win32":
+        raise SpiderMisuseError(
+            "Multiprocess parser mode requires the fork start method"
+        )
+    return multiprocessing
+
+
+def build_response_state(grab):
+    """
+    Build picklable state of network response stored in the grab.
+    """
+    doc = grab.doc
+    doc_state = {}
+    for slot in Document.__slots__:
+        if slot not in DOCUMENT_SKIP_SLOTS and hasattr(doc, slot):
+            doc_state[slot] = getattr(doc, slot)
+    grab_state = dict((x, getattr(grab, x)) for x in GRAB_STATE_SLOTS)
+    return {
+        "config": grab.dump_config(),
+        "grab": grab_state,
+        "doc": doc_state,
+    }
+
+
+def restore_response(spider, state):
+    """
+    Build Grab instance from the state created by `build_response_state`.
+    """
+    grab = spider.create_grab_instance()
+    grab.load_config(state["config"])
+    for key, value in state["grab"].items():
+        setattr(grab, key, value)
+    doc = Document()
+    for key, value in state["doc"].items():
+        setattr(doc, key, value)
+    doc.process_grab(grab)
+    grab.doc = doc
+    return grab
+
+
+def observe_handler_time(stat, task, elapsed):
+    """
+    Add time of task handler execution (generator handlers included)
+    to histograms.
+    """
+    stat.observe("parser:handler-time", elapsed)
+    stat.observe("parser:handler-time-%s" % task.name, elapsed)
+
+
+def parser_process_main(spider, address, authkey, requests_limit):
+    """
+    Main loop of the parser process.
+
+    Connects to the spider process, gets responses from the connection,
+    runs task handlers and sends all results back via same connection.
+    Changes of spider attributes made inside handlers are not visible
+    in the spider process, only `spider.stat` changes are sent back.
+    """
+    spider.stat = Stat(logging_period=0)
+    conn = Client(address, authkey=authkey)
+    job = {"id": None}
+
+    def send(msg):
+        try:
+            data = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+        except Exception as ex:  # pylint: disable=broad-except
+            error = SpiderError(
+                "Could not send %r to spider process: %s" % (msg[2], ex)
+            )
+            data = pickle.dumps(
+                ("error", msg[1], error, format_exc()), pickle.HIGHEST_PROTOCOL
+            )
+        conn.send_bytes(data)
+
+    # pylint: disable=unused-argument
+    def add_task(task, queue=None, raise_error=False):
+        send(("item", job["id"], task))
+        return True
+
+    # pylint: enable=unused-argument
+    spider.add_task = add_task
+    spider.prepare_parser()
+    # Spider process starts to send responses to the process
+    # only after it has been prepared
+    send(("hello", None, os.getpid()))
+    process_request_count = 0
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except EOFError:
+            # Spider process has closed the connection
+            break
+        msg = pickle.loads(data)
+        if msg is None:
+            break
+        job["id"], task, state = msg
+        process_request_count += 1
+        handler_found = True
+        try:
+            handler = spider.find_task_handler(task)
+        except NoTaskHandler as ex:
+            handler_found = False
+            send(("error", job["id"], ex, format_exc()))
+        else:
+            try:
+                grab = restore_response(spider, state)
+                started = time.time()
+                try:
+                    handler_result = handler(grab, task)
+                    if handler_result is not None:
+                        for item in handler_result:
+                            send(("item", job["id"], item))
+                finally:
+                    observe_handler_time(spider.stat, task, time.time() - started)
+            except Exception as ex:  # pylint: disable=broad-except
+                send(("error", job["id"], ex, format_exc()))
+        limit_reached = bool(
+            requests_limit and process_request_count >= requests_limit
+        )
+        if limit_reached:
+            spider.stat.inc("parser:handler-req-limit")
+        send(
+            (
+                "done",
+                job["id"],
+                handler_found,
+                dict(spider.stat.counters),
+                dict(spider.stat.collections),
+                spider.stat.histograms,
+                limit_reached,
+            )
+        )
+        spider.stat.reset()
+        if limit_reached:
+            break
+    conn.close()
+
+
+def fork_parser_process(spider, address, authkey, requests_limit):
+    """
+    Fork new parser process, return its pid.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    exit_code = 1
+    try:
+        parser_process_main(spider, address, authkey, requests_limit)
+        exit_code = 0
+    except Exception:  # pylint: disable=broad-except
+        logger.error("Parser process fatal error", exc_info=True)
+    finally:
+        # Do not run any cleanup inherited from the parent process
+        os._exit(exit_code)  # pylint: disable=protected-access
+
+
+def fork_server_main(spider, control_conn, address, authkey, pool_size,
+                     requests_limit):
+    """
+    Main loop of the fork server process.
+
+    The fork server is started before any thread of the spider process
+    and it does nothing else than forking parser processes: it keeps
+    `pool_size` processes running and starts new process when one exits.
+    So all parser processes are forked from the single-threaded process
+    and they get copy of the spider instance made at the start of the
+    spider. The fork server exits when it gets the stop message from
+    `control_conn` or when the spider process dies.
+    """
+    # Spider process is responsible for handling of Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pids = set()
+    while True:
+        while pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            pids.discard(pid)
+            if os.WIFSIGNALED(status):
+                logger.error(
+                    "Parser process %d killed by signal %d",
+                    pid,
+                    os.WTERMSIG(status),
+                )
+            elif os.WEXITSTATUS(status):
+                logger.error(
+                    "Parser process %d died with exit code %d",
+                    pid,
+                    os.WEXITSTATUS(status),
+                )
+        while len(pids) < pool_size:
+            pids.add(fork_parser_process(spider, address, authkey, requests_limit))
+        try:
+            if control_conn.poll(0.1):
+                control_conn.recv()
+                break
+        except (EOFError, IOError, OSError):
+            break
+    # Parser processes exit when the spider process closes
+    # their connections
+    deadline = time.time() + 2
+    while pids and time.time() < deadline:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            pids.discard(pid)
+        else:
+            time.sleep(0.05)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
 
 
 class ParserService(BaseService):
-    def __init__(self, spider, pool_size):
+    def __init__(self, spider, pool_size, mp_mode=False):
         self.spider = spider
         self.input_queue = Queue()
         self.pool_size = pool_size
+        self.mp_mode = mp_mode
         self.workers_pool = []
-        for _ in range(self.pool_size):
-            self.workers_pool.append(self.create_worker(self.worker_callback))
+        if self.mp_mode:
+            self.mp_context = get_mp_context()
+            self.fork_server = None
+            self.control_conn = None
+            self.listener = None
+            self.authkey = None
+            # connection of parser process -> id of the job which has been
+            # sent to the process, None if the process is idle
+            self.connections = {}
+            self.idle_connections = Queue()
+            self.jobs = {}
+            self.job_counter = itertools.count(1)
+            self.jobs_lock = Lock()
+            self.workers_pool.append(self.create_worker(self.feeder_callback))
+            self.workers_pool.append(self.create_worker(self.collector_callback))
+            # Acceptor blocks in `accept()` so it could not be paused and
+            # it is not registered as a service worker
+            self.acceptor = self.create_worker(self.acceptor_callback)
+        else:
+            for _ in range(self.pool_size):
+                self.workers_pool.append(self.create_worker(self.worker_callback))
         self.supervisor = self.create_worker(self.supervisor_callback)
         self.register_workers(self.workers_pool, self.supervisor)
 
+    def start(self):
+        if self.mp_mode:
+            # Fork server is started before any worker thread is started
+            self.start_fork_server()
+            self.acceptor.start()
+        super(ParserService, self).start()
+
+    def stop(self):
+        super(ParserService, self).stop()
+        if self.mp_mode:
+            self.stop_fork_server()
+
+    def is_busy(self):
+        if self.mp_mode and self.jobs:
+            return True
+        return super(ParserService, self).is_busy()
+
     def check_pool_health(self):
+        if self.mp_mode:
+            self.check_process_pool_health()
+            return
         to_remove = []
         for worker in self.workers_pool:
             if not worker.is_alive():
@@ -50,17 +358,7 @@ class ParserService(BaseService):
                 worker.is_busy_event.set()
                 try:
                     process_request_count += 1
-                    try:
-                        handler = self.spider.find_task_handler(task)
-                    except NoTaskHandler as ex:
-                        ex.tb = format_exc()
-                        self.spider.task_dispatcher.input_queue.put(
-                            (ex, task, {'exc_info': sys.exc_info()})
-                        )
-                        self.spider.stat.inc('parser:handler-not-found')
-                    else:
-                        self.execute_task_handler(handler, result, task)
-                        self.spider.stat.inc('parser:handler-processed')
+                    self.process_request(result, task)
                     if self.spider.parser_requests_per_process:
                         if (process_request_count >=
                                 self.spider.parser_requests_per_process):
@@ -71,8 +369,34 @@ class ParserService(BaseService):
                 finally:
                     worker.is_busy_event.clear()
 
+    def process_request(self, result, task):
+        tracer = self.spider.task_tracer
+        if tracer:
+            tracer.add_event(task, 'parser-start')
+        try:
+            handler = self.spider.find_task_handler(task)
+        except NoTaskHandler as ex:
+            ex.tb = format_exc()
+            self.spider.task_dispatcher.input_queue.put(
+                (ex, task, {'exc_info': sys.exc_info()})
+            )
+            self.spider.stat.inc('parser:handler-not-found')
+        else:
+            self.execute_task_handler(handler, result, task)
+            self.spider.stat.inc('parser:handler-processed')
+        if tracer:
+            tracer.add_event(task, 'parser-end')
+        self.ack_task(task)
+
+    def ack_task(self, task):
+        # Task is acknowledged by the task dispatcher after it has
+        # processed all results of the task handler, so new tasks
+        # yielded by the handler are put into the task queue before
+        self.spider.task_dispatcher.input_queue.put((None, task, {'ack': True}))
+
     def execute_task_handler(self, handler, result, task):
         # pylint: disable=broad-except
+        started = time.time()
         try:
             handler_result = handler(result['grab'], task)
             if handler_result is None:
@@ -87,3 +411,240 @@ class ParserService(BaseService):
                 'exc_info': sys.exc_info(),
                 'from': 'parser',
             }))
+        finally:
+            observe_handler_time(self.spider.stat, task, time.time() - started)
+
+    # *********************
+    # Multiprocess Mode
+    # *********************
+
+    def start_fork_server(self):
+        self.authkey = os.urandom(16)
+        self.listener = Listener(
+            backlog=max(self.pool_size, 16), authkey=self.authkey
+        )
+        control_reader, self.control_conn = self.mp_context.Pipe(duplex=False)
+        self.fork_server = self.mp_context.Process(
+            target=fork_server_main,
+            args=(
+                self.spider,
+                control_reader,
+                self.listener.address,
+                self.authkey,
+                self.pool_size,
+                self.spider.parser_requests_per_process,
+            ),
+        )
+        self.fork_server.daemon = True
+        self.fork_server.start()
+        control_reader.close()
+
+    def stop_fork_server(self):
+        self.acceptor.stop()
+        try:
+            self.control_conn.send(None)
+        except (IOError, OSError):
+            pass
+        with self.jobs_lock:
+            conns = list(self.connections)
+            self.connections.clear()
+        for conn in conns:
+            try:
+                conn.send_bytes(pickle.dumps(None, pickle.HIGHEST_PROTOCOL))
+            except (IOError, OSError):
+                pass
+            conn.close()
+        self.fork_server.join(3)
+        if self.fork_server.is_alive():
+            self.fork_server.terminate()
+        self.control_conn.close()
+        # Wake up the acceptor blocked in `accept()`
+        try:
+            Client(self.listener.address, authkey=self.authkey).close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        self.acceptor.thread.join(1)
+        self.listener.close()
+
+    def check_process_pool_health(self):
+        if (
+            not self.fork_server.is_alive()
+            and not self.supervisor.stop_event.is_set()
+        ):
+            raise SpiderError(
+                "Parser fork server died with exit code %s"
+                % self.fork_server.exitcode
+            )
+
+    def acceptor_callback(self, worker):
+        while not worker.stop_event.is_set():
+            try:
+                conn = self.listener.accept()
+                kind, _, pid = pickle.loads(conn.recv_bytes())
+            except Exception:  # pylint: disable=broad-except
+                # Connection has failed authentication or
+                # the process has died right after connecting
+                continue
+            if worker.stop_event.is_set():
+                conn.close()
+                break
+            assert kind == "hello"
+            logger.debug("Parser process %d is ready", pid)
+            with self.jobs_lock:
+                self.connections[conn] = None
+            self.idle_connections.put(conn)
+
+    def close_connection(self, conn):
+        """
+        Handle exit of the parser process.
+
+        If the process has exited (or died) with the job in progress
+        then the task of the job is failed.
+        """
+        with self.jobs_lock:
+            if conn not in self.connections:
+                return
+            job_id = self.connections.pop(conn)
+            task = self.jobs.pop(job_id, None)
+        conn.close()
+        self.spider.stat.inc('parser:worker-restarted')
+        if task is not None:
+            logger.error("Parser process died while processing %s", task)
+            try:
+                raise SpiderError("Parser process died")
+            except SpiderError as ex:
+                self.spider.task_dispatcher.input_queue.put((ex, task, {
+                    'exc_info': sys.exc_info(),
+                    'from': 'parser',
+                }))
+            self.ack_task(task)
+
+    def feeder_callback(self, worker):
+        while not worker.stop_event.is_set():
+            worker.process_pause_signal()
+            try:
+                result, task = self.input_queue.get(True, 0.1)
+            except queue.Empty:
+                pass
+            else:
+                worker.is_busy_event.set()
+                try:
+                    self.submit_to_parser_process(result, task, worker)
+                finally:
+                    worker.is_busy_event.clear()
+
+    def submit_to_parser_process(self, result, task, worker):
+        job_id = next(self.job_counter)
+        try:
+            data = pickle.dumps(
+                (job_id, task, build_response_state(result['grab'])),
+                pickle.HIGHEST_PROTOCOL,
+            )
+        except Exception as ex:  # pylint: disable=broad-except
+            # For example, the task has `callback` attribute which
+            # refers to method of spider instance
+            logger.debug(
+                "Could not pass task %s to parser process: %s", task, ex
+            )
+            self.spider.stat.inc('parser:handler-process-fallback')
+            self.process_request(result, task)
+            return
+        if self.spider.task_tracer:
+            self.spider.task_tracer.add_event(task, 'parser-start')
+        with self.jobs_lock:
+            self.jobs[job_id] = task
+        while not worker.stop_event.is_set():
+            worker.process_pause_signal()
+            try:
+                conn = self.idle_connections.get(True, 0.1)
+            except queue.Empty:
+                continue
+            with self.jobs_lock:
+                if conn not in self.connections:
+                    # Process has exited
+                    continue
+                self.connections[conn] = job_id
+            try:
+                conn.send_bytes(data)
+            except (IOError, OSError):
+                # Process has died before it got the job,
+                # try to send the job to another process
+                with self.jobs_lock:
+                    if conn in self.connections:
+                        self.connections[conn] = None
+                    # Job could be already failed by the collector
+                    failed = job_id not in self.jobs
+                self.close_connection(conn)
+                if failed:
+                    return
+            else:
+                return
+
+    def collector_callback(self, worker):
+        while not worker.stop_event.is_set():
+            worker.process_pause_signal()
+            with self.jobs_lock:
+                conns = list(self.connections)
+            if not conns:
+                time.sleep(0.1)
+                continue
+            try:
+                ready = select.select(conns, [], [], 0.1)[0]
+            except (ValueError, IOError, OSError, select.error):
+                # Some connection has been closed in other thread
+                continue
+            for conn in ready:
+                worker.is_busy_event.set()
+                try:
+                    try:
+                        data = conn.recv_bytes()
+                    except (EOFError, IOError, OSError):
+                        self.close_connection(conn)
+                    else:
+                        self.process_parser_message(conn, pickle.loads(data))
+                finally:
+                    worker.is_busy_event.clear()
+
+    def process_parser_message(self, conn, msg):
+        kind, job_id = msg[:2]
+        with self.jobs_lock:
+            task = self.jobs.get(job_id)
+        if kind == "item":
+            self.spider.task_dispatcher.input_queue.put((msg[2], task, None))
+        elif kind == "error":
+            ex, ex_tb = msg[2:]
+            # Traceback object could not be sent between processes
+            # so its text representation is used
+            ex.tb = ex_tb
+            self.spider.task_dispatcher.input_queue.put((ex, task, {
+                'exc_info': (ex.__class__, ex, None),
+                'from': 'parser',
+            }))
+        elif kind == "done":
+            handler_found, counters, collections, histograms, closing = msg[2:]
+            for key, value in counters.items():
+                self.spider.stat.inc(key, value)
+            for key, values in collections.items():
+                for value in values:
+                    self.spider.stat.collect(key, value)
+            for key, hist in histograms.items():
+                self.spider.stat.merge_histogram(key, hist)
+            if handler_found:
+                self.spider.stat.inc('parser:handler-processed')
+            else:
+                self.spider.stat.inc('parser:handler-not-found')
+            with self.jobs_lock:
+                self.jobs.pop(job_id, None)
+                if conn in self.connections:
+                    self.connections[conn] = None
+                    ready = True
+                else:
+                    ready = False
+            # Process which has reached the requests limit exits
+            # and it must not get new jobs
+            if ready and not closing:
+                self.idle_connections.put(conn)
+            if task is not None:
+                if self.spider.task_tracer:
+                    self.spider.task_tracer.add_event(task, 'parser-end')
+                self.ack_task(task)
@@ -1,6 +1,7 @@
 """
 QueueInterface defines interface of queue backend.
 """
+from six.moves.queue import Empty
 
 
 class QueueInterface(object):
@@ -10,6 +11,18 @@ class QueueInterface(object):
     def put(self, task, priority, schedule_time=None):
         raise NotImplementedError
 
+    def put_many(self, items):
+        """
+        Put multiple tasks into the queue.
+
+        Backends which could put all tasks with one request to the storage
+        should override this method.
+
+        @param items: list of (task, priority, schedule_time) tuples
+        """
+        for task, priority, schedule_time in items:
+            self.put(task, priority, schedule_time=schedule_time)
+
     def get(self):
         """
         Return `Task` object or raise `Queue.Empty` exception
@@ -19,6 +32,44 @@ class QueueInterface(object):
         """
         raise NotImplementedError
 
+    def get_many(self, count):
+        """
+        Return list of at most `count` tasks.
+
+        Backends which could get multiple tasks with one request to
+        the storage should override this method.
+
+        @returns: list of `grab.spider.task.Task` objects, the list is
+            empty if there is no task which is ready to be processed
+        """
+        tasks = []
+        for _ in range(count):
+            try:
+                tasks.append(self.get())
+            except Empty:
+                break
+        return tasks
+
+    def ack(self, task):
+        """
+        Notify the queue that the task taken from it has been
+        completely processed.
+
+        Only queues which keep taken tasks until they are acknowledged
+        need to override this method.
+        """
+
+    def renew_leases(self):
+        """
+        Extend leases of tasks which have been taken from the queue
+        and have not been acknowledged yet.
+
+        The spider calls this method periodically while it works,
+        so tasks which wait in buffers or are processed for a long time
+        are not returned to the queue. Only queues which lease taken
+        tasks need to override this method.
+        """
+
     def size(self):
         raise NotImplementedError
 
@@ -1,4 +1,7 @@
 from datetime import datetime
+import heapq
+import itertools
+from threading import Lock
 try:
     from Queue import PriorityQueue, Empty
 except ImportError:
@@ -11,27 +14,30 @@ class QueueBackend(QueueInterface):
     def __init__(self, spider_name, **kwargs):
         super(QueueBackend, self).__init__(spider_name, **kwargs)
         self.queue_object = PriorityQueue()
+        # Heap of (schedule_time, sequence number, task) items
+        # Sequence number keeps the order of tasks with same schedule
+        # time and prevents the comparison of task objects
         self.schedule_list = []
+        self.schedule_counter = itertools.count()
+        self.schedule_lock = Lock()
 
     def put(self, task, priority, schedule_time=None):
         if schedule_time is None:
             self.queue_object.put((priority, task))
         else:
-            self.schedule_list.append((schedule_time, task))
+            with self.schedule_lock:
+                heapq.heappush(
+                    self.schedule_list,
+                    (schedule_time, next(self.schedule_counter), task),
+                )
 
     def get(self):
-        now = datetime.utcnow()
-
-        removed_indexes = []
-        index = 0
-        for schedule_time, task in self.schedule_list:
-            if schedule_time <= now:
-                self.put(task, 1)
-                removed_indexes.append(index)
-            index += 1
-
-        self.schedule_list = [x for idx, x in enumerate(self.schedule_list)
-                              if idx not in removed_indexes]
+        if self.schedule_list:
+            now = datetime.utcnow()
+            with self.schedule_lock:
+                while self.schedule_list and self.schedule_list[0][0] <= now:
+                    _, _, task = heapq.heappop(self.schedule_list)
+                    self.queue_object.put((1, task))
 
         _, task = self.queue_object.get(block=False)
         return task
@@ -45,7 +51,8 @@ class QueueBackend(QueueInterface):
                 self.queue_object.get(False)
         except Empty:
             pass
-        self.schedule_list = []
+        with self.schedule_lock:
+            self.schedule_list = []
 
     def close(self):
         pass
@@ -2,22 +2,22 @@ try:
     import Queue as queue
 except ImportError:
     import queue
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pymongo
-from bson import Binary
+from bson import Binary, ObjectId
 
 from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.task import deserialize_task, serialize_task
 
 # pylint: disable=invalid-name
 logger = logging.getLogger("grab.spider.queue_backend.mongodb")
 # pylint: enable=invalid-name
+# Documents claimed by `get_many` are deleted right after they are read.
+# If the consumer dies between these requests then claimed documents
+# are returned to the queue after this number of seconds.
+CLAIM_TIMEOUT = 60
 
 
 class QueueBackend(QueueInterface):
@@ -32,6 +32,9 @@ class QueueBackend(QueueInterface):
         self.init_kwargs = kwargs
         self.connection, self.collection = self.connect()
         self.collection.create_index("priority")
+        # Only claimed tasks have these fields, see `get_many`
+        self.collection.create_index("claim", sparse=True)
+        self.collection.create_index("claim_time", sparse=True)
         logger.debug("Using collection: %s", self.collection)
         super(QueueBackend, self).__init__(spider_name, **kwargs)
 
@@ -51,21 +54,71 @@ class QueueBackend(QueueInterface):
             schedule_time = datetime.utcnow()
 
         item = {
-            "task": Binary(pickle.dumps(task)),
+            "task": Binary(serialize_task(task)),
             "priority": priority,
             "schedule_time": schedule_time,
         }
         self.collection.insert_one(item)
 
+    def put_many(self, items):
+        docs = []
+        now = datetime.utcnow()
+        for task, priority, schedule_time in items:
+            docs.append(
+                {
+                    "task": Binary(serialize_task(task)),
+                    "priority": priority,
+                    "schedule_time": now if schedule_time is None else schedule_time,
+                }
+            )
+        if docs:
+            self.collection.insert_many(docs, ordered=False)
+
     def get(self):
         item = self.collection.find_one_and_delete(
-            {"schedule_time": {"$lt": datetime.utcnow()}},
+            {"schedule_time": {"$lt": datetime.utcnow()}, "claim": None},
             sort=[("priority", pymongo.ASCENDING)],
         )
         if item is None:
             raise queue.Empty()
         else:
-            return pickle.loads(item["task"])
+            return deserialize_task(item["task"])
+
+    def get_many(self, count):
+        """
+        Claim and return at most `count` tasks with constant number
+        of requests to the database.
+
+        Documents are marked with unique claim token first, so if multiple
+        consumers select same documents each document is returned only
+        to the consumer which has claimed it. Stale claims are released,
+        see `CLAIM_TIMEOUT`.
+        """
+        now = datetime.utcnow()
+        self.collection.update_many(
+            {"claim_time": {"$lt": now - timedelta(seconds=CLAIM_TIMEOUT)}},
+            {"$unset": {"claim": "", "claim_time": ""}},
+        )
+        ids = [
+            x["_id"]
+            for x in self.collection.find(
+                {"schedule_time": {"$lt": now}, "claim": None},
+                {"_id": 1},
+                sort=[("priority", pymongo.ASCENDING)],
+                limit=count,
+            )
+        ]
+        if not ids:
+            return []
+        token = ObjectId()
+        self.collection.update_many(
+            {"_id": {"$in": ids}, "claim": None},
+            {"$set": {"claim": token, "claim_time": now}},
+        )
+        items = list(self.collection.find({"claim": token}))
+        self.collection.delete_many({"claim": token})
+        items.sort(key=lambda x: x["priority"])
+        return [deserialize_task(x["task"]) for x in items]
 
     def clear(self):
         self.collection.delete_many({})
@@ -1,5 +1,14 @@
 """
 Spider task queue backend powered by redis
+
+In reliable mode (`reliable=True`) the task is not removed from redis
+when it is taken from the queue. It is moved into the set of processing
+tasks with the lease which expires in `lease_timeout` seconds. The spider
+acknowledges the task when it is completely processed. Tasks with expired
+leases (e.g. taken by the spider process which has died) are moved back
+to the queue. That allows multiple spider processes to share one queue.
+Leases of tasks which are held by the spider (including tasks waiting
+in the spider's buffers) are renewed every `lease_timeout / 3` seconds.
 """
 try:
     import Queue as queue
@@ -7,14 +16,39 @@ except ImportError:
     import queue
 
 import logging
-import pickle
-import random
+import os
+from threading import Lock
+import time
 
 from fastrq.priorityqueue import PriorityQueue
 from redis import StrictRedis
 
 from grab.spider.error import SpiderMisuseError
 from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.task import deserialize_task, serialize_task
+
+# Size of random suffix which is added to each serialized task
+# This is required because sorted set does not allow to store
+# multiple equal values
+NONCE_SIZE = 8
+DEFAULT_LEASE_TIMEOUT = 600
+# KEYS: queue, processing set, priority hash
+# ARGV: max. number of tasks, current time, lease expiration time
+CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+for _, member in ipairs(expired) do
+    local priority = redis.call('HGET', KEYS[3], member)
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], priority or 0, member)
+end
+local items = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1, 'WITHSCORES')
+for idx = 1, #items, 2 do
+    redis.call('ZREM', KEYS[1], items[idx])
+    redis.call('ZADD', KEYS[2], ARGV[3], items[idx])
+    redis.call('HSET', KEYS[3], items[idx], items[idx + 1])
+end
+return items
+"""
 
 
 class CustomPriorityQueue(PriorityQueue):
@@ -30,43 +64,148 @@ class CustomPriorityQueue(PriorityQueue):
         return self._redis
 
     def clear(self):
-        if self._redis:
-            self._redis.delete(self._key)
+        self.connect().delete(self._key)
 
 
 class QueueBackend(QueueInterface):
-    def __init__(self, spider_name, queue_name=None, **kwargs):
+    def __init__(
+        self,
+        spider_name,
+        queue_name=None,
+        reliable=False,
+        lease_timeout=DEFAULT_LEASE_TIMEOUT,
+        **kwargs
+    ):
         super(QueueBackend, self).__init__(spider_name, **kwargs)
         self.spider_name = spider_name
         if queue_name is None:
             queue_name = "task_queue_%s" % spider_name
         self.queue_name = queue_name
         self.queue_object = CustomPriorityQueue(queue_name, **kwargs)
+        self.reliable = reliable
+        self.lease_timeout = lease_timeout
+        self.processing_key = "%s:processing" % queue_name
+        self.priority_key = "%s:priority" % queue_name
+        self.claim_script = None
+        # id(task) -> redis member, for tasks which are not acknowledged
+        self.leased_members = {}
+        self.leased_members_lock = Lock()
+        self.next_renew_time = 0
         logging.debug("Redis queue key: %s", self.queue_name)
 
     def put(self, task, priority, schedule_time=None):
         if schedule_time is not None:
             raise SpiderMisuseError("Redis task queue does not support " "delayed task")
-        # Add attribute with random value
-        # This is required because qr library
-        # does not allow to store multiple values with same hash
-        # in the PriorityQueue
+        self.queue_object.push({self.pack_task(task): priority})
 
-        task.redis_qr_rnd = random.random()
-        self.queue_object.push({pickle.dumps(task): priority})
+    def put_many(self, items):
+        members = {}
+        for task, priority, schedule_time in items:
+            if schedule_time is not None:
+                raise SpiderMisuseError(
+                    "Redis task queue does not support " "delayed task"
+                )
+            members[self.pack_task(task)] = priority
+        if members:
+            # All tasks are pushed with one call of LUA script
+            self.queue_object.push(members)
 
     def get(self):
+        if self.reliable:
+            tasks = self.get_many(1)
+            if not tasks:
+                raise queue.Empty()
+            return tasks[0]
         task = self.queue_object.pop()
         if task is None:
             raise queue.Empty()
         else:
-            return pickle.loads(task[0])
+            return self.unpack_task(task[0])
+
+    def get_many(self, count):
+        if self.reliable:
+            return self.claim_tasks(count)
+        items = self.queue_object.pop(count)
+        if count == 1:
+            # fastrq returns single item instead of list for count=1
+            items = [items] if items else []
+        return [self.unpack_task(x[0]) for x in items]
+
+    def claim_tasks(self, count):
+        if self.claim_script is None:
+            self.claim_script = self.queue_object.connect().register_script(
+                CLAIM_SCRIPT
+            )
+        now = time.time()
+        items = self.claim_script(
+            keys=[self.queue_name, self.processing_key, self.priority_key],
+            args=[count, now, now + self.lease_timeout],
+        )
+        tasks = []
+        with self.leased_members_lock:
+            for member in items[::2]:
+                task = self.unpack_task(member)
+                self.leased_members[id(task)] = member
+                tasks.append(task)
+        return tasks
+
+    def ack(self, task):
+        if not self.reliable:
+            return
+        with self.leased_members_lock:
+            member = self.leased_members.pop(id(task), None)
+        if member is not None:
+            pipe = self.queue_object.connect().pipeline()
+            pipe.zrem(self.processing_key, member)
+            pipe.hdel(self.priority_key, member)
+            pipe.execute()
+
+    def renew_leases(self):
+        if not self.reliable:
+            return
+        now = time.time()
+        if now < self.next_renew_time:
+            return
+        self.next_renew_time = now + self.lease_timeout / 3.0
+        with self.leased_members_lock:
+            members = list(self.leased_members.values())
+        if members:
+            # Members which have been acknowledged or moved back to
+            # the queue in the meantime are not added again
+            self.queue_object.connect().zadd(
+                self.processing_key,
+                dict.fromkeys(members, now + self.lease_timeout),
+                xx=True,
+            )
+
+    def pack_task(self, task):
+        return serialize_task(task) + os.urandom(NONCE_SIZE)
+
+    def unpack_task(self, data):
+        if data[:1] == b"\x80":
+            # Task stored by old version of Grab as pickle data
+            # with `redis_qr_rnd` attribute
+            return deserialize_task(data)
+        return deserialize_task(data[:-NONCE_SIZE])
 
     def size(self):
+        if self.reliable:
+            # Tasks which are not acknowledged yet could return
+            # to the queue if their leases expire
+            pipe = self.queue_object.connect().pipeline()
+            pipe.zcard(self.queue_name)
+            pipe.zcard(self.processing_key)
+            return sum(pipe.execute())
         return len(self.queue_object)
 
     def clear(self):
         self.queue_object.clear()
+        if self.reliable:
+            self.queue_object.connect().delete(
+                self.processing_key, self.priority_key
+            )
+            with self.leased_members_lock:
+                self.leased_members.clear()
 
     def close(self):
         # get conneciton opened by qr and close it
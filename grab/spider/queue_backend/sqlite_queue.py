@@ -0,0 +1,150 @@
+"""
+Spider task queue backend powered by sqlite
+
+The queue is stored in the file so the number of pending tasks is not
+limited by the size of memory. The database works in WAL mode, tasks are
+inserted in batches and claimed with index-backed queries inside
+`BEGIN IMMEDIATE` transactions.
+
+Number of tasks is tracked in memory after the queue is opened, so the
+queue file should be used by one spider process at a time.
+"""
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import calendar
+from datetime import datetime
+import logging
+import sqlite3
+from threading import Lock
+
+from grab.spider.error import SpiderMisuseError
+from grab.spider.queue_backend.base import QueueInterface
+from grab.spider.task import deserialize_task, serialize_task
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.queue_backend.sqlite")
+# pylint: enable=invalid-name
+
+
+def datetime_to_timestamp(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class QueueBackend(QueueInterface):
+    def __init__(self, spider_name, path=None, queue_name=None, **kwargs):
+        """
+        Args:
+            path: path to the database file
+            queue_name: name of the table, by default it is
+                "task_queue_<spider_name>"
+        """
+        super(QueueBackend, self).__init__(spider_name, **kwargs)
+        if path is None:
+            raise SpiderMisuseError("Sqlite task queue requires path option")
+        if queue_name is None:
+            queue_name = "task_queue_%s" % spider_name
+        self.path = path
+        self.queue_name = queue_name
+        self.table = '"%s"' % queue_name.replace('"', '""')
+        self.lock = Lock()
+        self.connection = self.connect()
+        self.create_table()
+        self.task_count = self.connection.execute(
+            "SELECT COUNT(*) FROM %s" % self.table
+        ).fetchone()[0]
+        logger.debug("Sqlite queue table %s in %s", self.table, self.path)
+
+    def connect(self):
+        conn = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def create_table(self):
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS %s ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " priority INTEGER NOT NULL,"
+            " schedule_time REAL NOT NULL,"
+            " task BLOB NOT NULL"
+            ")" % self.table
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS "%s_priority_idx" ON %s'
+            " (priority, schedule_time)"
+            % (self.queue_name.replace('"', '""'), self.table)
+        )
+
+    def build_row(self, task, priority, schedule_time):
+        if schedule_time is None:
+            timestamp = 0
+        else:
+            timestamp = datetime_to_timestamp(schedule_time)
+        return (priority, timestamp, sqlite3.Binary(serialize_task(task)))
+
+    def put(self, task, priority, schedule_time=None):
+        self.put_many([(task, priority, schedule_time)])
+
+    def put_many(self, items):
+        rows = [self.build_row(*x) for x in items]
+        if not rows:
+            return
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT INTO %s (priority, schedule_time, task)"
+                    " VALUES (?, ?, ?)" % self.table,
+                    rows,
+                )
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+                self.task_count += len(rows)
+
+    def get(self):
+        tasks = self.get_many(1)
+        if not tasks:
+            raise queue.Empty()
+        else:
+            return tasks[0]
+
+    def get_many(self, count):
+        now = datetime_to_timestamp(datetime.utcnow())
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.connection.execute(
+                    "SELECT id, task FROM %s WHERE schedule_time <= ?"
+                    " ORDER BY priority LIMIT ?" % self.table,
+                    (now, count),
+                ).fetchall()
+                self.connection.executemany(
+                    "DELETE FROM %s WHERE id = ?" % self.table,
+                    [(x[0],) for x in rows],
+                )
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            else:
+                self.connection.execute("COMMIT")
+                self.task_count -= len(rows)
+        return [deserialize_task(x[1]) for x in rows]
+
+    def size(self):
+        return self.task_count
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM %s" % self.table)
+            self.task_count = 0
+
+    def close(self):
+        self.connection.close()
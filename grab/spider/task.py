@@ -1,9 +1,35 @@
 from __future__ import absolute_import
 from datetime import datetime, timedelta
+import pickle
+
+import six
 
 from grab.spider.error import SpiderMisuseError
-from grab.base import copy_config
-from grab.util.warning import warn
+from grab.base import copy_config, default_config
+
+# Version of the format produced by `serialize_task`
+TASK_FORMAT_VERSION = 1
+# Pickle protocol which is supported by both python 2 and python 3
+TASK_PICKLE_PROTOCOL = 2
+# Values of Task attributes which are not stored by `serialize_task`
+TASK_DEFAULT_ATTRS = {
+    'grab_config': None,
+    'valid_status': [],
+    'schedule_time': None,
+    'cache_timeout': None,
+    'fallback_name': None,
+    'priority_set_explicitly': True,
+    'priority': None,
+    'network_try_count': 0,
+    'task_try_count': 1,
+    'disable_cache': False,
+    'refresh_cache': False,
+    'use_proxylist': True,
+    'raw': False,
+    'callback': None,
+    'coroutines_stack': [],
+    'trace': None,
+}
 
 
 class BaseTask(object):
@@ -66,6 +92,10 @@ class Task(BaseTask):
                 be saved to cache.
             :param refresh_cache: if `True` the document will be fetched from
                 the Network and saved to cache.
+            :param cache_timeout: max. age of cached response in seconds,
+                by default the `cache_timeout` option of spider's cache is
+                used. Expired response is revalidated with conditional
+                request if the server supports it.
             :param valid_status: extra status codes which counts as valid
             :param use_proxylist: it means to use proxylist which was
                 configured via `setup_proxylist` method of spider
@@ -130,11 +160,6 @@ class Task(BaseTask):
 
         self.process_delay_option(delay)
         self.cache_timeout = cache_timeout
-        if cache_timeout is not None:
-            warn(
-                'Option `cache_timeout` is deprecated and'
-                ' is not supported anymore'
-            )
 
         self.fallback_name = fallback_name
         self.priority_set_explicitly = priority_set_explicitly
@@ -147,6 +172,8 @@ class Task(BaseTask):
         self.raw = raw
         self.callback = callback
         self.coroutines_stack = []
+        # Timestamps of task processing stages, see grab.spider.tracer
+        self.trace = None
         for key, value in kwargs.items():
             setattr(self, key, value)
 
@@ -193,6 +220,8 @@ class Task(BaseTask):
             task.refresh_cache = False
         if 'disable_cache' not in kwargs:
             task.disable_cache = False
+        if 'trace' not in kwargs:
+            task.trace = None
 
         if kwargs.get('url') is not None and kwargs.get('grab') is not None:
             raise SpiderMisuseError('Options url and grab could not be '
@@ -248,3 +277,63 @@ class Task(BaseTask):
                 return getattr(spider, fb_name)
         else:
             return None
+
+
+def serialize_task(task):
+    """
+    Serialize task into compact binary representation.
+
+    Only attributes which values differ from default values are stored.
+    Options of `grab_config` which values are same as in default Grab
+    config are not stored too. The first byte is the format version.
+    """
+    state = {}
+    for key, value in task.__dict__.items():
+        if key in TASK_DEFAULT_ATTRS and value == TASK_DEFAULT_ATTRS[key]:
+            continue
+        if key == 'grab_config':
+            defaults = default_config()
+            value = dict(
+                (x, y) for x, y in value.items()
+                if x not in defaults or defaults[x] != y
+            )
+        state[key] = value
+    if state.get('grab_config'):
+        # URL is stored in the grab config
+        state.pop('url', None)
+    return (
+        six.int2byte(TASK_FORMAT_VERSION)
+        + pickle.dumps(state, TASK_PICKLE_PROTOCOL)
+    )
+
+
+def deserialize_task(data):
+    """
+    Load task from data created by `serialize_task`.
+
+    Also tasks which were stored with old versions of Grab as plain
+    pickle data of any protocol are supported.
+    """
+    version = six.indexbytes(data, 0)
+    if version != TASK_FORMAT_VERSION:
+        # Pickle data could not start with the version byte: protocol 0
+        # and 1 data starts with printable opcode, data of newer
+        # protocols starts with PROTO opcode
+        try:
+            return pickle.loads(data)
+        except Exception:  # pylint: disable=broad-except
+            raise SpiderMisuseError(
+                'Unknown format version of serialized task: %d' % version
+            )
+    state = pickle.loads(data[1:])
+    task = Task.__new__(Task)
+    for key, value in TASK_DEFAULT_ATTRS.items():
+        setattr(task, key, list(value) if isinstance(value, list) else value)
+    if 'grab_config' in state:
+        config = default_config()
+        config.update(state.pop('grab_config'))
+        task.grab_config = config
+        task.url = config['url']
+    for key, value in state.items():
+        setattr(task, key, value)
+    return task
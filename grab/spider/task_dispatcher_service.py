@@ -32,7 +32,9 @@ class TaskDispatcherService(BaseService):
 
         Result could be:
         * Task
-        * None
+        * list of results, tasks from the list are added to the
+            task queue with one request to the queue backend
+        * None, the task is acknowledged if meta has "ack" flag
         * Task instance
         * InvalidResponseError-based exception
         * Arbitrary exception
@@ -45,13 +47,26 @@ class TaskDispatcherService(BaseService):
 
         if meta is None:
             meta = {}
-        if isinstance(result, Task):
+        if isinstance(result, list):
+            tasks = []
+            for item in result:
+                if isinstance(item, Task):
+                    tasks.append(item)
+                else:
+                    self.process_service_result(item, task, meta)
+            if tasks:
+                if meta.get("source") == "cache_reader":
+                    self.spider.add_tasks(tasks, queue=self.spider.task_queue)
+                else:
+                    self.spider.add_tasks(tasks)
+        elif isinstance(result, Task):
             if meta.get("source") == "cache_reader":
                 self.spider.add_task(result, queue=self.spider.task_queue)
             else:
                 self.spider.add_task(result)
         elif result is None:
-            pass
+            if meta.get("ack"):
+                self.spider.ack_task(task)
         elif isinstance(result, InvalidResponseError):
             self.spider.add_task(task.clone(refresh_cache=True))
             error_code = result.__class__.__name__.replace("_", "-")
@@ -70,12 +85,31 @@ class TaskDispatcherService(BaseService):
             if isinstance(result, FatalError):
                 self.spider.fatal_error_queue.put(meta["exc_info"])
         elif isinstance(result, dict) and "grab" in result:
+            if self.spider.task_tracer:
+                self.spider.task_tracer.add_event(task, "dispatch-start")
+            self.spider.release_task_host(task)
+            if self.is_cache_revalidated(result, task):
+                # Cached response is still valid, the task is
+                # processed with the response loaded from the cache
+                self.spider.stat.inc("cache:req-revalidated")
+                task.cache_validators = None
+                task.cache_revalidated = True
+                self.spider.add_task(
+                    task, queue=self.spider.cache_reader_service.input_queue
+                )
+                return
             if (
                 self.spider.cache_writer_service
                 and not result.get("from_cache")
                 and result["ok"]
             ):
-                self.spider.cache_writer_service.input_queue.put((task, result["grab"]))
+                self.spider.cache_writer_service.put(task, result["grab"])
+            if (
+                self.spider.warc_writer
+                and not result.get("from_cache")
+                and result["ok"]
+            ):
+                self.write_warc_record(result["grab"], task)
             # TODO: Move to network service
             # starts
             self.spider.log_network_result_stats(result, task)
@@ -87,6 +121,8 @@ class TaskDispatcherService(BaseService):
                 res_code = result["grab"].doc.code
                 is_valid = self.spider.is_valid_network_response_code(res_code, task)
             if is_valid:
+                if self.spider.task_tracer:
+                    self.spider.task_tracer.add_event(task, "dispatch-end")
                 self.spider.parser_service.input_queue.put((result, task))
             else:
                 self.spider.log_failed_network_result(result)
@@ -99,8 +135,29 @@ class TaskDispatcherService(BaseService):
                     task.refresh_cache = True
                     task.setup_grab_config(result["grab_config_backup"])
                     self.spider.add_task(task)
+                self.spider.ack_task(task)
             if result.get("from_cache"):
                 self.spider.stat.inc("spider:task-%s-cache" % task.name)
             self.spider.stat.inc("spider:request")
         else:
             raise SpiderError("Unknown result received from a service: %s" % result)
+
+    def write_warc_record(self, grab, task):
+        self.spider.warc_writer.write_response(
+            task.url,
+            grab.doc.head,
+            grab.doc.body,
+            task_name=task.name,
+            response_url=grab.doc.url,
+            code=grab.doc.code,
+        )
+        self.spider.stat.inc("warc:write-record")
+
+    def is_cache_revalidated(self, result, task):
+        return (
+            result["ok"]
+            and result["grab"].doc.code == 304
+            and task.get("cache_validators")
+            and not task.get("refresh_cache")
+            and self.spider.cache_reader_service is not None
+        )
@@ -9,6 +9,7 @@ class TaskGeneratorService(BaseService):
         self.real_generator = real_generator
         self.spider = spider
         self.task_queue_threshold = max(200, self.spider.thread_number * 2)
+        self.batch_size = 100
         self.worker = self.create_worker(self.worker_callback)
         self.register_workers(self.worker)
 
@@ -22,16 +23,27 @@ class TaskGeneratorService(BaseService):
                 self.spider.parser_service.input_queue.qsize(),
             )
             if queue_size < self.task_queue_threshold:
+                # Tasks are sent to task dispatcher in batches
+                # to add them to the task queue with one request
+                batch = []
                 try:
                     for _ in six.moves.range(
                             self.task_queue_threshold - queue_size):
                         if worker.pause_event.is_set():
                             return
-                        task = next(self.real_generator)
-                        self.spider.task_dispatcher.input_queue.put((
-                            task, None, {'source': 'task_generator'}
-                        ))
+                        batch.append(next(self.real_generator))
+                        if len(batch) >= self.batch_size:
+                            self.send_batch(batch)
+                            batch = []
                 except StopIteration:
                     return
+                finally:
+                    if batch:
+                        self.send_batch(batch)
             else:
                 time.sleep(0.1)
+
+    def send_batch(self, batch):
+        self.spider.task_dispatcher.input_queue.put((
+            batch, None, {'source': 'task_generator'}
+        ))
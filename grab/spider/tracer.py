@@ -0,0 +1,132 @@
+"""
+Tracing of the task lifecycle.
+
+If tracing is enabled with `Spider.setup_trace` then the time of each
+handoff of the task between spider services is recorded in `task.trace`:
+
+* add - task is added to the task queue
+* get - network service has got the task from the task queue
+* network-start - network request is started
+* network-end - network response is received
+* dispatch-start - task dispatcher has got the network response
+* dispatch-end - task dispatcher has passed the response to the parser
+* parser-start - parser has got the response
+* parser-end - task handler has completed
+
+Time between consecutive events is added to `trace:<stage>` histograms
+of `spider.stat`, see `STAGES`. Events of sampled tasks are saved into
+the file in Chrome trace event format, which could be opened with
+chrome://tracing or https://ui.perfetto.dev
+"""
+import json
+import logging
+import random
+from threading import Lock
+import time
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.spider.tracer")
+# pylint: enable=invalid-name
+# end event -> (start event, name of the stage)
+STAGES = {
+    "get": ("add", "queue-wait"),
+    "network-start": ("get", "network-wait"),
+    "network-end": ("network-start", "network-time"),
+    "dispatch-start": ("network-end", "dispatcher-wait"),
+    "dispatch-end": ("dispatch-start", "dispatcher-time"),
+    "parser-start": ("dispatch-end", "parser-wait"),
+    "parser-end": ("parser-start", "parser-time"),
+}
+
+
+def get_stage_name(start_event, end_event):
+    stage = STAGES.get(end_event)
+    if stage and stage[0] == start_event:
+        return stage[1]
+    # Task has skipped some stages e.g. the response has been
+    # loaded from the cache
+    return "%s/%s" % (start_event, end_event)
+
+
+class TaskTracer(object):
+    def __init__(self, spider, path=None, sample_rate=0.01, max_tasks=1000):
+        """
+        Args:
+            path: file to save trace events of sampled tasks, if it is None
+                then only histograms are collected
+            sample_rate: probability of the task to be sampled
+            max_tasks: max. number of sampled tasks, events of other tasks
+                are not saved to limit memory usage
+        """
+        self.spider = spider
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_tasks = max_tasks
+        self.trace_events = []
+        self.sampled_number = 0
+        self.lock = Lock()
+
+    def start_trace(self, task):
+        """
+        Start new trace of the task which is added to the task queue.
+        """
+        sampled = self.path is not None and random.random() < self.sample_rate
+        task.trace = {"sampled": sampled, "events": [("add", time.time())]}
+
+    def add_event(self, task, name):
+        trace = task.get("trace")
+        if trace is None:
+            # Task has been added to the queue before tracing was enabled
+            return
+        now = time.time()
+        prev_name, prev_time = trace["events"][-1]
+        stage = STAGES.get(name)
+        if stage and stage[0] == prev_name:
+            self.spider.stat.observe("trace:%s" % stage[1], now - prev_time)
+        trace["events"].append((name, now))
+        if name == "parser-end" and trace["sampled"]:
+            self.add_trace_events(task)
+
+    def add_trace_events(self, task):
+        events = task.trace["events"]
+        with self.lock:
+            if self.sampled_number >= self.max_tasks:
+                return
+            self.sampled_number += 1
+            # Each task is displayed as separate thread
+            tid = self.sampled_number
+            self.trace_events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": "%s %s" % (task.name, task.url)},
+                }
+            )
+            for (start_name, start), (end_name, end) in zip(events, events[1:]):
+                self.trace_events.append(
+                    {
+                        "name": get_stage_name(start_name, end_name),
+                        "cat": task.name,
+                        "ph": "X",
+                        "ts": int(start * 1e6),
+                        "dur": int((end - start) * 1e6),
+                        "pid": 1,
+                        "tid": tid,
+                    }
+                )
+
+    def save(self):
+        """
+        Save trace events of sampled tasks to the file.
+        """
+        if self.path is None:
+            return
+        with self.lock:
+            data = {"traceEvents": list(self.trace_events), "displayTimeUnit": "ms"}
+        with open(self.path, "w") as out:
+            json.dump(data, out)
+        logger.debug(
+            "Saved trace of %d tasks to %s", self.sampled_number, self.path
+        )
@@ -0,0 +1,199 @@
+"""
+Filters of seen URLs which are used by `Spider.add_task` to drop
+tasks with URLs which have been already added to the task queue.
+
+* SetUrlFilter - exact filter, stores all URLs in memory
+* BloomUrlFilter - Bloom filter, memory usage depends only on the
+    expected number of URLs and the false positive rate
+* FileBloomUrlFilter - Bloom filter stored in the memory-mapped file,
+    its state is kept between spider runs
+"""
+from hashlib import md5
+import math
+import mmap
+import os
+import struct
+from threading import Lock
+
+import six
+
+from grab.spider.error import SpiderMisuseError
+
+FILE_BLOOM_MAGIC = b"GRABBLM1"
+FILE_BLOOM_HEADER = struct.Struct("<8sQQ")
+
+
+def build_bloom_params(capacity, error_rate):
+    """
+    Return (number of bits, number of hash functions) of the Bloom filter
+    which keeps `error_rate` false positive rate for `capacity` items.
+    """
+    if capacity <= 0:
+        raise SpiderMisuseError("Capacity of Bloom filter should be positive")
+    if not 0 < error_rate < 1:
+        raise SpiderMisuseError("Error rate of Bloom filter should be in (0, 1)")
+    bit_number = int(
+        math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+    )
+    hash_number = max(1, int(round(bit_number / float(capacity) * math.log(2))))
+    return bit_number, hash_number
+
+
+class BaseUrlFilter(object):
+    def __init__(self):
+        self.lock = Lock()
+
+    def add(self, url):
+        """
+        Remember the URL.
+
+        Returns False if the URL has been already seen.
+        """
+        with self.lock:
+            return self.add_url(url)
+
+    def add_url(self, url):
+        raise NotImplementedError
+
+    def __contains__(self, url):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SetUrlFilter(BaseUrlFilter):
+    def __init__(self):
+        super(SetUrlFilter, self).__init__()
+        self.urls = set()
+
+    def add_url(self, url):
+        if url in self.urls:
+            return False
+        self.urls.add(url)
+        return True
+
+    def __contains__(self, url):
+        return url in self.urls
+
+
+class BloomUrlFilter(BaseUrlFilter):
+    def __init__(self, capacity=10 ** 7, error_rate=0.001):
+        super(BloomUrlFilter, self).__init__()
+        self.bit_number, self.hash_number = build_bloom_params(
+            capacity, error_rate
+        )
+        self.bits = self.create_storage((self.bit_number + 7) // 8)
+
+    def create_storage(self, size):
+        return bytearray(size)
+
+    def iterate_bit_positions(self, url):
+        if isinstance(url, six.text_type):
+            url = url.encode("utf-8")
+        digest = md5(url).digest()
+        # Double hashing: k hash functions are built from two hashes
+        hash1, hash2 = struct.unpack("<QQ", digest)
+        for idx in six.moves.range(self.hash_number):
+            yield (hash1 + idx * hash2) % self.bit_number
+
+    def add_url(self, url):
+        bits = self.bits
+        is_new = False
+        for pos in self.iterate_bit_positions(url):
+            byte_pos = pos >> 3
+            mask = 1 << (pos & 7)
+            value = bits[byte_pos]
+            if not value & mask:
+                is_new = True
+                bits[byte_pos] = value | mask
+        return is_new
+
+    def __contains__(self, url):
+        bits = self.bits
+        return all(
+            bits[pos >> 3] & (1 << (pos & 7))
+            for pos in self.iterate_bit_positions(url)
+        )
+
+
+class FileBloomUrlFilter(BloomUrlFilter):
+    """
+    Bloom filter which bits are stored in the memory-mapped file.
+
+    If the file exists then parameters of the filter are read from it
+    and `capacity` and `error_rate` arguments are ignored.
+    """
+
+    def __init__(self, path=None, capacity=10 ** 7, error_rate=0.001):
+        if path is None:
+            raise SpiderMisuseError("File Bloom filter requires path option")
+        self.path = path
+        self.file = None
+        self.mmap = None
+        super(FileBloomUrlFilter, self).__init__(
+            capacity=capacity, error_rate=error_rate
+        )
+
+    def create_storage(self, size):
+        if os.path.exists(self.path):
+            self.file = open(self.path, "r+b")
+            magic, bit_number, hash_number = FILE_BLOOM_HEADER.unpack(
+                self.file.read(FILE_BLOOM_HEADER.size)
+            )
+            if magic != FILE_BLOOM_MAGIC:
+                raise SpiderMisuseError(
+                    "File %s is not a Bloom filter file" % self.path
+                )
+            self.bit_number, self.hash_number = bit_number, hash_number
+            size = (self.bit_number + 7) // 8
+        else:
+            self.file = open(self.path, "w+b")
+            self.file.write(
+                FILE_BLOOM_HEADER.pack(
+                    FILE_BLOOM_MAGIC, self.bit_number, self.hash_number
+                )
+            )
+            self.file.truncate(FILE_BLOOM_HEADER.size + size)
+            self.file.flush()
+        self.mmap = mmap.mmap(self.file.fileno(), FILE_BLOOM_HEADER.size + size)
+        return self.mmap
+
+    # Items of mmap are one-byte strings on Python 2 and integers on
+    # Python 3, so bytes are read with `six.indexbytes` and written
+    # with slice assignment which accepts bytes on both versions
+
+    def add_url(self, url):
+        data = self.mmap
+        offset = FILE_BLOOM_HEADER.size
+        is_new = False
+        for pos in self.iterate_bit_positions(url):
+            byte_pos = offset + (pos >> 3)
+            mask = 1 << (pos & 7)
+            value = six.indexbytes(data, byte_pos)
+            if not value & mask:
+                is_new = True
+                data[byte_pos : byte_pos + 1] = six.int2byte(value | mask)
+        return is_new
+
+    def __contains__(self, url):
+        data = self.mmap
+        offset = FILE_BLOOM_HEADER.size
+        return all(
+            six.indexbytes(data, offset + (pos >> 3)) & (1 << (pos & 7))
+            for pos in self.iterate_bit_positions(url)
+        )
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.flush()
+            self.mmap.close()
+            self.file.close()
+            self.mmap = None
+
+
+URL_FILTER_BACKENDS = {
+    "set": SetUrlFilter,
+    "bloom": BloomUrlFilter,
+    "bloom-file": FileBloomUrlFilter,
+}
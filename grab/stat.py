@@ -2,16 +2,195 @@
 This module contains Stat class. It is used inside
 Grab::Spider to collect statistics about events happening
 during the scraping session.
+
+Counters are incremented from many threads of the spider. Each thread
+increments its own shard of counters without locking and shards are
+merged when counters are read. Shards of finished threads are folded
+into the base values. The progress line is logged by the background
+ticker thread, not by the thread which increments counters.
+
+Histograms are used to collect distributions of values like network
+response time. They take fixed amount of memory and percentiles are
+calculated with relative error about `HISTOGRAM_PRECISION`.
 """
 import logging
 from collections import defaultdict
+import math
 import time
 from contextlib import contextmanager
+from threading import Event, Lock, Thread, local
+import weakref
 
 from grab.util.warning import warn
 
 DEFAULT_SPEED_KEY = 'spider:request-processed'
 DEFAULT_LOGGING_PERIOD = 1
+# How often the ticker checks `logging_period` if logging is disabled
+TICKER_IDLE_PERIOD = 0.5
+# Values less than HISTOGRAM_MIN_VALUE go to the first bucket of histogram,
+# values greater than HISTOGRAM_MAX_VALUE go to the last bucket
+HISTOGRAM_MIN_VALUE = 1e-6
+HISTOGRAM_MAX_VALUE = 1e5
+HISTOGRAM_PRECISION = 0.05
+HISTOGRAM_LOG_BASE = math.log(1 + HISTOGRAM_PRECISION)
+HISTOGRAM_SIZE = int(
+    math.ceil(math.log(HISTOGRAM_MAX_VALUE / HISTOGRAM_MIN_VALUE)
+              / HISTOGRAM_LOG_BASE)
+) + 2
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+
+class Histogram(object):
+    """
+    Distribution of values counted in logarithmic buckets.
+
+    Bucket N (N > 0) counts values from `MIN * (1 + PRECISION) ** (N - 1)`
+    to `MIN * (1 + PRECISION) ** N`.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_SIZE
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value <= HISTOGRAM_MIN_VALUE:
+            idx = 0
+        else:
+            idx = min(
+                int(math.log(value / HISTOGRAM_MIN_VALUE)
+                    / HISTOGRAM_LOG_BASE) + 1,
+                HISTOGRAM_SIZE - 1,
+            )
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add values of other histogram to this histogram.
+        """
+        buckets = list(other.buckets)
+        for idx, num in enumerate(buckets):
+            if num:
+                self.buckets[idx] += num
+        self.count += sum(buckets)
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def percentile(self, percent):
+        """
+        Returns value which is greater than or equal to `percent`
+        percents of values, None if histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        seen = 0
+        for idx, num in enumerate(self.buckets):
+            seen += num
+            if seen >= rank:
+                if idx == HISTOGRAM_SIZE - 1:
+                    # The last bucket has no upper bound
+                    return self.max
+                value = HISTOGRAM_MIN_VALUE * (1 + HISTOGRAM_PRECISION) ** idx
+                return max(min(value, self.max), self.min)
+        return self.max
+
+    def get_bucket_counts(self, bounds):
+        """
+        Returns list of numbers of values which are less than or equal
+        to each of sorted `bounds`. Values are compared with upper bounds
+        of their buckets so the result is approximate.
+        """
+        result = [0] * len(bounds)
+        for idx, num in enumerate(self.buckets):
+            if num:
+                if idx == HISTOGRAM_SIZE - 1:
+                    break
+                value = HISTOGRAM_MIN_VALUE * (1 + HISTOGRAM_PRECISION) ** idx
+                for pos, bound in enumerate(bounds):
+                    if value <= bound:
+                        result[pos] += num
+                        break
+        total = 0
+        for pos, num in enumerate(result):
+            total += num
+            result[pos] = total
+        return result
+
+    def get_summary(self, percentiles=DEFAULT_PERCENTILES):
+        """
+        Returns dict with count, min, max, mean and percentiles
+        of values e.g. {'count': 10, 'p50': 0.1, ...}
+        """
+        result = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': (float(self.total) / self.count) if self.count else None,
+        }
+        for percent in percentiles:
+            result['p%s' % percent] = self.percentile(percent)
+        return result
+
+    def render(self, percentiles=DEFAULT_PERCENTILES):
+        summary = self.get_summary(percentiles)
+        keys = ['min'] + ['p%s' % x for x in percentiles] + ['max']
+        tokens = ['count=%d' % summary['count']]
+        for key in keys:
+            if summary[key] is not None:
+                tokens.append('%s=%.4f' % (key, summary[key]))
+        return ' '.join(tokens)
+
+
+class ShardOwner(object):
+    """
+    Object which is kept in the thread-local storage. It is destroyed
+    with the storage when the thread is finished.
+    """
+
+    __slots__ = ('__weakref__',)
+
+
+class CounterView(defaultdict):
+    """
+    Values of counters summed over all threads.
+
+    Values set in the dict are saved into the base values of `Stat`
+    instance, e.g. `stat.counters['foo'] += 1` increments the counter.
+    """
+
+    def __init__(self, stat, values):
+        defaultdict.__init__(self, int, values)
+        self.stat = stat
+
+    def __missing__(self, key):
+        # Reading of missing counter does not create it
+        return 0
+
+    def __setitem__(self, key, value):
+        self.stat.inc_base(key, value - self[key])
+        defaultdict.__setitem__(self, key, value)
+
+    def copy(self):
+        return defaultdict(int, self)
+
+    __copy__ = copy
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
 
 
 class Stat(object):
@@ -28,6 +207,9 @@ class Stat(object):
         self.logger_name = logger_name
         self.logger = logging.getLogger(logger_name)
         self.setup_logging_file(log_file)
+        self.shards_lock = Lock()
+        self.ticker = None
+        self.ticker_stop_event = Event()
         self.reset()
 
     def setup_speed_keys(self, speed_key, extra_keys):
@@ -37,10 +219,111 @@ class Stat(object):
         self.speed_keys = keys
 
     def reset(self):
-        self.counters = defaultdict(int)
+        with self.shards_lock:
+            # weakref to `ShardOwner` -> (counters, histograms)
+            self.shards = {}
+            self.base_counters = defaultdict(int)
+            self.base_histograms = {}
+            # Shard owners of the old storage are destroyed after
+            # the lock is released, their shards are not folded
+            # because they are not in `self.shards` anymore
+            old_local, self.local = getattr(self, 'local', None), local()
+        del old_local
         self.collections = defaultdict(list)
         self.counters_prev = defaultdict(int)
 
+    def create_shards(self):
+        owner = ShardOwner()
+        ref = weakref.ref(owner, self.fold_shards)
+        counters = defaultdict(int)
+        histograms = {}
+        with self.shards_lock:
+            self.shards[ref] = (counters, histograms)
+        self.local.owner = owner
+        self.local.counters = counters
+        self.local.histograms = histograms
+
+    def fold_shards(self, ref):
+        """
+        Add values of shards of the finished thread to the base values.
+        """
+        with self.shards_lock:
+            shards = self.shards.pop(ref, None)
+            if shards is None:
+                return
+            counters, histograms = shards
+            for key, value in counters.items():
+                self.base_counters[key] += value
+            for key, hist in histograms.items():
+                if key not in self.base_histograms:
+                    self.base_histograms[key] = Histogram()
+                self.base_histograms[key].merge(hist)
+
+    def inc_base(self, key, delta):
+        with self.shards_lock:
+            self.base_counters[key] += delta
+
+    @property
+    def counters(self):
+        """
+        Values of counters summed over all threads.
+
+        Returns new dict on each call, values set in the dict are
+        added to counters, see `CounterView`.
+        """
+        result = defaultdict(int)
+        with self.shards_lock:
+            result.update(self.base_counters)
+            for shard, _ in self.shards.values():
+                # Copying of the dict is atomic, the shard could not change
+                # while it is being copied by the other thread
+                for key, value in shard.copy().items():
+                    result[key] += value
+        return CounterView(self, result)
+
+    @property
+    def histograms(self):
+        """
+        Histograms merged over all threads, dict which maps
+        key to `Histogram` instance.
+        """
+        result = {}
+        with self.shards_lock:
+            shards = [self.base_histograms]
+            shards.extend(x for _, x in self.shards.values())
+            for shard in shards:
+                for key, hist in list(shard.items()):
+                    if key not in result:
+                        result[key] = Histogram()
+                    result[key].merge(hist)
+        return result
+
+    def start(self):
+        """
+        Start the thread which logs the progress line every
+        `logging_period` seconds.
+        """
+        if self.ticker is None:
+            self.ticker_stop_event.clear()
+            self.ticker = Thread(target=self.ticker_callback, name='stat-ticker')
+            self.ticker.daemon = True
+            self.ticker.start()
+
+    def stop(self):
+        if self.ticker is not None:
+            self.ticker_stop_event.set()
+            self.ticker.join()
+            self.ticker = None
+
+    def ticker_callback(self):
+        while not self.ticker_stop_event.wait(
+            self.logging_period or TICKER_IDLE_PERIOD
+        ):
+            now = time.time()
+            if self.logging_period and now - self.time >= self.logging_period:
+                self.print_progress_line()
+                self.time = now
+
     def setup_logging_file(self, log_file):
         self.log_file = log_file
         if log_file:
@@ -49,10 +332,11 @@ class Stat(object):
 
     def get_counter_line(self):
         result = []
-        for key in list(self.counters.keys()):
+        counters = self.counters
+        for key in list(counters.keys()):
             if not any(key.startswith(x)
                        for x in self.logging_ignore_prefixes):
-                result.append((key, '%s=%d' % (key, self.counters[key])))
+                result.append((key, '%s=%d' % (key, counters[key])))
         for key in list(self.collections.keys()):
             if not any(key.startswith(x)
                        for x in self.logging_ignore_prefixes):
@@ -63,12 +347,13 @@ class Stat(object):
 
     def get_speed_line(self, now):
         items = []
+        counters = self.counters
         for key in self.speed_keys:
             time_elapsed = now - self.time
             if time_elapsed == 0:
                 qps = 0
             else:
-                count_current = self.counters[key]
+                count_current = counters[key]
                 diff = count_current - self.counters_prev[key]
                 qps = diff / time_elapsed
                 self.counters_prev[key] = count_current
@@ -86,11 +371,36 @@ class Stat(object):
                           self.get_counter_line())
 
     def inc(self, key, delta=1):
-        self.counters[key] += delta
-        now = time.time()
-        if self.logging_period and now - self.time > self.logging_period:
-            self.print_progress_line()
-            self.time = now
+        try:
+            shard = self.local.counters
+        except AttributeError:
+            self.create_shards()
+            shard = self.local.counters
+        shard[key] += delta
+
+    def get_histogram(self, key):
+        try:
+            shard = self.local.histograms
+        except AttributeError:
+            self.create_shards()
+            shard = self.local.histograms
+        try:
+            return shard[key]
+        except KeyError:
+            hist = shard[key] = Histogram()
+            return hist
+
+    def observe(self, key, value):
+        """
+        Add value to the histogram.
+        """
+        self.get_histogram(key).add(value)
+
+    def merge_histogram(self, key, hist):
+        """
+        Add values of `Histogram` instance to the histogram.
+        """
+        self.get_histogram(key).merge(hist)
 
     def collect(self, key, val):
         self.collections[key].append(val)
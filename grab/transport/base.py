@@ -3,6 +3,10 @@ import os
 
 
 class BaseTransport(object):
+    # Transport sets `connect_time` and `name_lookup_time`
+    # of the response
+    measures_connect_time = False
+
     def __init__(self):
         # these assignments makes pylint happy
         self.body_file = None
@@ -100,6 +100,8 @@ class CurlTransport(BaseTransport):
     Grab transport layer using pycurl.
     """
 
+    measures_connect_time = True
+
     def __init__(self):
         super(CurlTransport, self).__init__()
         self.curl = pycurl.Curl()
@@ -395,6 +395,7 @@ class Urllib3Transport(BaseTransport):
             # self.response_header_chunks = []
 
             response.code = self._response.status
+            response.total_time = time.time() - self._request.op_started
             # response.total_time = self.curl.getinfo(pycurl.TOTAL_TIME)
             # response.connect_time = self.curl.getinfo(pycurl.CONNECT_TIME)
             # response.name_lookup_time = (self.curl
@@ -0,0 +1,163 @@
+"""
+Compression codecs which are used to store documents in the cache.
+
+Codec is specified by the name and optional compression level separated
+by colon e.g. "zlib", "zlib:9", "lzma:6". Only the name of the codec is
+required to decompress the data, so the name is stored with compressed
+data and the level could be changed at any time.
+
+Available codecs:
+
+* none - data is not compressed
+* zlib - zlib from standard library
+* lzma - lzma from standard library, better compression ratio, slower
+* lz4 - very fast, requires `lz4` package
+* zstd - fast, good compression ratio, requires `zstandard` package
+"""
+import zlib
+
+from grab.error import GrabMisuseError
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class BaseCodec(object):
+    name = None
+    default_level = None
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def decompress(self, data):
+        raise NotImplementedError
+
+
+class NoneCodec(BaseCodec):
+    name = "none"
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(BaseCodec):
+    name = "zlib"
+    default_level = 6
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCodec(BaseCodec):
+    name = "lzma"
+    default_level = 6
+
+    @classmethod
+    def is_available(cls):
+        return lzma is not None
+
+    def compress(self, data):
+        return lzma.compress(data, preset=self.level)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class Lz4Codec(BaseCodec):
+    name = "lz4"
+    default_level = 0
+
+    @classmethod
+    def is_available(cls):
+        return lz4_frame is not None
+
+    def compress(self, data):
+        return lz4_frame.compress(data, compression_level=self.level)
+
+    def decompress(self, data):
+        return lz4_frame.decompress(data)
+
+
+class ZstdCodec(BaseCodec):
+    name = "zstd"
+    default_level = 3
+
+    @classmethod
+    def is_available(cls):
+        return zstandard is not None
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODEC_CLASSES = dict(
+    (cls.name, cls) for cls in (NoneCodec, ZlibCodec, LzmaCodec, Lz4Codec, ZstdCodec)
+)
+# Codec instances which are used to decompress data, name -> codec
+DECOMPRESSORS = {}
+
+
+def build_codec(spec):
+    """
+    Create codec from specification like "zlib" or "zlib:9".
+    """
+    name, _, level = spec.partition(":")
+    try:
+        cls = CODEC_CLASSES[name]
+    except KeyError:
+        raise GrabMisuseError("Unknown codec: %s" % name)
+    if not cls.is_available():
+        raise GrabMisuseError(
+            "Codec %s is not available, required package is not installed" % name
+        )
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            raise GrabMisuseError("Invalid codec level: %s" % spec)
+    else:
+        level = None
+    return cls(level)
+
+
+def decompress(name, data):
+    """
+    Decompress data which has been compressed with the codec `name`.
+    """
+    try:
+        codec = DECOMPRESSORS[name]
+    except KeyError:
+        codec = DECOMPRESSORS[name] = build_codec(name)
+    return codec.decompress(data)
+
+
+def get_available_codecs():
+    return sorted(x.name for x in CODEC_CLASSES.values() if x.is_available())
@@ -0,0 +1,375 @@
+"""
+Reading and writing of WARC files.
+
+Records are written as separate gzip members, so any record could be read
+without decompressing the records before it, if its offset is known. The
+writer saves offsets of records into the index file `<path>.idx`, each
+line of the index is "<offset> <length> <url>".
+
+Responses are written as "response" records with HTTP headers and body in
+the payload. The body of the response is already decoded by the network
+transport, so Content-Encoding and Transfer-Encoding headers are removed
+from the stored headers and Content-Length header is set to the size of
+the decoded body. The name of the task and the URL of the final response
+(after redirects) are stored in "Grab-Task-Name" and "Grab-Response-URI"
+record headers.
+"""
+import base64
+import calendar
+from hashlib import sha1
+import logging
+import os
+from threading import Lock
+import time
+import uuid
+import zlib
+
+from six.moves.http_client import responses
+
+from grab.error import GrabError
+
+# pylint: disable=invalid-name
+logger = logging.getLogger("grab.util.warc")
+# pylint: enable=invalid-name
+READ_CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+# Headers which do not match decoded body
+ENCODING_HEADERS = (b"content-encoding", b"transfer-encoding", b"content-length")
+
+
+class WarcError(GrabError):
+    """
+    Raised when WARC file is malformed.
+    """
+
+
+def get_index_path(path):
+    return path + ".idx"
+
+
+def format_warc_date(timestamp=None):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def parse_warc_date(value):
+    return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def build_record(headers, payload, compress_level=6):
+    """
+    Build WARC record compressed as one gzip member.
+
+    Args:
+        headers: list of (name, value) tuples, Content-Length header
+            is added automatically
+    """
+    lines = [b"WARC/1.0"]
+    for name, value in headers + [("Content-Length", str(len(payload)))]:
+        lines.append(("%s: %s" % (name, value)).encode("utf-8"))
+    data = b"\r\n".join(lines) + b"\r\n\r\n" + payload + b"\r\n\r\n"
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def build_status_line(code):
+    return ("HTTP/1.1 %d %s" % (code, responses.get(code, "Unknown"))).encode(
+        "ascii"
+    )
+
+
+def build_http_payload(head, body, code=200):
+    """
+    Build HTTP response from headers of the final response and decoded body.
+
+    The status line is built from `code` if the head does not contain it,
+    e.g. urllib3 transport does not save the status line into the head.
+    """
+    # Head could contain headers of multiple responses if there
+    # were redirects, the last block belongs to the final response
+    blocks = [x for x in head.replace(b"\r\n", b"\n").split(b"\n\n") if x.strip()]
+    lines = blocks[-1].split(b"\n") if blocks else []
+    if not lines or not lines[0].startswith(b"HTTP/"):
+        lines.insert(0, build_status_line(code))
+    result = [lines[0]]
+    for line in lines[1:]:
+        name = line.split(b":", 1)[0].strip().lower()
+        if name not in ENCODING_HEADERS:
+            result.append(line)
+    result.append(b"Content-Length: " + str(len(body)).encode("ascii"))
+    return b"\r\n".join(result) + b"\r\n\r\n" + body
+
+
+class WarcWriter(object):
+    """
+    Appends responses to the WARC file.
+
+    The file is opened on the first write and it could be used by
+    multiple threads.
+    """
+
+    def __init__(self, path, compress_level=6):
+        self.path = path
+        self.compress_level = compress_level
+        self.file = None
+        self.index_file = None
+        self.lock = Lock()
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        self.index_file = open(get_index_path(self.path), "a")
+        if not self.file.tell():
+            payload = b"software: grab\r\nformat: WARC File Format 1.0\r\n"
+            self.write_record(
+                [
+                    ("WARC-Type", "warcinfo"),
+                    ("WARC-Record-ID", "<urn:uuid:%s>" % uuid.uuid4()),
+                    ("WARC-Date", format_warc_date()),
+                    ("WARC-Filename", os.path.basename(self.path)),
+                    ("Content-Type", "application/warc-fields"),
+                ],
+                payload,
+                "-",
+            )
+
+    def write_record(self, headers, payload, url):
+        data = build_record(headers, payload, self.compress_level)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.index_file.write("%d %d %s\n" % (offset, len(data), url))
+
+    def write_response(
+        self, url, head, body, task_name=None, response_url=None, code=200
+    ):
+        """
+        Write response record.
+
+        Args:
+            url: requested URL, it is saved as WARC-Target-URI
+            head: headers of all responses received for the request
+            body: decoded body of the final response
+            code: status code of the final response, it is used if
+                the head does not contain the status line
+        """
+        payload = build_http_payload(head, body, code)
+        digest = base64.b32encode(sha1(body).digest()).decode("ascii")
+        headers = [
+            ("WARC-Type", "response"),
+            ("WARC-Record-ID", "<urn:uuid:%s>" % uuid.uuid4()),
+            ("WARC-Date", format_warc_date()),
+            ("WARC-Target-URI", url),
+            ("WARC-Payload-Digest", "sha1:%s" % digest),
+            ("Content-Type", "application/http; msgtype=response"),
+        ]
+        if task_name is not None:
+            headers.append(("Grab-Task-Name", task_name))
+        if response_url is not None and response_url != url:
+            headers.append(("Grab-Response-URI", response_url))
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.write_record(headers, payload, url)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.index_file.close()
+                self.file = None
+                self.index_file = None
+
+
+def read_record_data(data, offset):
+    """
+    Read raw data of the record which starts at `offset`.
+
+    Args:
+        data: content of WARC file, any object which supports slicing
+            e.g. memory-mapped file
+
+    Returns tuple (data, length of the record in the file).
+    """
+    if data[offset : offset + 2] == GZIP_MAGIC:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        pos = offset
+        while not decompressor.eof:
+            chunk = data[pos : pos + READ_CHUNK_SIZE]
+            if not chunk:
+                raise WarcError("Truncated gzip member at offset %d" % offset)
+            chunks.append(decompressor.decompress(chunk))
+            pos += len(chunk)
+        return b"".join(chunks), pos - len(decompressor.unused_data) - offset
+    # Uncompressed record
+    pos = offset
+    while True:
+        chunk = data[pos : pos + READ_CHUNK_SIZE]
+        if not chunk:
+            raise WarcError("Truncated record at offset %d" % offset)
+        idx = chunk.find(b"\r\n\r\n")
+        if idx > -1:
+            break
+        # The delimiter could be split between chunks
+        pos += max(1, len(chunk) - 3)
+    head_size = pos + idx + 4 - offset
+    headers = parse_record_headers(data[offset : offset + head_size])
+    size = head_size + int(headers[b"content-length"]) + 4
+    return data[offset : offset + size], size
+
+
+def parse_record_headers(head):
+    lines = head.strip().split(b"\r\n")
+    if not lines[0].startswith(b"WARC/"):
+        raise WarcError("Invalid WARC record")
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def parse_record(raw):
+    """
+    Returns tuple (headers, payload) where headers is dict with lowercased
+    names of headers.
+    """
+    head, _, rest = raw.partition(b"\r\n\r\n")
+    headers = parse_record_headers(head)
+    return headers, rest[: int(headers[b"content-length"])]
+
+
+def iterate_records(data, offset=0):
+    """
+    Iterate over (offset, length, headers, payload) of records of WARC file.
+    """
+    size = len(data)
+    while offset < size:
+        raw, length = read_record_data(data, offset)
+        headers, payload = parse_record(raw)
+        yield offset, length, headers, payload
+        offset += length
+
+
+def decode_chunked_body(body):
+    result = []
+    pos = 0
+    while True:
+        idx = body.find(b"\r\n", pos)
+        if idx == -1:
+            raise ValueError("Invalid chunked body")
+        chunk_size = int(body[pos:idx].split(b";")[0], 16)
+        if not chunk_size:
+            return b"".join(result)
+        result.append(body[idx + 2 : idx + 2 + chunk_size])
+        pos = idx + 2 + chunk_size + 2
+
+
+def parse_http_response(payload):
+    """
+    Parse HTTP response stored in the "response" record.
+
+    Body is decoded if the record has been written by other software
+    which stores raw chunked or compressed body.
+
+    Returns tuple (status code, head, body).
+    """
+    head, _, body = payload.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    status = lines[0].split(None, 2)
+    if (
+        len(status) < 2
+        or not status[0].startswith(b"HTTP/")
+        or not status[1].isdigit()
+        or len(status[1]) != 3
+    ):
+        raise WarcError("Invalid status line of HTTP response: %r" % lines[0])
+    code = int(status[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip().lower()
+    try:
+        if headers.get(b"transfer-encoding") == b"chunked":
+            body = decode_chunked_body(body)
+        encoding = headers.get(b"content-encoding")
+        if encoding in (b"gzip", b"x-gzip"):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == b"deflate":
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+    except (ValueError, zlib.error):
+        # Keep body as is
+        pass
+    return code, head + b"\r\n\r\n", body
+
+
+def read_index_file(path):
+    """
+    Returns tuple (index, offset of the end of last indexed record), the
+    offset is None if records in the index file are not contiguous.
+    """
+    index = {}
+    end = 0
+    with open(path) as inp:
+        for line in inp:
+            offset, length, url = line.rstrip("\n").split(" ", 2)
+            offset, length = int(offset), int(length)
+            if offset != end:
+                return index, None
+            if url != "-":
+                index[url] = (offset, length)
+            end = offset + length
+    return index, end
+
+
+def load_index(path, data):
+    """
+    Load index of response records of WARC file.
+
+    Records which are not in the index file (or all records if there is
+    no index file) are read from the file and added to the index file.
+
+    Args:
+        data: content of WARC file
+
+    Returns dict which maps URL to (offset, length) of the last record
+    of that URL.
+    """
+    index, end = {}, 0
+    index_path = get_index_path(path)
+    if os.path.exists(index_path):
+        index, end = read_index_file(index_path)
+        if end is None or end > len(data):
+            # Index file does not match the WARC file
+            index, end = {}, 0
+            try:
+                os.unlink(index_path)
+            except (IOError, OSError):
+                pass
+    lines = []
+    try:
+        for offset, length, headers, _ in iterate_records(data, end):
+            url = "-"
+            if headers.get(b"warc-type") == b"response":
+                url = headers[b"warc-target-uri"].decode("utf-8")
+                index[url] = (offset, length)
+            lines.append("%d %d %s\n" % (offset, length, url))
+    except WarcError as ex:
+        # The last record could be not completely written yet
+        logger.error("Could not read %s: %s", path, ex)
+    if lines:
+        try:
+            with open(index_path, "a") as out:
+                out.writelines(lines)
+        except (IOError, OSError):
+            # WARC file could be in read-only location
+            pass
+    return index
+
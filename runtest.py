@@ -37,6 +37,7 @@ GRAB_TEST_LIST = (
     "tests.grab_request",
     "tests.grab_response_body_processing",
     "tests.grab_sigint",
+    "tests.grab_stat",
     "tests.grab_timeout",
     "tests.grab_transport",
     "tests.grab_upload_file",
@@ -48,9 +49,11 @@ GRAB_TEST_LIST = (
     "tests.raw_server",
     "tests.response_class",
     "tests.script_crawl",
+    "tests.util_codec",
     "tests.util_config",
     "tests.util_log",
     "tests.util_module",
+    "tests.util_warc",
 )
 
 # ************
@@ -59,9 +62,11 @@ GRAB_TEST_LIST = (
 
 SPIDER_TEST_LIST = (
     "tests.spider",
-    "tests.spider_cache",  # backends: mongodb, mysql, postgresql
+    "tests.spider_cache",  # backends: mongodb, mysql, postgresql, sqlite
     #'tests.spider_data',
     "tests.spider_error",
+    "tests.spider_host_scheduler",
+    "tests.spider_http_api",
     "tests.spider_meta",
     "tests.spider_misc",
     "tests.spider_multiprocess",
@@ -70,6 +75,7 @@ SPIDER_TEST_LIST = (
     "tests.spider_sigint",
     "tests.spider_stat",
     "tests.spider_task",
+    "tests.spider_url_filter",
 )
 
 
@@ -95,7 +101,11 @@ def main():
     parser = OptionParser()
     parser.add_option("-t", "--test", help="Run only specified tests")
     parser.add_option("--grab-transport", default="pycurl")
-    parser.add_option("--network-service", default="multicurl")
+    parser.add_option(
+        "--network-service",
+        default="multicurl",
+        help="multicurl, multicurl-socket, threaded or asyncio",
+    )
     parser.add_option(
         "--test-grab",
         action="store_true",
@@ -32,6 +32,10 @@ setup(
             "urllib3",
             "certifi",
         ],
+        "compression": [
+            "lz4",
+            "zstandard",
+        ],
         "pyquery": [
             'pyquery; platform_system != "Windows" and python_version >= "3.0"',
             'pyquery; platform_system == "Windows" and python_version >= "3.13"',
@@ -1,5 +1,8 @@
 # coding: utf-8
 from test_server import Response
+
+from grab.document import Document
+from grab.util.codec import build_codec
 from tests.util import BaseGrabTestCase, build_grab
 
 
@@ -15,3 +18,12 @@ class GrabDocumentTestCase(BaseGrabTestCase):
 
         res2 = res1.copy()
         self.assertEqual("test", res2.select("//h1").text())
+
+    def test_compressed_body(self):
+        body = b"<h1>test</h1>"
+        doc = Document()
+        doc.set_compressed_body("zlib", build_codec("zlib").compress(body))
+        self.assertEqual(None, doc._bytes_body)  # pylint: disable=protected-access
+        self.assertEqual(body, doc.body)
+        doc.body = b"<h1>new</h1>"
+        self.assertEqual(b"<h1>new</h1>", doc.body)
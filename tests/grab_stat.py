@@ -1,6 +1,11 @@
+from threading import Thread
+import time
+
+import mock
+
 from tests.util import BaseGrabTestCase
 
-from grab.stat import Stat
+from grab.stat import Histogram, Stat
 
 
 class GrabStatTestCase(BaseGrabTestCase):
@@ -10,3 +15,115 @@ class GrabStatTestCase(BaseGrabTestCase):
     def test_zero_division_error(self):
         stat = Stat()
         stat.get_speed_line(stat.time)
+
+    def test_inc_from_many_threads(self):
+        stat = Stat()
+
+        def worker():
+            for _ in range(10000):
+                stat.inc('foo')
+                stat.inc('bar', 2)
+
+        threads = [Thread(target=worker) for _ in range(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        self.assertEqual(stat.counters['foo'], 40000)
+        self.assertEqual(stat.counters['bar'], 80000)
+
+    def test_reset(self):
+        stat = Stat()
+        stat.inc('foo')
+        stat.collect('bar', 1)
+        stat.reset()
+        self.assertFalse('foo' in stat.counters)
+        self.assertFalse('bar' in stat.collections)
+        stat.inc('foo')
+        self.assertEqual(stat.counters['foo'], 1)
+
+    def test_set_counter(self):
+        stat = Stat()
+        stat.inc('foo')
+        counters = stat.counters
+        counters['foo'] += 10
+        counters['bar'] = 5
+        stat.inc('foo')
+        self.assertEqual(stat.counters['foo'], 12)
+        self.assertEqual(stat.counters['bar'], 5)
+        self.assertFalse('baz' in stat.counters)
+
+    def test_fold_shards_of_finished_threads(self):
+        stat = Stat()
+
+        def worker():
+            stat.inc('foo')
+            stat.observe('bar', 1)
+
+        for _ in range(10):
+            th = Thread(target=worker)
+            th.start()
+            th.join()
+        # Thread-local storage could be destroyed a bit later
+        # than the thread is joined
+        for _ in range(100):
+            if not stat.shards:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(stat.shards), 0)
+        self.assertEqual(stat.counters['foo'], 10)
+        self.assertEqual(stat.histograms['bar'].count, 10)
+
+    def test_ticker(self):
+        stat = Stat(logging_period=0.01)
+        with mock.patch.object(stat, 'print_progress_line') as func:
+            stat.start()
+            time.sleep(0.2)
+            stat.stop()
+        self.assertTrue(func.called)
+        self.assertTrue(stat.ticker is None)
+
+    def test_histogram_percentile(self):
+        hist = Histogram()
+        self.assertEqual(hist.percentile(50), None)
+        for num in range(1, 1001):
+            hist.add(num / 1000.0)
+        self.assertEqual(hist.count, 1000)
+        self.assertEqual(hist.min, 0.001)
+        self.assertEqual(hist.max, 1)
+        for percent in (50, 90, 99):
+            value = hist.percentile(percent)
+            self.assertTrue(percent / 100.0 <= value <= percent / 100.0 * 1.06)
+        self.assertEqual(hist.percentile(100), 1)
+
+    def test_histogram_extreme_values(self):
+        hist = Histogram()
+        hist.add(0)
+        hist.add(1e9)
+        self.assertTrue(hist.percentile(1) <= 1e-6)
+        self.assertEqual(hist.percentile(100), 1e9)
+
+    def test_histogram_merge(self):
+        stat = Stat()
+        stat.observe('foo', 1)
+
+        def worker():
+            stat.observe('foo', 2)
+
+        th = Thread(target=worker)
+        th.start()
+        th.join()
+        other = Histogram()
+        other.add(3)
+        stat.merge_histogram('foo', other)
+        hist = stat.histograms['foo']
+        self.assertEqual(hist.count, 3)
+        self.assertEqual(hist.min, 1)
+        self.assertEqual(hist.max, 3)
+        self.assertEqual(hist.get_summary()['mean'], 2)
+
+    def test_histogram_bucket_counts(self):
+        hist = Histogram()
+        for value in (0.001, 0.02, 0.03, 0.5, 100):
+            hist.add(value)
+        self.assertEqual(hist.get_bucket_counts([0.01, 0.1, 1, 10]), [1, 3, 4, 4])
@@ -219,3 +219,51 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         bot.setup_queue()
         bot.add_task(Task("page", url=self.server.get_url()))
         self.assertRaises(FatalError, bot.run)
+
+    def test_asyncio_network_service(self):
+        self.server.add_response(Response(data="Hello spider!"), count=20)
+        bot = build_spider(
+            SimpleSpider,
+            network_service="asyncio",
+            grab_transport="pycurl",
+            thread_number=5,
+        )
+        bot.setup_queue()
+        for num in six.moves.range(20):
+            bot.add_task(Task("baz", url=self.server.get_url("/%d" % num)))
+        bot.run()
+        self.assertEqual(20, len(bot.stat.collections["SAVED_ITEM"]))
+        self.assertEqual(20, bot.stat.counters["spider:request-network"])
+
+    def test_asyncio_network_service_grab_transport(self):
+        self.assertRaises(
+            SpiderError,
+            build_spider,
+            SimpleSpider,
+            network_service="asyncio",
+            grab_transport="urllib3",
+        )
+
+    def test_multicurl_socket_network_service(self):
+        self.server.add_response(Response(data="Hello spider!"), count=20)
+        bot = build_spider(
+            SimpleSpider,
+            network_service="multicurl-socket",
+            grab_transport="pycurl",
+            thread_number=5,
+        )
+        bot.setup_queue()
+        for num in six.moves.range(20):
+            bot.add_task(Task("baz", url=self.server.get_url("/%d" % num)))
+        bot.run()
+        self.assertEqual(20, len(bot.stat.collections["SAVED_ITEM"]))
+        self.assertEqual(20, bot.stat.counters["spider:request-network"])
+
+    def test_multicurl_socket_network_service_grab_transport(self):
+        self.assertRaises(
+            SpiderError,
+            build_spider,
+            SimpleSpider,
+            network_service="multicurl-socket",
+            grab_transport="urllib3",
+        )
@@ -11,13 +11,21 @@ If postgres then test next after the code below freezes:
 """
 import itertools
 import logging
+import os
 import time
 from copy import deepcopy
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
 
 import mock
 import six
 
 from grab.spider import Spider, Task
+from grab.spider.cache_memory import MemoryCache
+from grab.spider.cache_service import build_cache_validators
+from grab.spider.error import SpiderMisuseError
+from grab.util.codec import decompress
 from test_server import Request, Response
 from test_settings import MONGODB_CONNECTION, MYSQL_CONNECTION, POSTGRESQL_CONNECTION
 from tests.util import BaseGrabTestCase, build_spider
@@ -35,9 +43,16 @@ class ContentGenerator:
         self.counter += 1
 
 
+def get_item_body(item):
+    if item.get("codec"):
+        return decompress(item["codec"], item["body"])
+    else:
+        return item["body"]
+
+
 def skip_postgres_test(method):
     def wrapper(self):
-        if self.backend == "postgresql":
+        if getattr(self, "backend", None) == "postgresql":
             logging.error("Skipping %s method for postgres", method.__name__)
         else:
             method(self)
@@ -77,6 +92,53 @@ class SimpleSpider(Spider):
             yield Task("simple", url=self.meta["server"].get_url())
 
 
+class CacheValidatorsTestCase(TestCase):
+    def test_build_cache_validators(self):
+        head = (
+            b"HTTP/1.1 301 Moved\r\nLocation: /foo\r\nETag: \"old\"\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nEtag: \"new\"\r\n"
+            b"Last-Modified: Wed, 21 Oct 2015 07:28:00 GMT\r\n\r\n"
+        )
+        self.assertEqual(
+            {
+                "If-None-Match": '"new"',
+                "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT",
+            },
+            build_cache_validators(head),
+        )
+        self.assertEqual({}, build_cache_validators(b"HTTP/1.1 200 OK\r\n\r\n"))
+
+    def test_setup_reparse_without_cache(self):
+        bot = Spider()
+        self.assertRaises(SpiderMisuseError, bot.setup_reparse)
+
+
+class MemoryCacheTestCase(TestCase):
+    def build_item(self, body):
+        return {"body": body, "head": b""}
+
+    def test_max_items(self):
+        cache = MemoryCache(max_items=2)
+        cache.set_items([("a", self.build_item(b"1")), ("b", self.build_item(b"2"))])
+        # Access makes the item recently used
+        self.assertEqual(["a"], list(cache.get_items(["a"])))
+        cache.set_items([("c", self.build_item(b"3"))])
+        self.assertEqual(["a", "c"], sorted(cache.get_items(["a", "b", "c"])))
+
+    def test_max_bytes(self):
+        cache = MemoryCache(max_bytes=5)
+        cache.set_items([("a", self.build_item(b"12")), ("b", self.build_item(b"34"))])
+        cache.set_items([("a", self.build_item(b"5"))])
+        self.assertEqual(3, cache.size_bytes)
+        cache.set_items([("c", self.build_item(b"678"))])
+        self.assertEqual(["a", "c"], sorted(cache.get_items(["a", "b", "c"])))
+        # Item which does not fit into the cache is not saved
+        cache.set_items([("d", self.build_item(b"123456"))])
+        self.assertEqual(2, cache.size())
+        cache.remove_item("a")
+        self.assertEqual(3, cache.size_bytes)
+
+
 class SpiderCacheMixin(object):
     def setUp(self):  # pylint: disable=invalid-name
         super(SpiderCacheMixin, self).setUp()
@@ -84,14 +146,16 @@ class SpiderCacheMixin(object):
         #    Response(callback=ContentGenerator().callback), count=-1
         # )
 
-    def get_configured_spider(self, pause=None, spider_options=None):
+    def get_configured_spider(
+        self, pause=None, spider_options=None, cache_options=None
+    ):
         bot = build_spider(
             SimpleSpider,
             meta={"server": self.server, "pause": (pause or [])},
             parser_pool_size=1,
             **(spider_options or {})
         )
-        self.setup_cache(bot)
+        self.setup_cache(bot, **(cache_options or {}))
         bot.cache_reader_service.backend.clear()
         bot.setup_queue()
         return bot
@@ -162,6 +226,222 @@ class SpiderCacheMixin(object):
         self.assertEqual(1, bot.cache_reader_service.backend.size())
         bot.cache_reader_service.backend.close()
 
+    @skip_postgres_test
+    def test_batch_write(self):
+        self.server.add_response(
+            Response(callback=ContentGenerator().callback), count=-1
+        )
+        bot = self.get_configured_spider(cache_options={"batch_size": 2})
+        for num in range(5):
+            bot.add_task(Task("simple", url=self.server.get_url("/%d" % num)))
+        bot.run()
+        self.assertEqual(5, bot.stat.counters["cache:write-item"])
+        self.assertTrue(bot.stat.counters["cache:write-batch"] >= 3)
+        backend = bot.cache_reader_service.backend
+        backend.reconnect()
+        self.assertEqual(5, backend.size())
+        backend.close()
+
+    def test_reader_pool(self):
+        self.server.add_response(
+            Response(callback=ContentGenerator().callback), count=-1
+        )
+        urls = [self.server.get_url("/%d" % x) for x in range(10)]
+        bot = self.get_configured_spider()
+        for url in urls:
+            bot.add_task(Task("simple", url=url))
+        bot.run()
+        self.assertEqual(10, bot.stat.counters["cache:req-miss"])
+
+        bot = build_spider(SimpleSpider, meta={"server": self.server, "pause": []})
+        self.setup_cache(bot, reader_pool_size=3, read_batch_size=4)
+        bot.setup_queue()
+        for url in urls:
+            bot.add_task(Task("simple", url=url))
+        bot.run()
+        self.assertEqual(10, bot.stat.counters["cache:req-hit"])
+        self.assertEqual([1] * 10, bot.stat.collections["cnt"])
+
+    @skip_postgres_test
+    def test_get_items(self):
+        self.server.add_response(
+            Response(callback=ContentGenerator().callback), count=-1
+        )
+        bot = self.get_configured_spider()
+        bot.add_task(Task("simple", url=self.server.get_url("/foo")))
+        bot.add_task(Task("simple", url=self.server.get_url("/bar")))
+        bot.run()
+        backend = bot.cache_reader_service.backend
+        backend.reconnect()
+        items = backend.get_items(
+            [self.server.get_url(x) for x in ("/foo", "/bar", "/baz")]
+        )
+        self.assertEqual(
+            set([self.server.get_url("/foo"), self.server.get_url("/bar")]),
+            set(items),
+        )
+        self.assertEqual(b"<b>1</b>", get_item_body(items[self.server.get_url("/foo")]))
+        self.assertEqual({}, backend.get_items([]))
+        backend.close()
+
+    def test_cache_revalidation(self):
+        self.server.add_response(
+            Response(data=b"<b>1</b>", headers=[("ETag", '"v1"')]), count=1
+        )
+        bot = self.get_configured_spider()
+        bot.add_task(Task("simple", url=self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["cache:req-miss"])
+
+        self.server.add_response(Response(status=304), count=1)
+        bot = build_spider(SimpleSpider, meta={"server": self.server, "pause": []})
+        self.setup_cache(bot, cache_timeout=0)
+        bot.setup_queue()
+        bot.add_task(Task("simple", url=self.server.get_url()))
+        bot.run()
+        self.assertEqual('"v1"', self.server.request.headers.get("If-None-Match"))
+        self.assertEqual(1, bot.stat.counters["cache:req-stale"])
+        self.assertEqual(1, bot.stat.counters["cache:req-revalidated"])
+        self.assertEqual(1, bot.stat.counters["cache:req-hit"])
+        self.assertEqual([1], bot.stat.collections["cnt"])
+
+    def test_cache_timeout(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=-1)
+        bot = self.get_configured_spider()
+        bot.add_task(Task("simple", url=self.server.get_url()))
+        bot.run()
+
+        bot = build_spider(SimpleSpider, meta={"server": self.server, "pause": []})
+        self.setup_cache(bot, cache_timeout=3600)
+        bot.setup_queue()
+        bot.add_task(Task("simple", url=self.server.get_url()))
+        bot.add_task(Task("simple", url=self.server.get_url(), cache_timeout=0))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["cache:req-hit"])
+        self.assertEqual(1, bot.stat.counters["cache:req-expired"])
+        self.assertEqual([1, 1], bot.stat.collections["cnt"])
+
+    @skip_postgres_test
+    def test_deduplicate(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=-1)
+        bot = self.get_configured_spider(cache_options={"deduplicate": True})
+        urls = [self.server.get_url(x) for x in ("/foo", "/bar")]
+        for url in urls:
+            bot.add_task(Task("simple", url=url))
+        bot.run()
+
+        bot = build_spider(SimpleSpider, meta={"server": self.server, "pause": []})
+        self.setup_cache(bot)
+        bot.setup_queue()
+        for url in urls:
+            bot.add_task(Task("simple", url=url))
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["cache:req-hit"])
+        self.assertEqual([1, 1], bot.stat.collections["cnt"])
+
+        backend = bot.cache_reader_service.backend
+        backend.reconnect()
+        self.assertEqual(2, backend.size())
+        self.assertEqual(b"<b>1</b>", get_item_body(backend.get_item(urls[0])))
+        backend.remove_cache_item(urls[0])
+        self.assertEqual(0, backend.remove_unused_bodies())
+        self.assertEqual(b"<b>1</b>", get_item_body(backend.get_items(urls)[urls[1]]))
+        backend.remove_cache_item(urls[1])
+        self.assertEqual(1, backend.remove_unused_bodies())
+        backend.close()
+
+    @skip_postgres_test
+    def test_codec(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=-1)
+        url = self.server.get_url()
+        for codec in ("lzma", "none"):
+            bot = self.get_configured_spider(cache_options={"codec": codec})
+            bot.add_task(Task("simple", url=url))
+            bot.run()
+
+            bot = build_spider(SimpleSpider, meta={"server": self.server, "pause": []})
+            self.setup_cache(bot)
+            bot.setup_queue()
+            bot.add_task(Task("simple", url=url))
+            bot.run()
+            self.assertEqual(1, bot.stat.counters["cache:req-hit"])
+            self.assertEqual([1], bot.stat.collections["cnt"])
+
+            backend = bot.cache_reader_service.backend
+            backend.reconnect()
+            item = backend.get_item(url)
+            self.assertEqual(codec, item["codec"])
+            self.assertEqual(8, item["body_size"])
+            self.assertEqual(b"<b>1</b>", get_item_body(item))
+            backend.close()
+
+    @skip_postgres_test
+    def test_evict_max_size(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=-1)
+        bot = self.get_configured_spider(
+            cache_options={"max_size": 2, "evict_interval": 0.1}
+        )
+        for path in ("/a", "/b", "/c", "/d"):
+            bot.add_task(Task("simple", url=self.server.get_url(path)))
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["cache:evict-item"])
+        backend = bot.cache_reader_service.backend
+        backend.reconnect()
+        self.assertEqual(2, backend.size())
+        backend.close()
+
+    @skip_postgres_test
+    def test_remove_oldest_items(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=-1)
+        bot = self.get_configured_spider()
+        for path in ("/a", "/b", "/c"):
+            bot.add_task(Task("simple", url=self.server.get_url(path)))
+        bot.run()
+        backend = bot.cache_reader_service.backend
+        backend.reconnect()
+        self.assertEqual(
+            0, backend.remove_oldest_items(10, timestamp=int(time.time()) - 1000)
+        )
+        self.assertEqual(1, backend.remove_oldest_items(1))
+        self.assertEqual(2, backend.size())
+        self.assertEqual(2, backend.remove_oldest_items(10, timestamp=int(time.time())))
+        self.assertEqual(0, backend.size())
+        backend.close()
+
+    def test_memory_cache(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=-1)
+        bot = self.get_configured_spider(
+            pause=[0.5], cache_options={"memory_max_items": 10}
+        )
+        bot.add_task(Task("complex", url=self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["spider:request-network"])
+        self.assertEqual(3, bot.stat.counters["cache:memory-hit"])
+        self.assertEqual(3, bot.stat.counters["cache:req-hit"])
+        self.assertEqual([1, 1, 1, 1], bot.stat.collections["cnt"])
+
+    @skip_postgres_test
+    def test_reparse(self):
+        self.server.add_response(
+            Response(callback=ContentGenerator().callback), count=-1
+        )
+        bot = self.get_configured_spider()
+        for path in ("/a", "/b", "/c"):
+            bot.add_task(Task("simple", url=self.server.get_url(path)))
+        bot.run()
+
+        bot = build_spider(
+            SimpleSpider, meta={"server": self.server, "pause": []}, parser_pool_size=1
+        )
+        self.setup_cache(bot)
+        bot.setup_reparse(batch_size=2)
+        bot.add_task(Task("simple", url=self.server.get_url("/d")))
+        bot.run()
+        self.assertEqual(3, bot.stat.counters["cache:scan-item"])
+        self.assertEqual([1, 1, 1], bot.stat.collections["cnt"])
+        self.assertEqual(1, bot.stat.counters["spider:task-reparse-skipped"])
+        self.assertFalse("spider:request-network" in bot.stat.counters)
+
     @skip_postgres_test
     def test_has_item(self):
         self.server.add_response(
@@ -282,3 +562,132 @@ class SpiderPostgresqlCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
         self.setup_cache(bot)
         bot.cache_reader_service.backend.clear()
         self.assertEqual(0, bot.cache_reader_service.backend.size())
+
+    def test_rollback_on_error(self):
+        bot = build_spider(SimpleSpider)
+        self.setup_cache(bot)
+        backend = bot.cache_reader_service.backend
+        backend.clear()
+        def broken_execute_values(cursor, *unused_args, **unused_kwargs):
+            cursor.execute("SELECT * FROM no_such_table")
+
+        with mock.patch(
+            "grab.spider.cache_backend.postgresql.execute_values",
+            broken_execute_values,
+        ):
+            self.assertRaises(
+                Exception,
+                backend.set_item,
+                "http://example.com/",
+                {"url": "http://example.com/", "body": b"foo"},
+            )
+        # Failed transaction is rolled back and the connection is usable
+        self.assertEqual(0, backend.size())
+
+
+class SpiderSqliteCacheTestCase(SpiderCacheMixin, BaseGrabTestCase):
+    def setUp(self):
+        super(SpiderSqliteCacheTestCase, self).setUp()
+        self.db_dir = mkdtemp()
+        self.db_path = os.path.join(self.db_dir, "cache.sqlite")
+
+    def tearDown(self):
+        rmtree(self.db_dir)
+
+    def setup_cache(self, bot, **kwargs):
+        bot.setup_cache(backend="sqlite", database=self.db_path, **kwargs)
+
+    def test_cache_persistence(self):
+        self.server.add_response(Response(data=b"<b>1</b>"), count=1)
+        bot = self.get_configured_spider()
+        bot.add_task(Task("simple", self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["cache:req-miss"])
+
+        bot = build_spider(
+            SimpleSpider, meta={"server": self.server, "pause": []}
+        )
+        self.setup_cache(bot, use_compression=False)
+        bot.setup_queue()
+        bot.add_task(Task("simple", self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["cache:req-hit"])
+        self.assertEqual([1], bot.stat.collections["cnt"])
+
+    def test_missing_body(self):
+        bot = build_spider(SimpleSpider)
+        self.setup_cache(bot, deduplicate=True)
+        backend = bot.cache_reader_service.backend
+        urls = ["http://example.com/foo", "http://example.com/bar"]
+        backend.set_item(urls[0], {"url": urls[0], "body": b"foo"})
+        # Body of the item is removed e.g. by concurrent call
+        # of `remove_unused_bodies`
+        with mock.patch.object(backend, "save_bodies"):
+            backend.set_item(urls[1], {"url": urls[1], "body": b"bar"})
+        self.assertEqual(2, backend.size())
+        self.assertEqual([urls[0]], list(backend.get_items(urls)))
+        self.assertEqual(1, backend.size())
+        backend.set_item(urls[1], {"url": urls[1], "body": b"bar"})
+        self.assertEqual(b"bar", get_item_body(backend.get_item(urls[1])))
+        with mock.patch.object(backend, "save_bodies"):
+            backend.set_item(urls[0], {"url": urls[0], "body": b"baz"})
+        self.assertEqual(None, backend.get_item(urls[0]))
+        self.assertEqual([urls[1]], [x["url"] for x in backend.iterate_items()])
+        self.assertEqual(1, backend.size())
+
+
+class SpiderWarcCacheTestCase(BaseGrabTestCase):
+    def setUp(self):
+        super(SpiderWarcCacheTestCase, self).setUp()
+        self.warc_dir = mkdtemp()
+        self.warc_path = os.path.join(self.warc_dir, "crawl.warc.gz")
+
+    def tearDown(self):
+        rmtree(self.warc_dir)
+
+    def build_spider(self):
+        return build_spider(
+            SimpleSpider, meta={"server": self.server, "pause": []}, parser_pool_size=1
+        )
+
+    def test_write_and_replay(self):
+        self.server.add_response(
+            Response(callback=ContentGenerator().callback), count=-1
+        )
+        urls = [self.server.get_url(x) for x in ("/a", "/b")]
+        bot = self.build_spider()
+        bot.setup_queue()
+        bot.setup_warc(self.warc_path)
+        for url in urls:
+            bot.add_task(Task("simple", url=url))
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["warc:write-record"])
+
+        bot = self.build_spider()
+        bot.setup_cache(backend="warc", database=self.warc_path)
+        bot.setup_queue()
+        for url in urls + [self.server.get_url("/c")]:
+            bot.add_task(Task("simple", url=url))
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["cache:req-hit"])
+        self.assertEqual(1, bot.stat.counters["spider:request-network"])
+        self.assertEqual([1, 1, 1], bot.stat.collections["cnt"])
+
+        bot = self.build_spider()
+        bot.setup_cache(backend="warc", database=[self.warc_path])
+        bot.setup_reparse()
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["cache:scan-item"])
+        self.assertEqual([1, 1], bot.stat.collections["cnt"])
+
+    def test_eviction_not_supported(self):
+        open(self.warc_path, "wb").close()
+        bot = self.build_spider()
+        for options in ({"max_age": 10}, {"max_size": 10}):
+            self.assertRaises(
+                SpiderMisuseError,
+                bot.setup_cache,
+                backend="warc",
+                database=self.warc_path,
+                **options
+            )
@@ -0,0 +1,59 @@
+import time
+
+from grab.spider import Spider, Task
+from test_server import Response
+from tests.util import BaseGrabTestCase, build_spider
+
+
+class SimpleSpider(Spider):
+    def task_page(self, unused_grab, task):
+        self.stat.collect("page", task.url)
+
+
+class HostSchedulerTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_saturated_host_is_skipped(self):
+        bot = build_spider(SimpleSpider, priority_mode="const")
+        bot.setup_queue()
+        bot.setup_host_scheduler(max_host_connections=1)
+        for url in (
+            "http://foo.com/1",
+            "http://foo.com/2",
+            "http://bar.com/1",
+        ):
+            bot.add_task(Task("page", url=url))
+        task1 = bot.get_task_from_queue()
+        self.assertEqual("foo.com", task1.url.split("/")[2])
+        task2 = bot.get_task_from_queue()
+        self.assertEqual("http://bar.com/1", task2.url)
+        # Both hosts are saturated but there is a buffered task
+        self.assertTrue(bot.get_task_from_queue() is True)
+        self.assertEqual(1, bot.host_scheduler.size())
+        bot.release_task_host(task1)
+        task3 = bot.get_task_from_queue()
+        self.assertEqual("foo.com", task3.url.split("/")[2])
+        self.assertTrue(bot.get_task_from_queue() is None)
+
+    def test_host_delay(self):
+        bot = build_spider(SimpleSpider)
+        bot.setup_queue()
+        bot.setup_host_scheduler(max_host_connections=None, host_delay=10)
+        bot.add_task(Task("page", url="http://foo.com/1"))
+        bot.add_task(Task("page", url="http://foo.com/2"))
+        self.assertTrue(isinstance(bot.get_task_from_queue(), Task))
+        self.assertTrue(bot.get_task_from_queue() is True)
+
+    def test_spider_run(self):
+        self.server.add_response(Response(), count=6)
+        bot = build_spider(SimpleSpider, thread_number=4)
+        bot.setup_queue()
+        bot.setup_host_scheduler(max_host_connections=1, host_delay=0.1)
+        for num in range(6):
+            bot.add_task(Task("page", url=self.server.get_url("/%d" % num)))
+        start = time.time()
+        bot.run()
+        self.assertTrue(time.time() - start >= 0.5)
+        self.assertEqual(6, len(bot.stat.collections["page"]))
+        self.assertEqual({}, dict(bot.host_scheduler.active))
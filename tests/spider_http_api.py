@@ -1,10 +1,13 @@
 from threading import Thread
+import json
 import socket
 import time
 
 from six.moves.urllib.request import urlopen
+from test_server import Response
 
 from grab.spider import Spider, Task
+from grab.spider.http_api_service import render_metrics
 from tests.util import BaseGrabTestCase, build_spider
 
 
@@ -33,6 +36,7 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         bot.setup_queue()
         bot.add_task(Task('page', url=self.server.get_url(),
                           delay=1))
+        self.server.add_response(Response())
 
         def worker():
             bot.run()
@@ -44,3 +48,97 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         time.sleep(0.5)
         data = urlopen('http://localhost:%d' % api_port).read()
         self.assertTrue(b'<title>Grab Api</title>' in data)
+        th.join(10)
+
+    def test_metrics(self):
+
+        class SimpleSpider(Spider):
+            def task_page(self, grab, unused_task):
+                pass
+
+        api_port = self.get_open_port()
+        bot = build_spider(
+            SimpleSpider, http_api_port=api_port,
+        )
+        bot.setup_queue()
+        bot.add_task(Task('page', url=self.server.get_url(),
+                          delay=1))
+        self.server.add_response(Response())
+
+        th = Thread(target=bot.run) # pylint: disable=invalid-name
+        th.daemon = True
+        th.start()
+
+        time.sleep(0.5)
+        # Client which does not send request must not block other clients
+        slow_client = socket.create_connection(('localhost', api_port))
+        try:
+            res = urlopen('http://localhost:%d/metrics' % api_port, timeout=5)
+            data = res.read()
+        finally:
+            slow_client.close()
+        self.assertTrue(
+            res.info()['Content-Type'].startswith('application/openmetrics-text')
+        )
+        self.assertTrue(b'grab_queue_size{queue="task_queue"}' in data)
+        self.assertTrue(b'grab_network_active 0' in data)
+        self.assertTrue(data.endswith(b'# EOF\n'))
+
+        th.join(10)
+        data = render_metrics(bot)
+        self.assertTrue('grab_stat_total{key="spider:task-page"} 1\n' in data)
+        self.assertTrue(
+            'grab_histogram_bucket{key="network:total-time",le="+Inf"} 1\n'
+            in data
+        )
+        self.assertTrue('grab_histogram_count{key="network:total-time"} 1\n' in data)
+
+    def test_stop(self):
+
+        class SimpleSpider(Spider):
+            def task_page(self, grab, unused_task):
+                pass
+
+        api_port = self.get_open_port()
+        self.server.add_response(Response(), count=-1)
+        # Port is released when the spider is stopped
+        for _ in range(2):
+            bot = build_spider(SimpleSpider, http_api_port=api_port)
+            bot.setup_queue()
+            bot.add_task(Task('page', url=self.server.get_url()))
+            bot.run()
+            self.assertTrue(bot.http_api_service.server is None)
+        self.assertRaises(
+            socket.error, socket.create_connection, ('localhost', api_port)
+        )
+
+    def test_multiple_spiders(self):
+
+        class SimpleSpider(Spider):
+            def task_page(self, grab, unused_task):
+                pass
+
+        self.server.add_response(Response(), count=-1)
+        bots = []
+        for thread_number in (2, 3):
+            bot = build_spider(
+                SimpleSpider,
+                http_api_port=self.get_open_port(),
+                thread_number=thread_number,
+            )
+            bot.setup_queue()
+            bot.add_task(Task('page', url=self.server.get_url(), delay=1))
+            th = Thread(target=bot.run) # pylint: disable=invalid-name
+            th.daemon = True
+            th.start()
+            bots.append((bot, th))
+
+        time.sleep(0.5)
+        for bot, _ in bots:
+            data = urlopen(
+                'http://localhost:%d/api/info' % bot.http_api_port, timeout=5
+            ).read()
+            info = json.loads(data.decode('utf-8'))
+            self.assertEqual(bot.thread_number, info['thread_number'])
+        for _, th in bots:
+            th.join(10)
@@ -1,6 +1,13 @@
+import os
+
 from grab.spider import Spider, Task
 from test_server import Response
-from tests.util import BaseGrabTestCase, build_spider
+from tests.util import (
+    BaseGrabTestCase,
+    build_spider,
+    fork_is_unavailable,
+    skip_test_if,
+)
 
 
 class BasicSpiderTestCase(BaseGrabTestCase):
@@ -37,3 +44,73 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         self.server.add_response(Response(), count=2)
         bot.run()
         self.assertEqual(4, bot.foo_count)
+
+    @skip_test_if(fork_is_unavailable, "fork start method is not available")
+    def test_spider_mp_changes(self):
+        """This test tests that in multiprocess-mode changes made
+        inside handler are not applied to main spider instance."""
+        bot = build_spider(self.SimpleSpider, mp_mode=True)
+        bot.setup_queue()
+        bot.meta["url"] = self.server.get_url()
+        bot.add_task(Task("page", self.server.get_url()))
+        self.server.add_response(Response(), count=2)
+        bot.run()
+        self.assertEqual(2, bot.foo_count)
+        self.assertEqual(2, bot.stat.counters["parser:handler-processed"])
+
+    @skip_test_if(fork_is_unavailable, "fork start method is not available")
+    def test_mp_stat_and_errors(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.inc("page")
+                self.stat.collect("body", grab.doc.body)
+                if task.get("fail"):
+                    raise Exception("Shit happens!")
+
+        bot = build_spider(TestSpider, mp_mode=True, parser_pool_size=2)
+        bot.setup_queue()
+        self.server.add_response(Response(data=b"foo"), count=3)
+        for num in range(3):
+            bot.add_task(Task("page", self.server.get_url(), fail=(num == 0)))
+        bot.run()
+        self.assertEqual(3, bot.stat.counters["page"])
+        self.assertEqual([b"foo"] * 3, bot.stat.collections["body"])
+        self.assertEqual(1, len(bot.stat.collections["fatal"]))
+
+    @skip_test_if(fork_is_unavailable, "fork start method is not available")
+    def test_mp_requests_per_process(self):
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, unused_task):
+                self.stat.collect("pid", os.getpid())
+
+        bot = build_spider(
+            TestSpider, mp_mode=True, parser_requests_per_process=1, thread_number=1
+        )
+        bot.setup_queue()
+        self.server.add_response(Response(), count=3)
+        for _ in range(3):
+            bot.add_task(Task("page", self.server.get_url()))
+        bot.run()
+        pids = bot.stat.collections["pid"]
+        self.assertEqual(3, len(pids))
+        self.assertEqual(3, len(set(pids)))
+        self.assertFalse(os.getpid() in pids)
+
+    @skip_test_if(fork_is_unavailable, "fork start method is not available")
+    def test_mp_process_died(self):
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, task):
+                if task.get("die"):
+                    # pylint: disable=protected-access
+                    os._exit(1)
+                self.stat.inc("page")
+
+        bot = build_spider(TestSpider, mp_mode=True, parser_pool_size=1)
+        bot.setup_queue()
+        self.server.add_response(Response(), count=3)
+        for num in range(3):
+            bot.add_task(Task("page", self.server.get_url(), die=(num == 1)))
+        bot.run()
+        self.assertEqual(2, bot.stat.counters["page"])
+        self.assertEqual(1, len(bot.stat.collections["fatal"]))
+        self.assertEqual(1, bot.stat.counters["parser:worker-restarted"])
@@ -1,6 +1,13 @@
+from datetime import datetime, timedelta
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+import time
 from unittest import TestCase
 
+import mock
 import six
+from six.moves.queue import Empty
 
 from grab.spider import Spider, Task
 from grab.spider.error import SpiderMisuseError
@@ -47,6 +54,42 @@ class SpiderQueueMixin(object):
         bot = build_spider(self.SimpleSpider)
         bot.render_stats()
 
+    def test_put_many_get_many(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        bot.task_queue.put_many(
+            [
+                (Task("page", url="http://example.com/%d" % x), x, None)
+                for x in (3, 1, 4, 2)
+            ]
+        )
+        self.assertEqual(4, bot.task_queue.size())
+        tasks = bot.task_queue.get_many(3)
+        self.assertEqual(
+            ["http://example.com/%d" % x for x in (1, 2, 3)],
+            [x.url for x in tasks],
+        )
+        self.assertEqual(1, len(bot.task_queue.get_many(1)))
+        self.assertEqual([], bot.task_queue.get_many(10))
+
+    def test_batch_size(self):
+        bot = build_spider(self.SimpleSpider, thread_number=2)
+        self.setup_queue(bot, batch_size=3)
+        bot.task_queue.clear()
+        self.server.add_response(Response(), count=5)
+        self.assertEqual(
+            5,
+            bot.add_tasks(
+                [
+                    Task("page", url=self.server.get_url("/%d" % x))
+                    for x in range(5)
+                ]
+            ),
+        )
+        bot.run()
+        self.assertEqual(5, len(bot.stat.collections["url_history"]))
+
     def test_clear(self):
         bot = build_spider(self.SimpleSpider)
         self.setup_queue(bot)
@@ -60,8 +103,8 @@ class SpiderQueueMixin(object):
 
 
 class SpiderMemoryQueueTestCase(BaseGrabTestCase, SpiderQueueMixin):
-    def setup_queue(self, bot):
-        bot.setup_queue(backend="memory")
+    def setup_queue(self, bot, **kwargs):
+        bot.setup_queue(backend="memory", **kwargs)
 
     def test_schedule(self):
         """
@@ -98,12 +141,32 @@ class SpiderMemoryQueueTestCase(BaseGrabTestCase, SpiderQueueMixin):
         bot.task_queue.clear()
         self.assertEqual(0, len(bot.task_queue.schedule_list))
 
+    def test_schedule_due_tasks(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        now = datetime.utcnow()
+        for num, offset in enumerate((-3, 100, -1, -2, 100)):
+            bot.task_queue.put(
+                Task("page", url=self.server.get_url(), num=num),
+                priority=1,
+                schedule_time=now + timedelta(seconds=offset),
+            )
+        nums = []
+        while True:
+            try:
+                nums.append(bot.task_queue.get().num)
+            except Empty:
+                break
+        self.assertEqual([0, 2, 3], sorted(nums))
+        self.assertEqual(2, bot.task_queue.size())
+
 
 class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
     backend = "mongodb"
 
-    def setup_queue(self, bot):
-        bot.setup_queue(backend="mongodb", **MONGODB_CONNECTION)
+    def setup_queue(self, bot, **kwargs):
+        kwargs.update(MONGODB_CONNECTION)
+        bot.setup_queue(backend="mongodb", **kwargs)
 
     def test_schedule(self):
         """
@@ -134,12 +197,83 @@ class BasicSpiderTestCase(SpiderQueueMixin, BaseGrabTestCase):
         self.setup_queue(bot)
         bot.task_queue.clear()
 
+    def test_stale_claim(self):
+        from bson import ObjectId
+
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.clear()
+        bot.task_queue.put(Task("page", url="http://example.com/"), 1)
+        # Consumer has claimed the task and died before deleting it
+        bot.task_queue.collection.update_many(
+            {},
+            {
+                "$set": {
+                    "claim": ObjectId(),
+                    "claim_time": datetime.utcnow() - timedelta(hours=1),
+                }
+            },
+        )
+        tasks = bot.task_queue.get_many(10)
+        self.assertEqual(["http://example.com/"], [x.url for x in tasks])
+        self.assertEqual(0, bot.task_queue.size())
+
+
+class SpiderSqliteQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    def setUp(self):
+        super(SpiderSqliteQueueTestCase, self).setUp()
+        self.db_dir = mkdtemp()
+        self.db_path = os.path.join(self.db_dir, "queue.sqlite")
+
+    def tearDown(self):
+        rmtree(self.db_dir)
+
+    def setup_queue(self, bot, **kwargs):
+        bot.setup_queue(backend="sqlite", path=self.db_path, **kwargs)
+
+    def test_schedule(self):
+        server = self.server
+
+        class TestSpider(Spider):
+            def task_generator(self):
+                yield Task("page", url=server.get_url(), num=1)
+                yield Task("page", url=server.get_url(), delay=1.5, num=2)
+                yield Task("page", url=server.get_url(), delay=0.5, num=3)
+                yield Task("page", url=server.get_url(), delay=1, num=4)
+
+            def task_page(self, unused_grab, task):
+                self.stat.collect("numbers", task.num)
+
+        bot = build_spider(TestSpider, thread_number=1)
+        self.setup_queue(bot)
+        self.server.add_response(Response(), count=4)
+        bot.run()
+        self.assertEqual(bot.stat.collections["numbers"], [1, 3, 4, 2])
+
+    def test_persistence(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.add_task(Task("page", url="http://example.com/", foo="bar"))
+        bot.task_queue.close()
+
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        self.assertEqual(1, bot.task_queue.size())
+        task = bot.task_queue.get()
+        self.assertEqual("bar", task.foo)
+        self.assertEqual(0, bot.task_queue.size())
+
+    def test_path_required(self):
+        bot = build_spider(self.SimpleSpider)
+        self.assertRaises(SpiderMisuseError, bot.setup_queue, backend="sqlite")
+
 
 class SpiderRedisQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
     backend = "redis"
 
-    def setup_queue(self, bot):
-        bot.setup_queue(backend="redis", **REDIS_CONNECTION)
+    def setup_queue(self, bot, **kwargs):
+        kwargs.update(REDIS_CONNECTION)
+        bot.setup_queue(backend="redis", **kwargs)
 
     def test_delay_error(self):
         bot = build_spider(self.SimpleSpider)
@@ -152,6 +286,158 @@ class SpiderRedisQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
         )
 
 
+class SpiderRedisReliableQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    backend = "redis"
+
+    def setup_queue(self, bot, **kwargs):
+        kwargs.update(REDIS_CONNECTION)
+        bot.setup_queue(backend="redis", reliable=True, **kwargs)
+
+
+class SpiderFakeRedisReliableQueueTestCase(SpiderQueueMixin, BaseGrabTestCase):
+    """
+    Tests of reliable mode of redis queue which use in-process fake
+    of redis server.
+    """
+
+    def setUp(self):
+        super(SpiderFakeRedisReliableQueueTestCase, self).setUp()
+        try:
+            import fakeredis  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+        server = fakeredis.FakeServer()
+
+        def build_redis(**kwargs):
+            return fakeredis.FakeStrictRedis(
+                server=server, decode_responses=kwargs["decode_responses"]
+            )
+
+        patcher = mock.patch(
+            "grab.spider.queue_backend.redis_queue.StrictRedis", build_redis
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def setup_queue(self, bot, **kwargs):
+        kwargs.setdefault("reliable", True)
+        bot.setup_queue(backend="redis", **kwargs)
+
+    def test_ack(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot.task_queue.put(Task("page", url="http://example.com/"), 1)
+        task = bot.task_queue.get()
+        # Task is not acknowledged yet
+        self.assertEqual(1, bot.task_queue.size())
+        self.assertRaises(Empty, bot.task_queue.get)
+        bot.task_queue.ack(task)
+        self.assertEqual(0, bot.task_queue.size())
+
+    def test_expired_lease(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot, lease_timeout=-1)
+        bot.task_queue.put(Task("page", url="http://example.com/", foo=1), 5)
+        task = bot.task_queue.get()
+        bot.task_queue.put(Task("page", url="http://example.com/", foo=2), 7)
+        # Lease of the task has expired, e.g. spider process died,
+        # the task returns to the queue with its original priority
+        task2 = bot.task_queue.get()
+        self.assertEqual(1, task2.foo)
+        self.assertEqual(2, bot.task_queue.size())
+        bot.task_queue.ack(task2)
+        self.assertEqual(1, bot.task_queue.size())
+        self.assertEqual(2, bot.task_queue.get().foo)
+
+    def test_shared_queue(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        bot2 = build_spider(self.SimpleSpider)
+        self.setup_queue(bot2)
+        bot.task_queue.put_many(
+            [(Task("page", url="http://example.com/%d" % x), x, None) for x in range(4)]
+        )
+        urls = [x.url for x in bot.task_queue.get_many(2)]
+        urls2 = [x.url for x in bot2.task_queue.get_many(10)]
+        self.assertEqual(
+            ["http://example.com/%d" % x for x in range(4)], urls + urls2
+        )
+
+    def test_spider_acks_tasks(self):
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, task):
+                self.stat.collect("url", task.url)
+                if not task.get("last"):
+                    yield Task("page", url=task.url + "?last", last=True)
+
+            def task_fail(self, unused_grab, unused_task):
+                raise Exception("Shit happens!")
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider, thread_number=2, network_try_limit=1)
+        self.setup_queue(bot)
+        bot.add_task(Task("page", url=self.server.get_url()))
+        bot.add_task(Task("fail", url=self.server.get_url()))
+        bot.add_task(Task("page", url="http://127.0.0.1:1/", raw=False))
+        bot.run()
+        self.assertEqual(2, len(bot.stat.collections["url"]))
+        redis = bot.task_queue.queue_object.connect()
+        self.assertFalse(redis.exists(bot.task_queue.processing_key))
+        self.assertFalse(redis.exists(bot.task_queue.priority_key))
+
+    def test_ack_after_child_tasks(self):
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, task):
+                if not task.get("last"):
+                    yield Task("page", url=task.url + "?last", last=True)
+
+            def add_tasks(self, tasks, queue=None, raise_error=False):
+                # Task queue is slow
+                time.sleep(0.5)
+                return super(TestSpider, self).add_tasks(
+                    tasks, queue=queue, raise_error=raise_error
+                )
+
+            def ack_task(self, task):
+                if not task.get("last"):
+                    # Parent task is still leased and the child task
+                    # is already in the queue
+                    self.stat.collect("size", self.task_queue.size())
+                super(TestSpider, self).ack_task(task)
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider)
+        self.setup_queue(bot)
+        bot.add_task(Task("page", url=self.server.get_url()))
+        bot.run()
+        self.assertEqual([2], bot.stat.collections["size"])
+
+    def test_spider_renews_leases(self):
+        class TestSpider(Spider):
+            def task_page(self, unused_grab, task):
+                self.stat.collect("url", task.url)
+                # Task is processed longer than its lease lasts
+                time.sleep(2)
+
+        self.server.add_response(Response(), count=-1)
+        bot = build_spider(TestSpider)
+        self.setup_queue(bot, lease_timeout=1)
+        bot.add_task(Task("page", url=self.server.get_url()))
+        bot.run()
+        self.assertEqual(1, len(bot.stat.collections["url"]))
+        self.assertEqual(0, bot.task_queue.size())
+
+    def test_spider_keeps_shared_queue(self):
+        bot = build_spider(self.SimpleSpider)
+        self.setup_queue(bot)
+        self.server.add_response(Response())
+        bot.add_task(Task("page", url=self.server.get_url()))
+        # Queue could be used by other spider processes
+        with mock.patch.object(bot.task_queue, "clear") as clear:
+            bot.run()
+        self.assertFalse(clear.called)
+
+
 class QueueInterfaceTestCase(TestCase):
     def test_abstract_methods(self):
         """Just to improve test coverage"""
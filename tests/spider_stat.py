@@ -1,6 +1,14 @@
+import json
+
 from grab.spider import Spider, Task
 from test_server import Response
-from tests.util import BaseGrabTestCase, build_spider
+from tests.util import (
+    BaseGrabTestCase,
+    build_spider,
+    fork_is_unavailable,
+    skip_test_if,
+    temp_file,
+)
 
 
 class BasicSpiderTestCase(BaseGrabTestCase):
@@ -50,3 +58,135 @@ class BasicSpiderTestCase(BaseGrabTestCase):
         self.server.add_response(Response())
         bot.run()
         bot.render_stats()
+
+    def test_histograms(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.add_task(Task("page", url=self.server.get_url()))
+        bot.add_task(Task("page", url=self.server.get_url("/2")))
+        self.server.add_response(Response(), count=2)
+        bot.run()
+        hists = bot.stat.histograms
+        self.assertEqual(2, hists["network:total-time"].count)
+        self.assertEqual(2, hists["network:total-time-page"].count)
+        self.assertEqual(2, hists["parser:handler-time-page"].count)
+        self.assertTrue(hists["network:total-time"].max > 0)
+        self.assertTrue("network:total-time-page: count=2" in bot.render_stats())
+
+    def test_connect_time_histograms(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        self.server.add_response(Response(), count=-1)
+        for transport, network_service, count in (
+            ("pycurl", "multicurl", 1),
+            ("urllib3", "threaded", 0),
+        ):
+            bot = build_spider(
+                TestSpider, grab_transport=transport, network_service=network_service
+            )
+            bot.setup_queue()
+            bot.add_task(Task("page", url=self.server.get_url()))
+            bot.run()
+            hists = bot.stat.histograms
+            self.assertEqual(1, hists["network:total-time"].count)
+            # urllib3 transport does not measure connect time
+            for key in ("network:connect-time", "network:name-lookup-time"):
+                self.assertEqual(count, hists[key].count if key in hists else 0)
+
+    @skip_test_if(fork_is_unavailable, "fork start method is not available")
+    def test_histograms_multiprocess(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider, mp_mode=True)
+        bot.setup_queue()
+        bot.add_task(Task("page", url=self.server.get_url()))
+        self.server.add_response(Response())
+        bot.run()
+        self.assertEqual(1, bot.stat.histograms["parser:handler-time-page"].count)
+
+    def test_trace(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        with temp_file() as trace_file:
+            bot = build_spider(TestSpider)
+            bot.setup_queue()
+            bot.setup_trace(path=trace_file, sample_rate=1)
+            bot.add_task(Task("page", url=self.server.get_url()))
+            bot.add_task(Task("page", url=self.server.get_url("/2")))
+            self.server.add_response(Response(), count=2)
+            bot.run()
+            with open(trace_file) as inp:
+                data = json.load(inp)
+        hists = bot.stat.histograms
+        for stage in (
+            "queue-wait",
+            "network-wait",
+            "network-time",
+            "dispatcher-wait",
+            "dispatcher-time",
+            "parser-wait",
+            "parser-time",
+        ):
+            self.assertEqual(2, hists["trace:%s" % stage].count)
+        threads = [x for x in data["traceEvents"] if x["ph"] == "M"]
+        self.assertEqual(2, len(threads))
+        spans = [x for x in data["traceEvents"] if x["ph"] == "X"]
+        self.assertEqual(14, len(spans))
+        self.assertEqual(set(["page"]), set(x["cat"] for x in spans))
+
+    def test_trace_max_tasks(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        with temp_file() as trace_file:
+            bot = build_spider(TestSpider)
+            bot.setup_queue()
+            bot.setup_trace(path=trace_file, sample_rate=1, max_tasks=1)
+            bot.add_task(Task("page", url=self.server.get_url()))
+            bot.add_task(Task("page", url=self.server.get_url("/2")))
+            self.server.add_response(Response(), count=2)
+            bot.run()
+            with open(trace_file) as inp:
+                data = json.load(inp)
+        threads = [x for x in data["traceEvents"] if x["ph"] == "M"]
+        self.assertEqual(1, len(threads))
+        self.assertEqual(2, bot.stat.histograms["trace:parser-time"].count)
+
+    @skip_test_if(fork_is_unavailable, "fork start method is not available")
+    def test_trace_multiprocess(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                pass
+
+        bot = build_spider(TestSpider, mp_mode=True)
+        bot.setup_queue()
+        bot.setup_trace()
+        bot.add_task(Task("page", url=self.server.get_url()))
+        self.server.add_response(Response())
+        bot.run()
+        self.assertEqual(1, bot.stat.histograms["trace:parser-wait"].count)
+        self.assertEqual(1, bot.stat.histograms["trace:parser-time"].count)
+
+    def test_trace_disabled(self):
+        class TestSpider(Spider):
+            def task_page(self, grab, task):
+                self.stat.inc("trace-%s" % task.trace)
+
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.add_task(Task("page", url=self.server.get_url()))
+        self.server.add_response(Response())
+        bot.run()
+        self.assertEqual(1, bot.stat.counters["trace-None"])
+        self.assertFalse(any(x.startswith("trace:") for x in bot.stat.histograms))
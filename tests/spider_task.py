@@ -1,9 +1,12 @@
+import pickle
+
 from test_server import Request, Response
 
 from grab import Grab
 from grab.error import InvalidResponseError
 from grab.spider import NoTaskHandler, Spider, SpiderMisuseError, Task, base
 from grab.spider.error import SpiderError
+from grab.spider.task import deserialize_task, serialize_task
 from tests.util import BaseGrabTestCase, build_grab, build_spider
 
 
@@ -419,3 +422,26 @@ class TestSpiderTestCase(BaseGrabTestCase):
         bot.run()
 
         self.assertEqual(1, bot.stat.counters["foo"])
+
+    def test_serialize_task(self):
+        grab = build_grab(url="http://example.com/", headers={"Foo": "bar"})
+        task = Task("page", grab=grab, priority=5, foo=[1, 2])
+        data = serialize_task(task)
+        self.assertTrue(len(data) < len(pickle.dumps(task)))
+        task2 = deserialize_task(data)
+        self.assertEqual(task.__dict__, task2.__dict__)
+        self.assertEqual("http://example.com/", task2.url)
+        self.assertEqual({"Foo": "bar"}, task2.grab_config["headers"])
+        self.assertEqual(2, task2.clone().task_try_count)
+
+    def test_deserialize_legacy_pickle(self):
+        task = Task("page", url="http://example.com/", foo="bar")
+        # Python 2 uses protocol 0 by default
+        for protocol in (0, 1, 2):
+            task2 = deserialize_task(pickle.dumps(task, protocol))
+            self.assertEqual("http://example.com/", task2.url)
+            self.assertEqual("bar", task2.foo)
+
+    def test_deserialize_unknown_version(self):
+        data = serialize_task(Task("page", url="http://example.com/"))
+        self.assertRaises(SpiderMisuseError, deserialize_task, b"\x7f" + data[1:])
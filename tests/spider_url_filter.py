@@ -0,0 +1,143 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from grab.spider import Spider, Task
+from grab.spider.error import SpiderMisuseError
+from grab.spider.url_filter import (
+    BloomUrlFilter,
+    FileBloomUrlFilter,
+    SetUrlFilter,
+    build_bloom_params,
+)
+from test_server import Response
+from tests.util import BaseGrabTestCase, build_spider
+
+
+class SimpleSpider(Spider):
+    def task_page(self, unused_grab, task):
+        self.stat.collect("url", task.url)
+
+
+class UrlFilterTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def check_filter(self, url_filter):
+        self.assertTrue(url_filter.add("http://example.com/1"))
+        self.assertTrue(url_filter.add("http://example.com/2"))
+        self.assertFalse(url_filter.add("http://example.com/1"))
+        self.assertFalse(url_filter.add(u"http://example.com/2"))
+
+    def test_set_filter(self):
+        self.check_filter(SetUrlFilter())
+
+    def test_bloom_filter(self):
+        self.check_filter(BloomUrlFilter(capacity=1000, error_rate=0.01))
+
+    def test_bloom_filter_error_rate(self):
+        url_filter = BloomUrlFilter(capacity=10000, error_rate=0.01)
+        for num in range(10000):
+            url_filter.add("http://example.com/%d" % num)
+        self.assertTrue("http://example.com/1" in url_filter)
+        false_positives = sum(
+            1 for num in range(10000) if "http://example.com/new/%d" % num in url_filter
+        )
+        self.assertTrue(false_positives < 200)
+
+    def test_bloom_params(self):
+        self.assertEqual((9586, 7), build_bloom_params(1000, 0.01))
+        self.assertRaises(SpiderMisuseError, build_bloom_params, 0, 0.01)
+        self.assertRaises(SpiderMisuseError, build_bloom_params, 1000, 1)
+
+    def test_file_bloom_filter(self):
+        path = os.path.join(self.tmp_dir, "urls.bloom")
+        url_filter = FileBloomUrlFilter(path, capacity=1000, error_rate=0.01)
+        self.check_filter(url_filter)
+        url_filter.close()
+        # Parameters are loaded from the file
+        url_filter = FileBloomUrlFilter(path, capacity=10 ** 6)
+        self.assertEqual(9586, url_filter.bit_number)
+        self.assertFalse(url_filter.add("http://example.com/1"))
+        self.assertTrue(url_filter.add("http://example.com/3"))
+        url_filter.close()
+
+    def test_file_bloom_filter_reopen(self):
+        path = os.path.join(self.tmp_dir, "urls.bloom")
+        urls = ["http://example.com/%d" % x for x in range(50)]
+        url_filter = FileBloomUrlFilter(path, capacity=1000, error_rate=0.01)
+        for url in urls:
+            url_filter.add(url)
+        url_filter.close()
+        # Bits are stored after the header in the same order as
+        # bits of the in-memory filter
+        memory_filter = BloomUrlFilter(capacity=1000, error_rate=0.01)
+        for url in urls:
+            memory_filter.add(url)
+        with open(path, "rb") as inp:
+            data = inp.read()
+        self.assertEqual(b"GRABBLM1", data[:8])
+        self.assertEqual(bytes(memory_filter.bits), data[24:])
+
+        url_filter = FileBloomUrlFilter(path)
+        for url in urls:
+            self.assertTrue(url in url_filter)
+            self.assertFalse(url_filter.add(url))
+        self.assertFalse("http://example.com/foo" in url_filter)
+        url_filter.close()
+
+    def test_file_bloom_filter_invalid_file(self):
+        path = os.path.join(self.tmp_dir, "urls.bloom")
+        with open(path, "wb") as out:
+            out.write(b"x" * 100)
+        self.assertRaises(SpiderMisuseError, FileBloomUrlFilter, path)
+
+
+class SpiderUrlFilterTestCase(BaseGrabTestCase):
+    def setUp(self):
+        self.server.reset()
+
+    def test_add_task(self):
+        bot = build_spider(SimpleSpider)
+        bot.setup_queue()
+        bot.setup_url_filter()
+        url = self.server.get_url()
+        self.assertTrue(bot.add_task(Task("page", url=url)))
+        self.assertFalse(bot.add_task(Task("page", url=url)))
+        self.assertEqual(1, bot.stat.counters["spider:task-url-filtered"])
+        # Tasks which bypass the filter
+        self.assertTrue(bot.add_task(Task("page", url=url, refresh_cache=True)))
+        self.assertTrue(bot.add_task(Task("page", url=url, task_try_count=2)))
+        self.assertTrue(bot.add_task(Task("page", url=url, network_try_count=1)))
+        self.assertTrue(bot.add_task(Task("page", url=url).clone()))
+        self.assertEqual(5, bot.task_queue.size())
+
+    def test_unknown_backend(self):
+        bot = build_spider(SimpleSpider)
+        self.assertRaises(SpiderMisuseError, bot.setup_url_filter, "foo")
+
+    def test_spider_run(self):
+        class TestSpider(SimpleSpider):
+            def task_generator(self):
+                for _ in range(3):
+                    yield Task("page", url=server.get_url("/1"))
+                yield Task("page", url=server.get_url("/2"))
+
+            def task_page(self, grab, task):
+                super(TestSpider, self).task_page(grab, task)
+                yield Task("page", url=server.get_url("/1"))
+
+        server = self.server
+        self.server.add_response(Response(), count=2)
+        bot = build_spider(TestSpider)
+        bot.setup_queue()
+        bot.setup_url_filter("bloom", capacity=1000)
+        bot.run()
+        self.assertEqual(
+            sorted([server.get_url("/1"), server.get_url("/2")]),
+            sorted(bot.stat.collections["url"]),
+        )
@@ -11,6 +11,8 @@ from test_server import TestServer
 
 from grab import Grab
 from grab import base
+from grab.spider.error import SpiderMisuseError
+from grab.spider.parser_service import get_mp_context
 
 logger = logging.getLogger('tests.util') # pylint: disable=invalid-name
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -158,6 +160,17 @@ def skip_test_if(condition, why_message):
     return decorator
 
 
+def fork_is_unavailable():
+    """
+    Multiprocess mode of the spider requires the fork start method.
+    """
+    try:
+        get_mp_context()
+    except SpiderMisuseError:
+        return True
+    return False
+
+
 def run_test_if(condition, why_message):
     def decorator(func):
         def caller(*args, **kwargs):
@@ -0,0 +1,24 @@
+from unittest import TestCase
+
+from grab.error import GrabMisuseError
+from grab.util.codec import build_codec, decompress, get_available_codecs
+
+
+class UtilCodecTestCase(TestCase):
+    def test_build_codec(self):
+        codec = build_codec("zlib:9")
+        self.assertEqual("zlib", codec.name)
+        self.assertEqual(9, codec.level)
+        self.assertEqual(6, build_codec("zlib").level)
+
+    def test_build_codec_invalid(self):
+        self.assertRaises(GrabMisuseError, build_codec, "foo")
+        self.assertRaises(GrabMisuseError, build_codec, "zlib:high")
+
+    def test_compress(self):
+        data = b"<html>" + b"foo" * 1000 + b"</html>"
+        self.assertTrue({"none", "zlib"} <= set(get_available_codecs()))
+        for name in get_available_codecs():
+            codec = build_codec(name)
+            self.assertEqual(data, codec.decompress(codec.compress(data)))
+            self.assertEqual(data, decompress(name, codec.compress(data)))
@@ -0,0 +1,117 @@
+import gzip
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from grab.util.warc import (
+    WarcError,
+    WarcWriter,
+    get_index_path,
+    iterate_records,
+    load_index,
+    parse_http_response,
+    parse_record,
+    read_record_data,
+)
+
+HEAD = (
+    b"HTTP/1.1 301 Moved\r\nLocation: /foo\r\n\r\n"
+    b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n"
+    b"Content-Encoding: gzip\r\nContent-Length: 10\r\n\r\n"
+)
+
+
+class UtilWarcTestCase(TestCase):
+    def setUp(self):
+        self.tmp_dir = mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "test.warc.gz")
+
+    def tearDown(self):
+        rmtree(self.tmp_dir)
+
+    def write_responses(self):
+        writer = WarcWriter(self.path)
+        writer.write_response(
+            "http://example.com/", HEAD, b"<b>1</b>", task_name="page",
+            response_url="http://example.com/foo",
+        )
+        writer.write_response("http://example.com/bar", HEAD, b"<b>2</b>")
+        writer.close()
+
+    def read_file(self):
+        with open(self.path, "rb") as inp:
+            return inp.read()
+
+    def test_write_read(self):
+        self.write_responses()
+        data = self.read_file()
+        records = list(iterate_records(data))
+        self.assertEqual(3, len(records))
+        self.assertEqual(b"warcinfo", records[0][2][b"warc-type"])
+        offset, length, headers, payload = records[1]
+        self.assertEqual(b"http://example.com/", headers[b"warc-target-uri"])
+        self.assertEqual(b"page", headers[b"grab-task-name"])
+        self.assertEqual(b"http://example.com/foo", headers[b"grab-response-uri"])
+        self.assertEqual(length, read_record_data(data, offset)[1])
+        code, head, body = parse_http_response(payload)
+        self.assertEqual(200, code)
+        self.assertEqual(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n"
+            b"Content-Length: 8\r\n\r\n",
+            head,
+        )
+        self.assertEqual(b"<b>1</b>", body)
+        # Each record is a gzip member, so standard tools could read the file
+        with gzip.open(self.path) as inp:
+            self.assertTrue(inp.read().startswith(b"WARC/1.0"))
+
+    def test_load_index(self):
+        self.write_responses()
+        data = self.read_file()
+        index = load_index(self.path, data)
+        self.assertEqual(["http://example.com/", "http://example.com/bar"], sorted(index))
+        # Index file is rebuilt if it does not match the WARC file
+        os.unlink(get_index_path(self.path))
+        with open(get_index_path(self.path), "w") as out:
+            out.write("100 10 http://example.com/\n")
+        self.assertEqual(index, load_index(self.path, data))
+        with open(get_index_path(self.path)) as inp:
+            self.assertEqual(3, len(inp.readlines()))
+
+    def test_foreign_record(self):
+        payload = (
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"3\r\n<b>\r\n4\r\n1</b\r\n1\r\n>\r\n0\r\n\r\n"
+        )
+        record = (
+            b"WARC/1.0\r\nWARC-Type: response\r\n"
+            b"WARC-Target-URI: http://example.com/\r\n"
+            b"Content-Length: %d\r\n\r\n%s\r\n\r\n" % (len(payload), payload)
+        )
+        raw, length = read_record_data(record + record, 0)
+        self.assertEqual(len(record), length)
+        _, payload = parse_record(raw)
+        self.assertEqual(b"<b>1</b>", parse_http_response(payload)[2])
+
+    def test_head_without_status_line(self):
+        writer = WarcWriter(self.path)
+        # urllib3 transport does not save the status line
+        writer.write_response(
+            "http://example.com/",
+            b"Listen-Port: 80\r\nContent-Type: text/html\r\n\r\n",
+            b"<b>1</b>",
+            code=404,
+        )
+        writer.close()
+        payload = list(iterate_records(self.read_file()))[1][3]
+        code, head, body = parse_http_response(payload)
+        self.assertEqual(404, code)
+        self.assertTrue(head.startswith(b"HTTP/1.1 404 Not Found\r\nListen-Port: 80"))
+        self.assertEqual(b"<b>1</b>", body)
+
+    def test_invalid_status_line(self):
+        for line in (b"Listen-Port: 39841", b"HTTP/1.1", b"HTTP/1.1 OK"):
+            self.assertRaises(
+                WarcError, parse_http_response, line + b"\r\n\r\nbody"
+            )